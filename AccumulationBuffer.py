@@ -0,0 +1,49 @@
+import json
+import os
+
+import numpy as np
+
+
+class AccumulationBuffer:
+    """
+    Running per-pixel sum of samples and how many samples went into each pixel,
+    for progressive rendering. It is checkpointed as an .npz file so a killed
+    render resumes from its last saved pass instead of starting over.
+    """
+
+    def __init__(self, width: int, height: int, settings: dict = None):
+        self.width = width
+        self.height = height
+        self.total = np.zeros((height, width, 3))
+        self.samples = np.zeros((height, width), dtype=np.int64)
+        self.passes = 0
+        # Round trip through JSON so settings compare equal to ones read back from a checkpoint
+        self.settings = json.loads(json.dumps(settings or {}))
+
+    def add(self, pixels: np.ndarray, samples=1) -> None:
+        # samples is the weight of each pixel of this pass, a scalar or an (height, width) array
+        samples = np.broadcast_to(samples, self.samples.shape)
+        self.total += pixels * samples[..., np.newaxis]
+        self.samples += samples
+        self.passes += 1
+
+    @property
+    def image(self) -> np.ndarray:
+        return np.clip(self.total / np.maximum(self.samples, 1)[..., np.newaxis], 0, 1)
+
+    def save(self, path: str) -> None:
+        # Write next to the old checkpoint and swap, so being killed mid-write never leaves a broken file
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as checkpoint:
+            np.savez(checkpoint, total=self.total, samples=self.samples, passes=self.passes, settings=json.dumps(self.settings))
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'AccumulationBuffer':
+        with np.load(path) as checkpoint:
+            height, width = checkpoint['samples'].shape
+            buffer = AccumulationBuffer(width=width, height=height, settings=json.loads(str(checkpoint['settings'])))
+            buffer.total = np.array(checkpoint['total'])
+            buffer.samples = np.array(checkpoint['samples'])
+            buffer.passes = int(checkpoint['passes'])
+        return buffer
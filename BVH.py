@@ -0,0 +1,288 @@
+import math
+
+import numpy as np
+
+from BoundingBox import slab_test
+
+
+class BVH:
+    """
+    Bounding volume hierarchy built with the binned surface area heuristic.
+
+    The builder only works on arrays of per-item bounds, so the same tree can
+    index Scene primitives or the triangles of a mesh. Nodes are stored flat:
+    an interior node has count == 0 and two children, a leaf covers
+    self.indices[start:start + count].
+    """
+
+    NUMBER_OF_BINS = 12
+    TRAVERSAL_COST = 1.0
+    INTERSECTION_COST = 1.0
+    _cached_lists = None
+
+    def __init__(self, minimums: np.ndarray, maximums: np.ndarray, leaf_size: int = 2, max_leaf_size: int = 8):
+        self.leaf_size = max(int(leaf_size), 1)
+        self.max_leaf_size = max(int(max_leaf_size), self.leaf_size)
+        minimums = np.asarray(minimums, dtype=np.float64).reshape(-1, 3)
+        maximums = np.asarray(maximums, dtype=np.float64).reshape(-1, 3)
+        self._build(minimums=minimums, maximums=maximums)
+
+    @staticmethod
+    def from_bounding_boxes(bounding_boxes: list, leaf_size: int = 2, max_leaf_size: int = 8) -> 'BVH':
+        minimums = np.array([box.minimum for box in bounding_boxes], dtype=np.float64).reshape(-1, 3)
+        maximums = np.array([box.maximum for box in bounding_boxes], dtype=np.float64).reshape(-1, 3)
+        return BVH(minimums=minimums, maximums=maximums, leaf_size=leaf_size, max_leaf_size=max_leaf_size)
+
+    @staticmethod
+    def from_arrays(node_bounds: np.ndarray, node_left: np.ndarray, node_right: np.ndarray, node_start: np.ndarray, node_count: np.ndarray, indices: np.ndarray = None, leaf_size: int = 2, max_leaf_size: int = 8) -> 'BVH':
+        # A previously built tree, e.g. read back from a SceneFile, without running the builder again
+        bvh = BVH.__new__(BVH)
+        bvh.leaf_size = max(int(leaf_size), 1)
+        bvh.max_leaf_size = max(int(max_leaf_size), bvh.leaf_size)
+        bvh.node_bounds = np.array(node_bounds, dtype=np.float64).reshape(-1, 6)
+        bvh.node_left = np.array(node_left, dtype=np.int64)
+        bvh.node_right = np.array(node_right, dtype=np.int64)
+        bvh.node_start = np.array(node_start, dtype=np.int64)
+        bvh.node_count = np.array(node_count, dtype=np.int64)
+        bvh.number_of_items = int(bvh.node_count.sum())
+        bvh.indices = np.arange(bvh.number_of_items, dtype=np.int64) if indices is None else np.array(indices, dtype=np.int64)
+        return bvh
+
+    def __len__(self) -> int:
+        return len(self.node_count)
+
+    def depth(self) -> int:
+        # Edges on the longest path from the root to a leaf, found a level at a time. SAH splits can be very uneven, so this is not bounded by log2 of the item count
+        if not self.number_of_items:
+            return 0
+        depth = 0
+        level = np.zeros(1, dtype=np.int64)
+        while True:
+            interior = level[self.node_count[level] == 0]
+            if not len(interior):
+                return depth
+            level = np.concatenate((self.node_left[interior], self.node_right[interior]))
+            depth += 1
+
+    def refit(self, minimums: np.ndarray, maximums: np.ndarray) -> None:
+        """
+        Recompute the node bounds for items that have moved, keeping the tree as it is.
+        Children are always created after their parent, so walking the nodes in reverse
+        order reaches both children of a node before the node itself.
+        """
+        if not self.number_of_items:
+            return
+        minimums = np.asarray(minimums, dtype=np.float64).reshape(-1, 3)[self.indices]
+        maximums = np.asarray(maximums, dtype=np.float64).reshape(-1, 3)[self.indices]
+        # Leaves partition indices into contiguous runs, so one reduceat gives every leaf's bounds
+        leaves = np.nonzero(self.node_count)[0]
+        leaves = leaves[np.argsort(self.node_start[leaves])]
+        self.node_bounds[leaves, :3] = np.minimum.reduceat(minimums, self.node_start[leaves], axis=0)
+        self.node_bounds[leaves, 3:] = np.maximum.reduceat(maximums, self.node_start[leaves], axis=0)
+        bounds = self.node_bounds.tolist()
+        left = self.node_left.tolist()
+        right = self.node_right.tolist()
+        for node in reversed(np.nonzero(self.node_count == 0)[0].tolist()):
+            a = bounds[left[node]]
+            b = bounds[right[node]]
+            bounds[node] = [min(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]), max(a[4], b[4]), max(a[5], b[5])]
+        self.node_bounds = np.array(bounds, dtype=np.float64).reshape(-1, 6)
+        self._cached_lists = None
+
+    def refit_bounding_boxes(self, bounding_boxes: list) -> None:
+        self.refit(minimums=np.array([box.minimum for box in bounding_boxes], dtype=np.float64), maximums=np.array([box.maximum for box in bounding_boxes], dtype=np.float64))
+
+    def translate(self, offset: np.ndarray) -> None:
+        # Every item moved by the same amount, so every node just moves with them
+        self.node_bounds = self.node_bounds + np.concatenate((offset, offset))
+        self._cached_lists = None
+
+    def _build(self, minimums: np.ndarray, maximums: np.ndarray) -> None:
+        number_of_items = len(minimums)
+        self.number_of_items = number_of_items
+        self.indices = np.arange(number_of_items, dtype=np.int64)
+        centroids = (minimums + maximums) * 0.5
+
+        bounds = []
+        left = []
+        right = []
+        start = []
+        count = []
+
+        def new_node() -> int:
+            bounds.append(None)
+            left.append(-1)
+            right.append(-1)
+            start.append(0)
+            count.append(0)
+            return len(count) - 1
+
+        if number_of_items == 0:
+            node = new_node()
+            bounds[node] = np.zeros(6)
+        else:
+            stack = [(new_node(), 0, number_of_items)]
+            while stack:
+                node, first, last = stack.pop()
+                segment = self.indices[first:last]
+                node_min = minimums[segment].min(axis=0)
+                node_max = maximums[segment].max(axis=0)
+                bounds[node] = np.concatenate((node_min, node_max))
+                split = self._find_split(segment=segment, centroids=centroids, minimums=minimums, maximums=maximums, node_min=node_min, node_max=node_max)
+                if split is None:
+                    start[node] = first
+                    count[node] = last - first
+                    continue
+                axis, position = split
+                below = centroids[segment, axis] < position
+                number_below = int(below.sum())
+                if number_below == 0 or number_below == len(segment):
+                    # All centroids landed on one side, fall back to a median split
+                    order = np.argsort(centroids[segment, axis], kind='stable')
+                    self.indices[first:last] = segment[order]
+                    number_below = len(segment) // 2
+                else:
+                    self.indices[first:last] = np.concatenate((segment[below], segment[~below]))
+                left_node = new_node()
+                right_node = new_node()
+                left[node] = left_node
+                right[node] = right_node
+                stack.append((right_node, first + number_below, last))
+                stack.append((left_node, first, first + number_below))
+
+        self.node_bounds = np.array(bounds, dtype=np.float64).reshape(-1, 6)
+        self.node_left = np.array(left, dtype=np.int64)
+        self.node_right = np.array(right, dtype=np.int64)
+        self.node_start = np.array(start, dtype=np.int64)
+        self.node_count = np.array(count, dtype=np.int64)
+
+    def _find_split(self, segment: np.ndarray, centroids: np.ndarray, minimums: np.ndarray, maximums: np.ndarray, node_min: np.ndarray, node_max: np.ndarray):
+        number_of_items = len(segment)
+        if number_of_items <= self.leaf_size:
+            return None
+
+        segment_centroids = centroids[segment]
+        centroid_min = segment_centroids.min(axis=0)
+        centroid_max = segment_centroids.max(axis=0)
+        extent = centroid_max - centroid_min
+        axis = int(np.argmax(extent))
+        if extent[axis] <= 0:
+            # Every centroid is identical, no split can separate them
+            if number_of_items <= self.max_leaf_size:
+                return None
+            return axis, centroid_min[axis]
+
+        bins = BVH.NUMBER_OF_BINS
+        bin_index = ((segment_centroids[:, axis] - centroid_min[axis]) * (bins / extent[axis])).astype(np.int64)
+        np.clip(bin_index, 0, bins - 1, out=bin_index)
+
+        bin_count = np.bincount(bin_index, minlength=bins)
+        bin_min = np.full((bins, 3), np.inf)
+        bin_max = np.full((bins, 3), -np.inf)
+        np.minimum.at(bin_min, bin_index, minimums[segment])
+        np.maximum.at(bin_max, bin_index, maximums[segment])
+
+        # Sweep from both sides to get the area and count either side of every bin boundary
+        left_count = np.cumsum(bin_count)[:-1]
+        right_count = np.cumsum(bin_count[::-1])[::-1][1:]
+        left_area = BVH._surface_areas(np.minimum.accumulate(bin_min, axis=0), np.maximum.accumulate(bin_max, axis=0))[:-1]
+        right_area = BVH._surface_areas(np.minimum.accumulate(bin_min[::-1], axis=0)[::-1], np.maximum.accumulate(bin_max[::-1], axis=0)[::-1])[1:]
+
+        parent_area = BVH._surface_areas(node_min[np.newaxis], node_max[np.newaxis])[0]
+        cost = left_count * left_area + right_count * right_area
+        cost[(left_count == 0) | (right_count == 0)] = np.inf
+        best = int(np.argmin(cost))
+        if not math.isfinite(cost[best]):
+            return None if number_of_items <= self.max_leaf_size else (axis, centroid_min[axis] + extent[axis] * 0.5)
+
+        split_cost = BVH.TRAVERSAL_COST + BVH.INTERSECTION_COST * cost[best] / parent_area if parent_area > 0 else BVH.TRAVERSAL_COST
+        if split_cost >= BVH.INTERSECTION_COST * number_of_items and number_of_items <= self.max_leaf_size:
+            return None
+        return axis, centroid_min[axis] + extent[axis] * (best + 1) / bins
+
+    @staticmethod
+    def _surface_areas(minimums: np.ndarray, maximums: np.ndarray) -> np.ndarray:
+        extent = np.maximum(maximums - minimums, 0.0)
+        return 2.0 * (extent[:, 0] * extent[:, 1] + extent[:, 1] * extent[:, 2] + extent[:, 2] * extent[:, 0])
+
+    def _lists(self) -> tuple:
+        # Traversal runs in pure Python where indexing lists of floats is far cheaper than indexing numpy arrays.
+        # Built on the first traversal only, the packet and compiled paths read the arrays and never need them
+        if self._cached_lists is None:
+            self._cached_lists = ([tuple(b) for b in self.node_bounds.tolist()], self.node_left.tolist(), self.node_right.tolist(), self.node_start.tolist(), self.node_count.tolist())
+        return self._cached_lists
+
+    def __getstate__(self) -> dict:
+        # Workers rebuild the lists if they traverse in Python, no point pickling them next to the arrays
+        state = self.__dict__.copy()
+        state['_cached_lists'] = None
+        return state
+
+    def traverse(self, origin: tuple, inverse_direction: tuple, intersect_leaf, max_distance: float = math.inf):
+        """
+        Front-to-back closest hit traversal.
+
+        intersect_leaf(start, end, best_distance) is called for every leaf that
+        could still hold something closer than best_distance and must return
+        (distance, payload) or None. Returns the best (distance, payload) or None.
+        """
+        if not self.number_of_items:
+            return None
+        bounds, left, right, start, count = self._lists()
+
+        t_root = slab_test(bounds[0], origin, inverse_direction, max_distance)
+        if t_root is None:
+            return None
+
+        best = None
+        best_distance = max_distance
+        stack = [(t_root, 0)]
+        while stack:
+            t_near, node = stack.pop()
+            if t_near >= best_distance:
+                continue
+            if count[node]:
+                result = intersect_leaf(start[node], start[node] + count[node], best_distance)
+                if result is not None and result[0] < best_distance:
+                    best_distance = result[0]
+                    best = result
+                continue
+            t_left = slab_test(bounds[left[node]], origin, inverse_direction, best_distance)
+            t_right = slab_test(bounds[right[node]], origin, inverse_direction, best_distance)
+            if t_left is not None and t_right is not None:
+                # Push the farther child first so the nearer one is popped next
+                if t_left <= t_right:
+                    stack.append((t_right, right[node]))
+                    stack.append((t_left, left[node]))
+                else:
+                    stack.append((t_left, left[node]))
+                    stack.append((t_right, right[node]))
+            elif t_left is not None:
+                stack.append((t_left, left[node]))
+            elif t_right is not None:
+                stack.append((t_right, right[node]))
+        return best
+
+    def any_hit(self, origin: tuple, inverse_direction: tuple, intersect_leaf, max_distance: float = math.inf):
+        """
+        Occlusion traversal: stops at the first leaf for which
+        intersect_leaf(start, end, max_distance) returns something other than None,
+        and returns that value. No ordering is needed since any blocker will do.
+        """
+        if not self.number_of_items:
+            return None
+        bounds, left, right, start, count = self._lists()
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if slab_test(bounds[node], origin, inverse_direction, max_distance) is None:
+                continue
+            if count[node]:
+                result = intersect_leaf(start[node], start[node] + count[node], max_distance)
+                if result is not None:
+                    return result
+                continue
+            stack.append(right[node])
+            stack.append(left[node])
+        return None
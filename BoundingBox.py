@@ -0,0 +1,74 @@
+import math
+
+
+class BoundingBox:
+    """
+    Axis aligned bounding box stored as plain float tuples so the slab test
+    does not have to allocate Q_Vector3d objects.
+    """
+
+    PADDING = 1e-6
+
+    def __init__(self, minimum: tuple, maximum: tuple):
+        # Pad flat boxes (planes, axis aligned triangles) so they still have volume for the slab test
+        self.minimum = tuple(float(min(lo, hi)) - (BoundingBox.PADDING if lo == hi else 0.0) for lo, hi in zip(minimum, maximum))
+        self.maximum = tuple(float(max(lo, hi)) + (BoundingBox.PADDING if lo == hi else 0.0) for lo, hi in zip(minimum, maximum))
+
+    @staticmethod
+    def from_points(points) -> 'BoundingBox':
+        points = list(points)
+        return BoundingBox(minimum=(min(p.x for p in points), min(p.y for p in points), min(p.z for p in points)),
+                           maximum=(max(p.x for p in points), max(p.y for p in points), max(p.z for p in points)))
+
+    def union(self, other: 'BoundingBox') -> 'BoundingBox':
+        return BoundingBox(minimum=tuple(min(a, b) for a, b in zip(self.minimum, other.minimum)),
+                           maximum=tuple(max(a, b) for a, b in zip(self.maximum, other.maximum)))
+
+    @property
+    def centroid(self) -> tuple:
+        return tuple((lo + hi) * 0.5 for lo, hi in zip(self.minimum, self.maximum))
+
+    @property
+    def surface_area(self) -> float:
+        dx, dy, dz = (hi - lo for lo, hi in zip(self.minimum, self.maximum))
+        return 2.0 * (dx * dy + dy * dz + dz * dx)
+
+    def intersect(self, origin: tuple, inverse_direction: tuple, max_distance: float = math.inf) -> float:
+        """
+        Slab test. Returns the entry distance (clamped to 0) or None on a miss.
+        """
+        return slab_test(self.minimum + self.maximum, origin, inverse_direction, max_distance)
+
+
+def inverse_direction(direction) -> tuple:
+    # 1 / 0 would raise, so an axis the ray does not move along gets an infinite (signed) slope
+    return tuple(1.0 / d if d != 0 else math.copysign(math.inf, d) for d in (direction.x, direction.y, direction.z))
+
+
+def slab_test(bounds: tuple, origin: tuple, inverse_direction: tuple, max_distance: float = math.inf) -> float:
+    """
+    bounds is (min_x, min_y, min_z, max_x, max_y, max_z).
+    """
+    t_near = 0.0
+    t_far = max_distance
+    for axis in range(3):
+        o = origin[axis]
+        inv = inverse_direction[axis]
+        lo = bounds[axis]
+        hi = bounds[axis + 3]
+        if math.isinf(inv):
+            # Parallel to this slab, so the origin must already lie between the planes
+            if o < lo or o > hi:
+                return None
+            continue
+        t1 = (lo - o) * inv
+        t2 = (hi - o) * inv
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+        if t2 < t_far:
+            t_far = t2
+        if t_near > t_far:
+            return None
+    return t_near
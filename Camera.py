@@ -0,0 +1,173 @@
+import math
+import random
+
+import numpy as np
+
+from QFunctions.Q_Functions import Q_Vector3d
+from Ray import Ray
+
+
+class Camera:
+    """
+    Pinhole camera, or a thin lens one when aperture > 0.
+
+    Screen coordinates follow the original renderer: x runs over [-1, 1] across
+    the image and y over [-1 / aspect, 1 / aspect], and anti aliasing offsets are
+    given in the same units. Without look_at the image plane is the old
+    hardcoded one, z = 0 centred on the origin, so existing scenes render
+    unchanged. With look_at the plane sits focus_distance in front of the
+    camera and spans the horizontal field of view fov (degrees).
+
+    For each image size the screen coordinates of every row and column are
+    worked out once, so a primary ray is the plane centre plus a column and a row
+    increment of the basis, looked up by pixel index. The packet renderer gets
+    the full (height, width, 3) grid of plane points and unit directions.
+    """
+
+    def __init__(self, position: Q_Vector3d, look_at: Q_Vector3d = None, up: Q_Vector3d = Q_Vector3d(0, 1, 0), fov: float = 90.0, aspect: float = None, aperture: float = 0.0, focus_distance: float = None, seed: int = 0):
+        self.position = position
+        self.look_at = look_at
+        self.up = up
+        self.fov = fov
+        self.aspect = aspect
+        self.aperture = aperture
+        self.focus_distance = focus_distance
+        self._lens_random = random.Random(seed)
+        self._update()
+
+    def set(self, **kwargs) -> 'Camera':
+        # Change any of the constructor arguments, e.g. to move the camera between frames
+        for name, value in kwargs.items():
+            if name not in ('position', 'look_at', 'up', 'fov', 'aspect', 'aperture', 'focus_distance'):
+                raise AttributeError(f'Camera has no setting {name!r}')
+            setattr(self, name, value)
+        self._update()
+        return self
+
+    def _update(self) -> None:
+        position = np.array(self.position.to_tuple(), dtype=np.float64)
+        if self.look_at is None:
+            # The original mapping: the z = 0 plane, one unit to either side of the origin
+            self._centre = np.zeros(3)
+            self._right = np.array([1.0, 0.0, 0.0])
+            self._up = np.array([0.0, 1.0, 0.0])
+            self._lens_right = self._right
+            self._lens_up = self._up
+        else:
+            forward = np.array(self.look_at.to_tuple(), dtype=np.float64) - position
+            distance = np.linalg.norm(forward)
+            if distance == 0:
+                raise ValueError('Camera look_at must differ from its position')
+            forward /= distance
+            right = np.cross(np.array(self.up.to_tuple(), dtype=np.float64), forward)
+            if np.linalg.norm(right) == 0:
+                raise ValueError('Camera up must not be parallel to the viewing direction')
+            right /= np.linalg.norm(right)
+            up = np.cross(forward, right)
+            focus_distance = self.focus_distance if self.focus_distance is not None else distance
+            half_width = focus_distance * math.tan(math.radians(self.fov) / 2)
+            self._centre = position + forward * focus_distance
+            self._right = right * half_width
+            self._up = up * half_width
+            self._lens_right = right
+            self._lens_up = up
+        self._position = position
+        self._origin = (float(position[0]), float(position[1]), float(position[2]))
+        self._right_tuple = tuple(self._right.tolist())
+        self._up_tuple = tuple(self._up.tolist())
+        self._grids = {}
+        self._screens = {}
+
+    def screen_coordinates(self, width: int, height: int) -> tuple:
+        # Screen x of every column and screen y of every row
+        aspect = self.aspect if self.aspect is not None else float(width) / float(height)
+        xs = np.arange(width, dtype=np.float64) / max(width - 1, 1) * 2.0 - 1.0
+        ys = (1.0 - np.arange(height, dtype=np.float64) / max(height - 1, 1) * 2.0) / aspect
+        return xs, ys
+
+    def screen(self, width: int, height: int) -> tuple:
+        """
+        Per-column and per-row offsets of the image plane from the camera position, as lists of
+        (x, y, z) tuples: the plane point of pixel (x, y) is position + columns[x] + rows[y].
+        Built on first use and kept until the camera changes.
+        """
+        key = (width, height)
+        if key not in self._screens:
+            xs, ys = self.screen_coordinates(width=width, height=height)
+            columns = self._centre - self._position + xs[:, np.newaxis] * self._right
+            rows = ys[:, np.newaxis] * self._up
+            self._screens[key] = ([tuple(column) for column in columns.tolist()], [tuple(row) for row in rows.tolist()])
+        return self._screens[key]
+
+    def grid(self, width: int, height: int) -> tuple:
+        """
+        (points, directions) of every pixel of a width x height image as (height, width, 3) arrays.
+        """
+        key = (width, height)
+        if key not in self._grids:
+            xs, ys = self.screen_coordinates(width=width, height=height)
+            points = self._centre + xs[np.newaxis, :, np.newaxis] * self._right + ys[:, np.newaxis, np.newaxis] * self._up
+            directions = points - self._position
+            directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+            self._grids[key] = (points, directions)
+        return self._grids[key]
+
+    def lens_origin(self, u: float, v: float) -> tuple:
+        # Point on the lens disc for two uniform numbers in [0, 1)
+        radius = 0.5 * self.aperture * math.sqrt(u)
+        theta = 2 * math.pi * v
+        lens_x, lens_y = radius * math.cos(theta), radius * math.sin(theta)
+        return tuple((self._position + self._lens_right * lens_x + self._lens_up * lens_y).tolist())
+
+    def primary_ray(self, x: int, y: int, width: int, height: int, offset: tuple = (0, 0)) -> Ray:
+        columns, rows = self._screens.get((width, height)) or self.screen(width=width, height=height)
+        c_x, c_y, c_z = columns[x]
+        w_x, w_y, w_z = rows[y]
+        d_x = c_x + w_x
+        d_y = c_y + w_y
+        d_z = c_z + w_z
+        dx, dy = offset
+        if dx != 0 or dy != 0:
+            r_x, r_y, r_z = self._right_tuple
+            u_x, u_y, u_z = self._up_tuple
+            d_x += r_x * dx + u_x * dy
+            d_y += r_y * dx + u_y * dy
+            d_z += r_z * dx + u_z * dy
+        if self.aperture > 0:
+            # Aim from a point on the lens at the same spot on the focal plane
+            o_x, o_y, o_z = self.lens_origin(u=self._lens_random.random(), v=self._lens_random.random())
+            p_x, p_y, p_z = self._origin
+            d_x += p_x - o_x
+            d_y += p_y - o_y
+            d_z += p_z - o_z
+            origin = Q_Vector3d(o_x, o_y, o_z)
+        else:
+            origin = self.position
+        scale = 1.0 / math.sqrt(d_x * d_x + d_y * d_y + d_z * d_z)
+        return Ray(origin=origin, direction=Q_Vector3d(d_x * scale, d_y * scale, d_z * scale))
+
+    def rays(self, width: int, height: int, xs: np.ndarray, ys: np.ndarray, offsets: np.ndarray = None) -> tuple:
+        """
+        (origins, directions) as (N, 3) arrays for pixels (xs[i], ys[i]), each shifted by offsets[i] in screen units.
+        """
+        points, directions = self.grid(width=width, height=height)
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        if (offsets is None or not np.any(offsets)) and self.aperture == 0:
+            return np.broadcast_to(self._position, (len(xs), 3)).copy(), directions[ys, xs]
+        points = points[ys, xs]
+        if offsets is not None:
+            offsets = np.asarray(offsets, dtype=np.float64)
+            points = points + offsets[:, :1] * self._right + offsets[:, 1:2] * self._up
+        origins = np.broadcast_to(self._position, points.shape).copy()
+        if self.aperture > 0:
+            origins = np.array([self.lens_origin(u=self._lens_random.random(), v=self._lens_random.random()) for _ in range(len(points))]).reshape(-1, 3)
+        directions = points - origins
+        return origins, directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+    def __getstate__(self) -> dict:
+        # The grids are rebuilt on demand, no point pickling them over to the workers
+        state = self.__dict__.copy()
+        state['_grids'] = {}
+        state['_screens'] = {}
+        return state
@@ -1,6 +1,9 @@
 import math
 
+from BoundingBox import BoundingBox
 from Hit import Hit
+from LightRegistry import sample_faces
+from Material import Material
 from Primitive import Primitive
 from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
@@ -20,8 +23,13 @@ class CubePrimitive(Primitive):
     front_bottom_left
     (x1, y1, z1)
     """
-    def __init__(self, front_bottom_left: Q_Vector3d, rear_top_right: Q_Vector3d, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
-        Primitive.__init__(self, position=(rear_top_right + front_bottom_left) * (1 / 2), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
+
+    EPSILON = 0.000000001
+
+    def __init__(self, front_bottom_left: Q_Vector3d, rear_top_right: Q_Vector3d, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), rotation: tuple = None, material: Material = None):
+        Primitive.__init__(self, position=(rear_top_right + front_bottom_left) * (1 / 2), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission, material=material)
+        self.front_bottom_left = front_bottom_left
+        self.rear_top_right = rear_top_right
         front = Q_Vector3d(0, 0, front_bottom_left.z)
         bottom = Q_Vector3d(0, front_bottom_left.y, 0)
         left = Q_Vector3d(front_bottom_left.x, 0, 0)
@@ -31,45 +39,148 @@ class CubePrimitive(Primitive):
 
         self.faces = (
             # front face
-            TrianglePrimitive((front_bottom_left, front + top + left, front + top + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front_bottom_left, front + bottom + right, front + top + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
+            TrianglePrimitive((front_bottom_left, front + top + left, front + top + right), material=self.material),
+            TrianglePrimitive((front_bottom_left, front + bottom + right, front + top + right), material=self.material),
             # top face
 
-            TrianglePrimitive((front + top + left, rear + top + left, rear_top_right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front + top + left, front + top + right, rear_top_right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
+            TrianglePrimitive((front + top + left, rear + top + left, rear_top_right), material=self.material),
+            TrianglePrimitive((front + top + left, front + top + right, rear_top_right), material=self.material),
 
             # bottom face
-            TrianglePrimitive((front_bottom_left, front + bottom + right, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front_bottom_left, rear + bottom + left, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
+            TrianglePrimitive((front_bottom_left, front + bottom + right, rear + bottom + right), material=self.material),
+            TrianglePrimitive((front_bottom_left, rear + bottom + left, rear + bottom + right), material=self.material),
 
             # rear face
-            TrianglePrimitive((rear + top + left, rear_top_right, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((rear + top + left, rear + bottom + left, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
+            TrianglePrimitive((rear + top + left, rear_top_right, rear + bottom + right), material=self.material),
+            TrianglePrimitive((rear + top + left, rear + bottom + left, rear + bottom + right), material=self.material),
 
             # left face
-            TrianglePrimitive((front_bottom_left, rear + bottom + left, rear + top + left), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front_bottom_left, front + top + left, rear + top + left), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
+            TrianglePrimitive((front_bottom_left, rear + bottom + left, rear + top + left), material=self.material),
+            TrianglePrimitive((front_bottom_left, front + top + left, rear + top + left), material=self.material),
 
             # right face
-            TrianglePrimitive((front + top + right, rear_top_right, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front + top + right, front + bottom + right, rear + bottom + right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
+            TrianglePrimitive((front + top + right, rear_top_right, rear + bottom + right), material=self.material),
+            TrianglePrimitive((front + top + right, front + bottom + right, rear + bottom + right), material=self.material)
         )
+        self._minimum = tuple(min(a, b) for a, b in zip(front_bottom_left.to_tuple(), rear_top_right.to_tuple()))
+        self._maximum = tuple(max(a, b) for a, b in zip(front_bottom_left.to_tuple(), rear_top_right.to_tuple()))
+
+        # A rotated box is no longer axis aligned, so it falls back to its triangles
+        self.rotation = None
+        self.angles = None
+        if rotation is not None and any(rotation):
+            self.angles = tuple(rotation)
+            self.rotation = CubePrimitive.rotation_matrix(angles=rotation)
+            self.faces = tuple(TrianglePrimitive(tuple(self._rotated(vertex) for vertex in face.vertices), material=self.material) for face in self.faces)
+        self._bounding_box = BoundingBox.from_points(vertex for face in self.faces for vertex in face.vertices)
+
+    @staticmethod
+    def rotation_matrix(angles: tuple) -> tuple:
+        # Rotation about x, then y, then z (radians), as three row tuples
+        cx, sx = math.cos(angles[0]), math.sin(angles[0])
+        cy, sy = math.cos(angles[1]), math.sin(angles[1])
+        cz, sz = math.cos(angles[2]), math.sin(angles[2])
+        return ((cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx),
+                (sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx),
+                (-sy, cy * sx, cy * cx))
+
+    def _rotated(self, vertex: Q_Vector3d) -> Q_Vector3d:
+        # Rotate about the centre of the box
+        x, y, z = vertex.x - self.position.x, vertex.y - self.position.y, vertex.z - self.position.z
+        return Q_Vector3d(*(row[0] * x + row[1] * y + row[2] * z for row in self.rotation)) + self.position
+
+    def contains(self, point: Q_Vector3d) -> bool:
+        x, y, z = point.x - self.position.x, point.y - self.position.y, point.z - self.position.z
+        if self.rotation is not None:
+            # Back into the box's own frame with the transpose of the rotation
+            x, y, z = (self.rotation[0][axis] * x + self.rotation[1][axis] * y + self.rotation[2][axis] * z for axis in range(3))
+        return all(math.fabs(offset) < (hi - lo) * 0.5 for offset, lo, hi in zip((x, y, z), self._minimum, self._maximum))
+
+    def _slab(self, ray: Ray) -> tuple:
+        # Returns (distance, axis of the face hit, is_inside) or None
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        t_near = -math.inf
+        t_far = math.inf
+        near_axis = far_axis = 0
+        for axis in range(3):
+            o = origin[axis]
+            lo = self._minimum[axis]
+            hi = self._maximum[axis]
+            if direction[axis] == 0:
+                if o < lo or o > hi:
+                    return None
+                continue
+            inverse = 1.0 / direction[axis]
+            t1 = (lo - o) * inverse
+            t2 = (hi - o) * inverse
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > t_near:
+                t_near, near_axis = t1, axis
+            if t2 < t_far:
+                t_far, far_axis = t2, axis
+            if t_near > t_far:
+                return None
+        if t_near > CubePrimitive.EPSILON:
+            return t_near, near_axis, False
+        if t_far > CubePrimitive.EPSILON:
+            # Started inside, so the hit is on the way out
+            return t_far, far_axis, True
+        return None
 
-    def intersect(self, ray: Ray) -> Hit:
-        # Call interct for all triangles in all faces
-        # Track objects and distances that have collissions
-        # Determine closest triangle
-        # Return this distance and that normal's triangle
-        num_intersections = 0
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        if self.rotation is None:
+            slab = self._slab(ray=ray)
+            if slab is None:
+                return None
+            distance, axis, inside = slab
+            normal = Primitive.AXIS_NORMALS[axis][(ray.direction.x, ray.direction.y, ray.direction.z)[axis] > 0]
+            if hit is None:
+                return Hit(distance=distance, normal_to_surface=normal, is_inside=inside, ray=ray)
+            return hit.set(distance=distance, normal_to_surface=normal, is_inside=inside, ray=ray)
+
+        # Find the closest face by distance alone and only build the Hit for that one
         min_distance = math.inf
-        normal_to_surface = None
+        nearest_face = None
         for triangle in self.faces:
-            hit = triangle.intersect(ray=ray)
-            if hit:
-                num_intersections += 1
-            if hit and hit.distance < min_distance:
-                min_distance = hit.distance
-                normal_to_surface = hit.normal_to_surface
-            if num_intersections > 1:
-                break
-        return Hit(distance=min_distance, normal_to_surface=normal_to_surface, is_inside=False)  # Need to update is_inside check
+            distance = triangle.hit_distance(ray=ray)
+            if distance < min_distance:
+                min_distance = distance
+                nearest_face = triangle
+        if nearest_face is None:
+            return None
+        hit = nearest_face.intersect(ray=ray, hit=hit)
+        hit.is_inside = self.contains(point=ray.origin)
+        return hit
+
+    def hit_distance(self, ray: Ray) -> float:
+        if self.rotation is None:
+            slab = self._slab(ray=ray)
+            return math.inf if slab is None else slab[0]
+        return min(triangle.hit_distance(ray=ray) for triangle in self.faces)
+
+    def occludes(self, ray: Ray, max_distance: float) -> bool:
+        if self.rotation is None:
+            return self.hit_distance(ray=ray) < max_distance
+        # Any face closer than max_distance is enough, no need to find the closest one
+        return any(triangle.hit_distance(ray=ray) < max_distance for triangle in self.faces)
+
+    def translate(self, offset: Q_Vector3d) -> None:
+        Primitive.translate(self, offset=offset)
+        self.front_bottom_left = self.front_bottom_left + offset
+        self.rear_top_right = self.rear_top_right + offset
+        for face in self.faces:
+            face.translate(offset=offset)
+        self._minimum = tuple(value + shift for value, shift in zip(self._minimum, offset.to_tuple()))
+        self._maximum = tuple(value + shift for value, shift in zip(self._maximum, offset.to_tuple()))
+        self._bounding_box = BoundingBox.from_points(vertex for face in self.faces for vertex in face.vertices)
+
+    def surface_area(self) -> float:
+        return sum(face.surface_area() for face in self.faces)
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        return sample_faces(faces=self.faces, u=u, v=v)
+
+    def bounding_box(self) -> BoundingBox:
+        return self._bounding_box
@@ -0,0 +1,86 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from TileScheduler import Tile
+
+FRAMEBUFFER_DTYPES = ('float64', 'float32')
+
+# Attachment made by this process, so a worker maps the buffer once and not once per tile. Only the
+# latest buffer is kept: renders hand out one buffer at a time, and each new one replaces the last
+_ATTACHED = {}
+
+
+class SharedFrameBuffer:
+    """
+    (height, width, 3) image living in a multiprocessing.shared_memory block.
+
+    The parent creates it; pickling only sends the block's name, so workers
+    attach to the same memory and write their tiles straight into it. Nothing
+    but the tile coordinates travels back through the pool.
+    """
+
+    def __init__(self, width: int, height: int, dtype: str = 'float64', name: str = None):
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        size = max(width * height * 3 * self.dtype.itemsize, 1)
+        if self.owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._memory = SharedFrameBuffer._attach_memory(name=name)
+        self.name = self._memory.name
+        self.array = np.ndarray((height, width, 3), dtype=self.dtype, buffer=self._memory.buf)
+        if self.owner:
+            self.array.fill(0)
+
+    @staticmethod
+    def _attach_memory(name: str) -> shared_memory.SharedMemory:
+        try:
+            return shared_memory.SharedMemory(name=name, create=False, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching also registers the block with the resource tracker,
+            # which then unlinks it (and warns) when this worker exits. Only the owner should.
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                return shared_memory.SharedMemory(name=name, create=False)
+            finally:
+                resource_tracker.register = register
+
+    @staticmethod
+    def attach(name: str, width: int, height: int, dtype: str) -> 'SharedFrameBuffer':
+        key = (name, width, height, dtype)
+        if key not in _ATTACHED:
+            # The owner has finished with (and unlinked) any earlier buffer, so release its mapping
+            for stale in list(_ATTACHED):
+                _ATTACHED.pop(stale).close()
+            _ATTACHED[key] = SharedFrameBuffer(width=width, height=height, dtype=dtype, name=name)
+        return _ATTACHED[key]
+
+    def __reduce__(self):
+        return (SharedFrameBuffer.attach, (self.name, self.width, self.height, self.dtype.name))
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    def write_tile(self, tile: Tile, pixels: np.ndarray) -> None:
+        self.array[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] = pixels
+
+    def to_array(self) -> np.ndarray:
+        return np.array(self.array)
+
+    def close(self) -> None:
+        # Drop the numpy view first, the block cannot be closed while it is exported
+        self.array = None
+        self._memory.close()
+        if self.owner:
+            self._memory.unlink()
+
+    def __enter__(self) -> 'SharedFrameBuffer':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -1,3 +1,31 @@
-from collections import namedtuple
+class Hit:
+    """
+    Intersection record. Slotted rather than a namedtuple so a primitive can
+    refill one record in place (see Primitive.intersect's hit argument), and
+    position is only worked out from ray and distance when somebody asks.
+    """
 
-Hit = namedtuple("Hit", ["position", "distance", "normal_to_surface", "is_inside"])
+    __slots__ = ('distance', 'normal_to_surface', 'is_inside', 'ray', '_position')
+
+    def __init__(self, distance: float = None, normal_to_surface=None, is_inside: bool = False, position=None, ray=None):
+        self.set(distance=distance, normal_to_surface=normal_to_surface, is_inside=is_inside, position=position, ray=ray)
+
+    def set(self, distance: float, normal_to_surface, is_inside: bool = False, position=None, ray=None) -> 'Hit':
+        self.distance = distance
+        self.normal_to_surface = normal_to_surface
+        self.is_inside = is_inside
+        self.ray = ray
+        self._position = position
+        return self
+
+    @property
+    def position(self):
+        if self._position is None and self.ray is not None:
+            self._position = self.ray.position_at_distance(self.distance)
+        return self._position
+
+    def copy(self) -> 'Hit':
+        return Hit(distance=self.distance, normal_to_surface=self.normal_to_surface, is_inside=self.is_inside, position=self._position, ray=self.ray)
+
+    def __repr__(self) -> str:
+        return f'Hit(distance={self.distance}, normal_to_surface={self.normal_to_surface}, is_inside={self.is_inside})'
@@ -0,0 +1,212 @@
+"""
+Image files written as the render produces them.
+
+An ImageWriter takes tiles (or bands of whole rows) in any order. pfm and exr
+rows have a fixed place in the file, so each row is written there as soon as
+it is complete; ppm and png are written front to back, so they take every run
+of finished rows from the top of the image once it is complete. Rows that are
+not written yet are copied into the writer, unless it is given the array the
+tiles land in anyway (a render's framebuffer) as source, in which case it only
+counts pixels and reads finished rows back from there, and needs no memory of
+its own whatever order the tiles come in. Nothing beyond numpy, zlib and
+struct is needed:
+
+    ppm  binary P6, 8 bits per channel
+    png  RGB, 16 bits per channel (or 8), deflated one band at a time
+    pfm  32 bit float, linear and unclamped
+    exr  OpenEXR, uncompressed 32 bit float scanlines, linear and unclamped
+
+ppm and png clamp to [0, 1]; pfm and exr keep the values as rendered.
+"""
+
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from TileScheduler import Tile
+
+IMAGE_FORMATS = ('ppm', 'png', 'pfm', 'exr')
+
+# Colour stops of the samples heatmap, dark to bright (an approximation of matplotlib's inferno)
+HEATMAP_STOPS = np.array([[0.0, 0.0, 0.02], [0.34, 0.06, 0.43], [0.73, 0.21, 0.33], [0.98, 0.55, 0.04], [0.99, 1.0, 0.64]])
+
+
+def image_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension not in IMAGE_FORMATS:
+        raise ValueError(f'Cannot tell the image format of {path!r}, expected an extension of {", ".join(IMAGE_FORMATS)}')
+    return extension
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def _exr_attribute(name: str, kind: str, value: bytes) -> bytes:
+    return name.encode('ascii') + b'\x00' + kind.encode('ascii') + b'\x00' + struct.pack('<i', len(value)) + value
+
+
+class ImageWriter:
+
+    # Formats whose rows can be written in any order, each at its own offset
+    RANDOM_ACCESS_FORMATS = ('pfm', 'exr')
+
+    def __init__(self, path: str, width: int, height: int, bit_depth: int = 16, source: np.ndarray = None):
+        # source, when given, is the (height, width, 3) image the tiles are already in when write_tile is called
+        if bit_depth not in (8, 16):
+            raise ValueError(f'PNG bit depth must be 8 or 16, not {bit_depth}')
+        self.path = path
+        self.width = width
+        self.height = height
+        self.format = image_format(path)
+        self.bit_depth = bit_depth
+        self._source = source
+        # Rows received so far but not written (only without a source), and how many pixels of each row have arrived
+        self._pending = {}
+        self._filled = np.zeros(height, dtype=np.int64)
+        # First row not written yet for ppm and png, and how many rows have been written in all
+        self._next_row = 0
+        self.rows_written = 0
+        self._file = open(path, 'wb')
+        getattr(self, f'_start_{self.format}')()
+
+    def write_tile(self, tile: Tile, pixels: np.ndarray) -> None:
+        # pixels is the (tile.height, tile.width, 3) block of the image at tile, ignored with a source
+        for row, y in enumerate(range(tile.y, tile.y + tile.height)):
+            if self._source is None:
+                if y not in self._pending:
+                    self._pending[y] = np.zeros((self.width, 3), dtype=np.float64)
+                self._pending[y][tile.x:tile.x + tile.width] = pixels[row]
+            self._filled[y] += tile.width
+        write = getattr(self, f'_write_{self.format}')
+        if self.format in ImageWriter.RANDOM_ACCESS_FORMATS:
+            for y in range(tile.y, tile.y + tile.height):
+                if self._filled[y] >= self.width:
+                    write(y, self._take_rows(start=y, end=y + 1))
+            return
+        end = self._next_row
+        while end < self.height and self._filled[end] >= self.width:
+            end += 1
+        if end > self._next_row:
+            write(self._next_row, self._take_rows(start=self._next_row, end=end))
+            self._next_row = end
+
+    def _take_rows(self, start: int, end: int) -> np.ndarray:
+        self.rows_written += end - start
+        if self._source is not None:
+            return np.asarray(self._source[start:end])
+        return np.stack([self._pending.pop(y) for y in range(start, end)])
+
+    def write_rows(self, y: int, rows: np.ndarray) -> None:
+        self.write_tile(tile=Tile(x=0, y=y, width=self.width, height=len(rows)), pixels=rows)
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self.rows_written < self.height:
+            self._file.close()
+            self._file = None
+            raise ValueError(f'{self.path} closed with only {self.rows_written} of {self.height} rows complete')
+        getattr(self, f'_finish_{self.format}')()
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> 'ImageWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _start_ppm(self) -> None:
+        self._file.write(f'P6\n{self.width} {self.height}\n255\n'.encode('ascii'))
+
+    def _write_ppm(self, y: int, rows: np.ndarray) -> None:
+        self._file.write((np.clip(rows, 0, 1) * 255 + 0.5).astype(np.uint8).tobytes())
+
+    def _finish_ppm(self) -> None:
+        pass
+
+    def _start_png(self) -> None:
+        self._file.write(b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, self.bit_depth, 2, 0, 0, 0)))
+        self._compressor = zlib.compressobj(6)
+
+    def _write_png(self, y: int, rows: np.ndarray) -> None:
+        scale = (1 << self.bit_depth) - 1
+        values = (np.clip(rows, 0, 1) * scale + 0.5).astype('>u2' if self.bit_depth == 16 else np.uint8).reshape(len(rows), -1)
+        # Filter type 0 (none) in front of every scanline
+        scanlines = np.concatenate((np.zeros((len(rows), 1), dtype=np.uint8), values.view(np.uint8)), axis=1)
+        data = self._compressor.compress(scanlines.tobytes())
+        if data:
+            self._file.write(_png_chunk(b'IDAT', data))
+
+    def _finish_png(self) -> None:
+        self._file.write(_png_chunk(b'IDAT', self._compressor.flush()) + _png_chunk(b'IEND', b''))
+
+    def _start_pfm(self) -> None:
+        # PFM stores the bottom row first, so rows are written into place in a file sized up front
+        header = f'PF\n{self.width} {self.height}\n-1.0\n'.encode('ascii')
+        self._data_start = len(header)
+        self._file.write(header)
+        self._file.truncate(self._data_start + self.width * self.height * 12)
+
+    def _write_pfm(self, y: int, rows: np.ndarray) -> None:
+        for row_number, row in enumerate(rows.astype('<f4')):
+            self._file.seek(self._data_start + (self.height - 1 - (y + row_number)) * self.width * 12)
+            self._file.write(row.tobytes())
+
+    def _finish_pfm(self) -> None:
+        pass
+
+    def _start_exr(self) -> None:
+        # Channels in alphabetical order, each FLOAT (2), not linear, sampled every pixel
+        channels = b''.join(name + b'\x00' + struct.pack('<iB3xii', 2, 0, 1, 1) for name in (b'B', b'G', b'R')) + b'\x00'
+        window = struct.pack('<iiii', 0, 0, self.width - 1, self.height - 1)
+        header = (struct.pack('<ii', 20000630, 2)
+                  + _exr_attribute('channels', 'chlist', channels)
+                  + _exr_attribute('compression', 'compression', b'\x00')
+                  + _exr_attribute('dataWindow', 'box2i', window)
+                  + _exr_attribute('displayWindow', 'box2i', window)
+                  + _exr_attribute('lineOrder', 'lineOrder', b'\x00')
+                  + _exr_attribute('pixelAspectRatio', 'float', struct.pack('<f', 1.0))
+                  + _exr_attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0.0, 0.0))
+                  + _exr_attribute('screenWindowWidth', 'float', struct.pack('<f', 1.0))
+                  + b'\x00')
+        # One uncompressed scanline per block: y, byte count, then the B, G and R rows
+        # Rows are written into place in a file sized up front, as for pfm
+        self._line_size = 8 + self.width * 12
+        self._data_start = len(header) + 8 * self.height
+        offsets = self._data_start + np.arange(self.height, dtype='<u8') * self._line_size
+        self._file.write(header + offsets.tobytes())
+        self._file.truncate(self._data_start + self.height * self._line_size)
+
+    def _write_exr(self, y: int, rows: np.ndarray) -> None:
+        lines = np.empty((len(rows), self._line_size), dtype=np.uint8)
+        lines[:, 0:4] = np.arange(y, y + len(rows), dtype='<i4')[:, np.newaxis].view(np.uint8)
+        lines[:, 4:8] = np.frombuffer(struct.pack('<i', self.width * 12), dtype=np.uint8)
+        lines[:, 8:] = np.ascontiguousarray(rows[:, :, ::-1].transpose(0, 2, 1).astype('<f4')).reshape(len(rows), -1).view(np.uint8)
+        self._file.seek(self._data_start + y * self._line_size)
+        self._file.write(lines.tobytes())
+
+    def _finish_exr(self) -> None:
+        pass
+
+
+def write_image(path: str, image: np.ndarray, bit_depth: int = 16, band: int = 64) -> None:
+    # A whole (height, width, 3) image, encoded band by band so only one band is ever converted at a time
+    height, width = image.shape[:2]
+    with ImageWriter(path=path, width=width, height=height, bit_depth=bit_depth, source=image) as writer:
+        for y in range(0, height, band):
+            writer.write_rows(y=y, rows=image[y:y + band])
+
+
+def heatmap(values: np.ndarray) -> np.ndarray:
+    # (height, width) values to (height, width, 3) colours along HEATMAP_STOPS, zero to max(values, 1)
+    scaled = np.clip(values / max(float(np.max(values)), 1.0), 0, 1) * (len(HEATMAP_STOPS) - 1)
+    positions = np.arange(len(HEATMAP_STOPS))
+    return np.stack([np.interp(scaled, positions, HEATMAP_STOPS[:, channel]) for channel in range(3)], axis=-1)
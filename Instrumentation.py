@@ -0,0 +1,161 @@
+"""
+Optional counters and stage timers for the scalar renderer.
+
+Inside a with block an Instrumentation swaps the hot methods of one scene (and
+the intersection tests of every primitive class) for wrappers that count and
+time their calls, and puts the originals back on the way out. Nothing is
+wrapped otherwise, so a render without instrumentation runs exactly the code
+it always did.
+
+Everything measured goes into one flat dict of numbers, so the statistics of
+many tiles and workers add up key by key:
+
+    rays.primary, rays.reflection, rays.shadow   rays traced, by type
+    hits, misses                                 closest hit queries that found something or not
+    shadow_misses                                shadow rays that were blocked or reached no light
+    tests.<class>                                intersection tests against each primitive class
+    seconds.<stage>                              time spent in each stage, excluding nested stages
+    seconds.tile                                 time spent in the block as a whole
+
+Stage times are exclusive: calculate_lighting's time does not include the
+shadow rays it casts, which count under shadow. Whatever is left of the tile
+time once every stage is taken away is the interpreter overhead of the loops
+around them. Packet rendering goes through PacketRenderer rather than these
+methods, so only its tile time is recorded.
+"""
+
+import collections
+import os
+import time
+
+from OrthoNormalBasis import OrthoNormalBasis
+from Primitive import Primitive
+
+STAGES = ('camera', 'trace', 'intersection', 'shading', 'shadow', 'cone_sample')
+INTERSECTION_TESTS = ('intersect', 'hit_distance', 'occludes')
+
+
+def _subclasses(cls: type) -> list:
+    return [subclass for child in cls.__subclasses__() for subclass in (child, *_subclasses(child))]
+
+
+class Instrumentation:
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.statistics = collections.Counter(dict.fromkeys(('rays.primary', 'rays.shadow', 'hits', 'misses', 'shadow_misses', 'seconds.tile'), 0))
+        # [stage, time it last started or resumed] of the stages running, innermost last
+        self._running = []
+        self._restore = []
+
+    def __enter__(self) -> 'Instrumentation':
+        scene = self.scene
+        self._wrap_instance(scene, 'trace_ray', 'trace', self._count_trace)
+        self._wrap_instance(scene, 'nearest_intersection', 'intersection', self._count_intersection)
+        self._wrap_instance(scene, 'visible_emitter', 'shadow', self._count_shadow)
+        self._wrap_instance(scene, 'calculate_lighting', 'shading')
+        self._wrap_instance(scene.camera, 'primary_ray', 'camera')
+        original = OrthoNormalBasis.__dict__['cone_samples']
+        OrthoNormalBasis.cone_samples = staticmethod(self._timed('cone_sample', original.__func__))
+        self._restore.append(lambda: setattr(OrthoNormalBasis, 'cone_samples', original))
+        # Only methods a class defines itself, so an inherited test that calls another is counted once
+        for cls in _subclasses(Primitive):
+            for name in INTERSECTION_TESTS:
+                if name in cls.__dict__:
+                    self._wrap_class(cls, name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.statistics['seconds.tile'] += time.perf_counter() - self._start
+        for restore in reversed(self._restore):
+            restore()
+        self._restore = []
+
+    def _timed(self, stage: str, function, count=None):
+        running = self._running
+        statistics = self.statistics
+        key = f'seconds.{stage}'
+
+        def timed(*args, **kwargs):
+            now = time.perf_counter()
+            if running:
+                statistics[f'seconds.{running[-1][0]}'] += now - running[-1][1]
+            running.append([stage, now])
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                now = time.perf_counter()
+                statistics[key] += now - running.pop()[1]
+                if running:
+                    running[-1][1] = now
+            if count is not None:
+                count(result)
+            return result
+        return timed
+
+    def _wrap_instance(self, instance, name: str, stage: str, count=None) -> None:
+        # An instance attribute shadows the class's method until it is deleted again
+        setattr(instance, name, self._timed(stage, getattr(instance, name), count))
+        self._restore.append(lambda: delattr(instance, name))
+
+    def _wrap_class(self, cls: type, name: str) -> None:
+        original = cls.__dict__[name]
+        statistics = self.statistics
+        key = f'tests.{cls.__name__}'
+
+        def counted(*args, **kwargs):
+            statistics[key] += 1
+            return original(*args, **kwargs)
+        setattr(cls, name, counted)
+        self._restore.append(lambda: setattr(cls, name, original))
+
+    def _count_trace(self, result) -> None:
+        self.statistics['rays.primary'] += 1
+
+    def _count_intersection(self, result) -> None:
+        self.statistics['hits' if result[0] is not None else 'misses'] += 1
+
+    def _count_shadow(self, result) -> None:
+        self.statistics['rays.shadow'] += 1
+        if result is None:
+            self.statistics['shadow_misses'] += 1
+
+    def result(self) -> dict:
+        # The statistics as a plain dict, tagged with the process that gathered them
+        statistics = dict(self.statistics)
+        # Every closest hit query after the first of a path follows a reflection
+        statistics['rays.reflection'] = statistics.get('hits', 0) + statistics.get('misses', 0) - statistics.get('rays.primary', 0)
+        statistics['worker'] = os.getpid()
+        return statistics
+
+
+def merge_statistics(results: list) -> dict:
+    # Sum the result() of many blocks, in total and per worker process: {'total': {...}, 'workers': {pid: {...}}}
+    total = collections.Counter()
+    workers = collections.defaultdict(collections.Counter)
+    for result in results:
+        statistics = {key: value for key, value in result.items() if key != 'worker'}
+        total.update(statistics)
+        workers[result['worker']].update(statistics)
+    return {'total': dict(total), 'workers': {worker: dict(statistics) for worker, statistics in workers.items()}}
+
+
+def _stage_times(statistics: dict) -> list:
+    stages = [(stage, statistics.get(f'seconds.{stage}', 0.0)) for stage in STAGES]
+    return stages + [('other', statistics.get('seconds.tile', 0.0) - sum(seconds for _, seconds in stages))]
+
+
+def format_statistics(merged: dict, wall_time: float) -> list:
+    # Report lines for the merge_statistics of a render that took wall_time seconds
+    statistics = merged['total']
+    rays = {kind: statistics.get(f'rays.{kind}', 0) for kind in ('primary', 'reflection', 'shadow')}
+    lines = [f'Rays: {", ".join(f"{count} {kind}" for kind, count in rays.items())}, {sum(rays.values()) / wall_time if wall_time > 0 else 0.0:.0f} rays/s overall.',
+             f'Closest hit queries: {statistics.get("hits", 0)} hits, {statistics.get("misses", 0)} misses. Shadow rays blocked or unlit: {statistics.get("shadow_misses", 0)}.']
+    tests = sorted((key[len('tests.'):], value) for key, value in statistics.items() if key.startswith('tests.'))
+    if tests:
+        lines.append(f'Intersection tests: {", ".join(f"{name} {count}" for name, count in tests)}.')
+    for name, entry in [('All workers', statistics)] + [(f'Worker {worker}', entry) for worker, entry in sorted(merged['workers'].items())]:
+        busy = entry.get('seconds.tile', 0.0)
+        lines.append(f'{name}: {busy:.2f}s busy, ' + ', '.join(f'{stage} {seconds / busy if busy > 0 else 0.0:.0%}' for stage, seconds in _stage_times(entry)) + '.')
+    return lines
@@ -0,0 +1,613 @@
+"""
+Compiled kernels for the scalar renderer's closest hit queries and shading.
+
+KernelScene flattens a scene into a few numpy arrays and answers
+Scene.nearest_intersection and Scene.calculate_lighting with the functions
+below, which are compiled by Numba (CPU only) when it is installed and are
+plain, much slower Python otherwise. Scene only uses them when its backend is
+'numba', and falls back to the Python objects when Numba is missing.
+
+    objects         (O, 4) int64    kind (see KERNEL_KINDS) and three kind specific integers:
+                                    triangles: first triangle, count
+                                    box: unused; rect: axis the rectangle is flat along
+                                    mesh: first triangle, count, first node of its BVH
+    params          (O, 6) float64  sphere centre and radius, box and rect minimum and maximum
+    triangles       (T, 12) float64 v0, e1, e2 and the unit face normal of every triangle
+    mesh_bounds     (N, 6) float64  mesh BVH nodes back to back, as BVH.node_bounds
+    mesh_nodes      (N, 4) int64    left, right, start, count, relative to the mesh
+    scene_bounds    (M, 6) float64  Scene.bvh over the objects, empty to test every object
+    scene_nodes     (M, 4) int64
+    scene_indices   (O,) int64      object of each leaf slot of Scene.bvh
+    stack_sizes     (2,) int64      traversal stack entries needed for Scene.bvh and for the deepest mesh BVH
+
+Every test uses the thresholds of the primitive it stands in for, so both
+backends find the same hits and shade them the same to within rounding.
+"""
+
+import math
+
+import numpy as np
+
+from CubePrimitive import CubePrimitive
+from Hit import Hit
+from MeshPrimitive import MeshPrimitive
+from PlanePrimitive import PlanePrimitive
+from QFunctions.Q_Functions import Q_Vector3d
+from SpherePrimitive import SpherePrimitive
+from TriangleMesh import TriangleMesh
+from TrianglePrimitive import TrianglePrimitive
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+KERNEL_BACKENDS = ('python', 'numba')
+KERNEL_KINDS = ('sphere', 'triangles', 'box', 'rect', 'mesh')
+SPHERE, TRIANGLES, BOX, RECT, MESH = range(len(KERNEL_KINDS))
+# The primitives' thresholds as plain module constants, which compiled code can read
+SPHERE_EPSILON = SpherePrimitive.EPSILON
+TRIANGLE_EPSILON = TriangleMesh.EPSILON
+BOX_EPSILON = CubePrimitive.EPSILON
+RECT_EPSILON = PlanePrimitive.EPSILON
+
+
+def jit(function):
+    # Compiled on first call and cached next to the module when Numba is installed, left as it is otherwise
+    return numba.njit(cache=True)(function) if numba is not None else function
+
+
+@jit
+def slab_distance(bounds, node, origin, inverse, max_distance):
+    # BoundingBox.slab_test on one row of an (N, 6) bounds array, -1.0 on a miss
+    t_near = 0.0
+    t_far = max_distance
+    for axis in range(3):
+        lo = bounds[node, axis]
+        hi = bounds[node, axis + 3]
+        if math.isinf(inverse[axis]):
+            if origin[axis] < lo or origin[axis] > hi:
+                return -1.0
+            continue
+        t1 = (lo - origin[axis]) * inverse[axis]
+        t2 = (hi - origin[axis]) * inverse[axis]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+        if t2 < t_far:
+            t_far = t2
+        if t_near > t_far:
+            return -1.0
+    return t_near
+
+
+@jit
+def sphere_distance(params, index, origin, direction):
+    op_x = params[index, 0] - origin[0]
+    op_y = params[index, 1] - origin[1]
+    op_z = params[index, 2] - origin[2]
+    b = op_x * direction[0] + op_y * direction[1] + op_z * direction[2]
+    determinant = b * b - (op_x * op_x + op_y * op_y + op_z * op_z) + params[index, 3] * params[index, 3]
+    if determinant < 0:
+        return math.inf
+    determinant = math.sqrt(determinant)
+    minus_t = b - determinant
+    plus_t = b + determinant
+    if minus_t < SPHERE_EPSILON and plus_t < SPHERE_EPSILON:
+        return math.inf
+    return minus_t if minus_t > SPHERE_EPSILON else plus_t
+
+
+@jit
+def triangle_distance(triangles, index, origin, direction):
+    # Moller-Trumbore, as TrianglePrimitive.hit_distance
+    e1_x, e1_y, e1_z = triangles[index, 3], triangles[index, 4], triangles[index, 5]
+    e2_x, e2_y, e2_z = triangles[index, 6], triangles[index, 7], triangles[index, 8]
+    d_x, d_y, d_z = direction
+    p_x = d_y * e2_z - d_z * e2_y
+    p_y = d_z * e2_x - d_x * e2_z
+    p_z = d_x * e2_y - d_y * e2_x
+    det = e1_x * p_x + e1_y * p_y + e1_z * p_z
+    if math.fabs(det) < TRIANGLE_EPSILON:
+        return math.inf
+    inv_det = 1.0 / det
+    t_x = origin[0] - triangles[index, 0]
+    t_y = origin[1] - triangles[index, 1]
+    t_z = origin[2] - triangles[index, 2]
+    u = (t_x * p_x + t_y * p_y + t_z * p_z) * inv_det
+    if u < 0.0 or u > 1.0:
+        return math.inf
+    q_x = t_y * e1_z - t_z * e1_y
+    q_y = t_z * e1_x - t_x * e1_z
+    q_z = t_x * e1_y - t_y * e1_x
+    v = (d_x * q_x + d_y * q_y + d_z * q_z) * inv_det
+    if v < 0.0 or (u + v) > 1.0:
+        return math.inf
+    t = (e2_x * q_x + e2_y * q_y + e2_z * q_z) * inv_det
+    if t < TRIANGLE_EPSILON:
+        return math.inf
+    return t
+
+
+@jit
+def box_distance(params, index, origin, direction):
+    # CubePrimitive._slab for an unrotated cube: (distance, axis of the face hit, is_inside), distance inf on a miss
+    t_near = -math.inf
+    t_far = math.inf
+    near_axis = 0
+    far_axis = 0
+    for axis in range(3):
+        lo = params[index, axis]
+        hi = params[index, axis + 3]
+        if direction[axis] == 0:
+            if origin[axis] < lo or origin[axis] > hi:
+                return math.inf, 0, False
+            continue
+        inverse = 1.0 / direction[axis]
+        t1 = (lo - origin[axis]) * inverse
+        t2 = (hi - origin[axis]) * inverse
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+            near_axis = axis
+        if t2 < t_far:
+            t_far = t2
+            far_axis = axis
+        if t_near > t_far:
+            return math.inf, 0, False
+    if t_near > BOX_EPSILON:
+        return t_near, near_axis, False
+    if t_far > BOX_EPSILON:
+        return t_far, far_axis, True
+    return math.inf, 0, False
+
+
+@jit
+def rect_distance(params, index, axis, origin, direction):
+    # PlanePrimitive._rect_distance for a rectangle lying in an axis plane
+    if direction[axis] == 0:
+        return math.inf
+    t = (params[index, axis] - origin[axis]) / direction[axis]
+    if t < RECT_EPSILON:
+        return math.inf
+    for other in range(3):
+        if other != axis:
+            p = origin[other] + direction[other] * t
+            if p < params[index, other] or p > params[index, other + 3]:
+                return math.inf
+    return t
+
+
+@jit
+def mesh_distance(triangles, first, mesh_bounds, mesh_nodes, node_offset, stack_size, origin, direction, inverse, max_distance):
+    # (distance, triangle) of the closest triangle of one mesh nearer than max_distance, front to back as BVH.traverse
+    best = max_distance
+    best_triangle = -1
+    t_root = slab_distance(mesh_bounds, node_offset, origin, inverse, max_distance)
+    if t_root < 0.0:
+        return math.inf, -1
+    stack_nodes = np.empty(stack_size, dtype=np.int64)
+    stack_distances = np.empty(stack_size, dtype=np.float64)
+    stack_nodes[0] = 0
+    stack_distances[0] = t_root
+    size = 1
+    while size:
+        size -= 1
+        node = stack_nodes[size]
+        if stack_distances[size] >= best:
+            continue
+        row = node_offset + node
+        if mesh_nodes[row, 3]:
+            start = first + mesh_nodes[row, 2]
+            for triangle in range(start, start + mesh_nodes[row, 3]):
+                t = triangle_distance(triangles, triangle, origin, direction)
+                if t < best:
+                    best = t
+                    best_triangle = triangle
+            continue
+        left = mesh_nodes[row, 0]
+        right = mesh_nodes[row, 1]
+        t_left = slab_distance(mesh_bounds, node_offset + left, origin, inverse, best)
+        t_right = slab_distance(mesh_bounds, node_offset + right, origin, inverse, best)
+        if t_left >= 0.0 and t_right >= 0.0:
+            # Farther child first so the nearer one is popped next
+            if t_left <= t_right:
+                stack_nodes[size], stack_distances[size] = right, t_right
+                stack_nodes[size + 1], stack_distances[size + 1] = left, t_left
+            else:
+                stack_nodes[size], stack_distances[size] = left, t_left
+                stack_nodes[size + 1], stack_distances[size + 1] = right, t_right
+            size += 2
+        elif t_left >= 0.0:
+            stack_nodes[size], stack_distances[size] = left, t_left
+            size += 1
+        elif t_right >= 0.0:
+            stack_nodes[size], stack_distances[size] = right, t_right
+            size += 1
+    if best_triangle < 0:
+        return math.inf, -1
+    return best, best_triangle
+
+
+@jit
+def object_distance(arrays, index, origin, direction, inverse, max_distance):
+    # (distance, element, is_inside) of one object: element is the triangle hit, or the axis of a box or rect face
+    objects, params, triangles, mesh_bounds, mesh_nodes = arrays[0], arrays[1], arrays[2], arrays[3], arrays[4]
+    kind = objects[index, 0]
+    if kind == SPHERE:
+        return sphere_distance(params, index, origin, direction), -1, False
+    if kind == BOX:
+        return box_distance(params, index, origin, direction)
+    if kind == RECT:
+        return rect_distance(params, index, objects[index, 1], origin, direction), objects[index, 1], False
+    if kind == MESH:
+        t, triangle = mesh_distance(triangles, objects[index, 1], mesh_bounds, mesh_nodes, objects[index, 3], arrays[8][1], origin, direction, inverse, max_distance)
+        return t, triangle, False
+    best = math.inf
+    best_triangle = -1
+    for triangle in range(objects[index, 1], objects[index, 1] + objects[index, 2]):
+        t = triangle_distance(triangles, triangle, origin, direction)
+        if t < best:
+            best = t
+            best_triangle = triangle
+    return best, best_triangle, False
+
+
+@jit
+def inverse_direction(direction):
+    # BoundingBox.inverse_direction
+    return (1.0 / direction[0] if direction[0] != 0 else math.copysign(math.inf, direction[0]),
+            1.0 / direction[1] if direction[1] != 0 else math.copysign(math.inf, direction[1]),
+            1.0 / direction[2] if direction[2] != 0 else math.copysign(math.inf, direction[2]))
+
+
+@jit
+def nearest(arrays, origin, direction, max_distance):
+    # (object, distance, element, is_inside) of the closest hit nearer than max_distance, object -1 on a miss
+    scene_bounds, scene_nodes, scene_indices = arrays[5], arrays[6], arrays[7]
+    inverse = inverse_direction(direction)
+    best = max_distance
+    best_object = -1
+    best_element = -1
+    best_inside = False
+    if len(scene_nodes) == 0:
+        for index in range(len(arrays[0])):
+            t, element, inside = object_distance(arrays, index, origin, direction, inverse, best)
+            if t < best:
+                best, best_object, best_element, best_inside = t, index, element, inside
+        return best_object, best, best_element, best_inside
+
+    t_root = slab_distance(scene_bounds, 0, origin, inverse, max_distance)
+    if t_root < 0.0:
+        return -1, best, -1, False
+    stack_size = arrays[8][0]
+    stack_nodes = np.empty(stack_size, dtype=np.int64)
+    stack_distances = np.empty(stack_size, dtype=np.float64)
+    stack_nodes[0] = 0
+    stack_distances[0] = t_root
+    size = 1
+    while size:
+        size -= 1
+        node = stack_nodes[size]
+        if stack_distances[size] >= best:
+            continue
+        if scene_nodes[node, 3]:
+            for slot in range(scene_nodes[node, 2], scene_nodes[node, 2] + scene_nodes[node, 3]):
+                index = scene_indices[slot]
+                t, element, inside = object_distance(arrays, index, origin, direction, inverse, best)
+                if t < best:
+                    best, best_object, best_element, best_inside = t, index, element, inside
+            continue
+        left = scene_nodes[node, 0]
+        right = scene_nodes[node, 1]
+        t_left = slab_distance(scene_bounds, left, origin, inverse, best)
+        t_right = slab_distance(scene_bounds, right, origin, inverse, best)
+        if t_left >= 0.0 and t_right >= 0.0:
+            if t_left <= t_right:
+                stack_nodes[size], stack_distances[size] = right, t_right
+                stack_nodes[size + 1], stack_distances[size + 1] = left, t_left
+            else:
+                stack_nodes[size], stack_distances[size] = left, t_left
+                stack_nodes[size + 1], stack_distances[size + 1] = right, t_right
+            size += 2
+        elif t_left >= 0.0:
+            stack_nodes[size], stack_distances[size] = left, t_left
+            size += 1
+        elif t_right >= 0.0:
+            stack_nodes[size], stack_distances[size] = right, t_right
+            size += 1
+    return best_object, best, best_element, best_inside
+
+
+@jit
+def mesh_occludes(triangles, first, mesh_bounds, mesh_nodes, node_offset, stack_size, origin, direction, inverse, max_distance):
+    # Whether any triangle of one mesh is nearer than max_distance, stopping at the first as BVH.any_hit
+    stack = np.empty(stack_size, dtype=np.int64)
+    stack[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        row = node_offset + stack[size]
+        if slab_distance(mesh_bounds, row, origin, inverse, max_distance) < 0.0:
+            continue
+        if mesh_nodes[row, 3]:
+            start = first + mesh_nodes[row, 2]
+            for triangle in range(start, start + mesh_nodes[row, 3]):
+                if triangle_distance(triangles, triangle, origin, direction) < max_distance:
+                    return True
+            continue
+        stack[size] = mesh_nodes[row, 1]
+        stack[size + 1] = mesh_nodes[row, 0]
+        size += 2
+    return False
+
+
+@jit
+def object_occludes(arrays, index, origin, direction, inverse, max_distance):
+    # Primitive.occludes: whether one object is hit nearer than max_distance
+    objects, triangles = arrays[0], arrays[2]
+    kind = objects[index, 0]
+    if kind == MESH:
+        return mesh_occludes(triangles, objects[index, 1], arrays[3], arrays[4], objects[index, 3], arrays[8][1], origin, direction, inverse, max_distance)
+    if kind == TRIANGLES:
+        for triangle in range(objects[index, 1], objects[index, 1] + objects[index, 2]):
+            if triangle_distance(triangles, triangle, origin, direction) < max_distance:
+                return True
+        return False
+    return object_distance(arrays, index, origin, direction, inverse, max_distance)[0] < max_distance
+
+
+@jit
+def occluded(arrays, emissive, origin, direction, max_distance):
+    # Scene.find_occluder: whether any non-emissive object is hit nearer than max_distance. Any blocker will do, so no ordering and an early exit
+    scene_bounds, scene_nodes, scene_indices = arrays[5], arrays[6], arrays[7]
+    inverse = inverse_direction(direction)
+    if len(scene_nodes) == 0:
+        for index in range(len(arrays[0])):
+            if not emissive[index] and object_occludes(arrays, index, origin, direction, inverse, max_distance):
+                return True
+        return False
+
+    stack = np.empty(arrays[8][0], dtype=np.int64)
+    stack[0] = 0
+    size = 1
+    while size:
+        size -= 1
+        node = stack[size]
+        if slab_distance(scene_bounds, node, origin, inverse, max_distance) < 0.0:
+            continue
+        if scene_nodes[node, 3]:
+            for slot in range(scene_nodes[node, 2], scene_nodes[node, 2] + scene_nodes[node, 3]):
+                index = scene_indices[slot]
+                if not emissive[index] and object_occludes(arrays, index, origin, direction, inverse, max_distance):
+                    return True
+            continue
+        stack[size] = scene_nodes[node, 1]
+        stack[size + 1] = scene_nodes[node, 0]
+        size += 2
+    return False
+
+
+@jit
+def visible_emitter(arrays, emissive, lights, origin, direction):
+    # Scene.visible_emitter: the emissive object the ray reaches first, or -1 when it misses them all or something blocks it
+    inverse = inverse_direction(direction)
+    light = -1
+    light_distance = math.inf
+    for index in lights:
+        t = object_distance(arrays, index, origin, direction, inverse, light_distance)[0]
+        if t < light_distance:
+            light = index
+            light_distance = t
+    if light < 0 or occluded(arrays, emissive, origin, direction, light_distance):
+        return -1
+    return light
+
+
+@jit
+def intersect(arrays, origin, direction):
+    # (object, distance, normal x, y, z, is_inside) of the closest hit, object -1 on a miss. Normals face the ray as the primitives' do
+    index, t, element, inside = nearest(arrays, origin, direction, math.inf)
+    if index < 0:
+        return -1, t, 0.0, 0.0, 0.0, False
+    objects, params, triangles = arrays[0], arrays[1], arrays[2]
+    kind = objects[index, 0]
+    if kind == SPHERE:
+        n_x = origin[0] + direction[0] * t - params[index, 0]
+        n_y = origin[1] + direction[1] * t - params[index, 1]
+        n_z = origin[2] + direction[2] * t - params[index, 2]
+        length = math.sqrt(n_x * n_x + n_y * n_y + n_z * n_z)
+        inside = (n_x * direction[0] + n_y * direction[1] + n_z * direction[2]) > 0
+        scale = (-1.0 if inside else 1.0) / length
+        return index, t, n_x * scale, n_y * scale, n_z * scale, inside
+    if kind == BOX or kind == RECT:
+        normal = [0.0, 0.0, 0.0]
+        normal[element] = -1.0 if direction[element] > 0 else 1.0
+        return index, t, normal[0], normal[1], normal[2], inside
+    n_x, n_y, n_z = triangles[element, 9], triangles[element, 10], triangles[element, 11]
+    if n_x * direction[0] + n_y * direction[1] + n_z * direction[2] > 0:
+        return index, t, -n_x, -n_y, -n_z, inside
+    return index, t, n_x, n_y, n_z, inside
+
+
+@jit
+def shade(arrays, shading, lights, index, origin, normal, to_camera, points, emitters, weights, cone_direction, cone_table, scale):
+    """
+    Scene.calculate_lighting for a hit on object index: Phong shading from every shadow ray that
+    reaches an emitter, of the emissive objects in lights. In 'lights' mode ray i is aimed at points[i]
+    and only counts if the emitter it reaches is emitters[i]; in 'cone' mode (cone_table not empty) the
+    rays are cone_table turned to cone_direction and any emitter counts. Returns the colour and the number of shadow rays.
+    """
+    ambient, diffuse, specular, shininess, emission, emissive = shading[0], shading[1], shading[2], shading[3], shading[4], shading[5]
+    n_x, n_y, n_z = normal
+    c_x, c_y, c_z = to_camera
+    exponent = shininess[index] / 4
+    cone = len(cone_table) > 0
+    x_x = x_y = x_z = y_x = y_y = y_z = z_x = z_y = z_z = 0.0
+    if cone:
+        # OrthoNormalBasis.fromZ around cone_direction
+        z_x, z_y, z_z = cone_direction
+        if math.fabs(z_x) > 0.9999:
+            x_x, x_y, x_z = z_z, 0.0, -z_x
+        else:
+            x_x, x_y, x_z = 0.0, -z_z, z_y
+        length = math.sqrt(x_x * x_x + x_y * x_y + x_z * x_z)
+        x_x, x_y, x_z = x_x / length, x_y / length, x_z / length
+        y_x, y_y, y_z = z_y * x_z - z_z * x_y, z_z * x_x - z_x * x_z, z_x * x_y - z_y * x_x
+        length = math.sqrt(y_x * y_x + y_y * y_y + y_z * y_z)
+        y_x, y_y, y_z = y_x / length, y_y / length, y_z / length
+    count = len(cone_table) if cone else len(points)
+    ambient_light = np.zeros(3)
+    diffuse_light = np.zeros(3)
+    specular_light = np.zeros(3)
+    for sample in range(count):
+        if cone:
+            a, b, c = cone_table[sample, 0], cone_table[sample, 1], cone_table[sample, 2]
+            d_x = x_x * a + y_x * b + z_x * c
+            d_y = x_y * a + y_y * b + z_y * c
+            d_z = x_z * a + y_z * b + z_z * c
+            emitter = -1
+            weight = 1.0
+        else:
+            d_x = points[sample, 0] - origin[0]
+            d_y = points[sample, 1] - origin[1]
+            d_z = points[sample, 2] - origin[2]
+            emitter = emitters[sample]
+            weight = weights[sample]
+        length = math.sqrt(d_x * d_x + d_y * d_y + d_z * d_z)
+        d_x, d_y, d_z = d_x / length, d_y / length, d_z / length
+
+        # Lit when the first emitter along the ray is the one it was aimed at and nothing blocks it
+        light = visible_emitter(arrays, emissive, lights, origin, (d_x, d_y, d_z))
+        if light < 0 or (emitter >= 0 and light != emitter):
+            continue
+        intensity = math.fabs(d_x * n_x + d_y * n_y + d_z * n_z)
+        h_x, h_y, h_z = d_x + c_x, d_y + c_y, d_z + c_z
+        length = math.sqrt(h_x * h_x + h_y * h_y + h_z * h_z)
+        cosine = (n_x * h_x + n_y * h_y + n_z * h_z) / length
+        # A negative cosine to a fractional power has no real value, PacketRenderer counts it as no highlight
+        highlight = cosine ** exponent if cosine >= 0 or exponent == math.floor(exponent) else 0.0
+        for channel in range(3):
+            light_emission = emission[light, channel] * weight
+            ambient_light[channel] += light_emission
+            diffuse_light[channel] += light_emission * intensity
+            specular_light[channel] += light_emission * highlight
+    return ((ambient[index, 0] * ambient_light[0] + diffuse[index, 0] * diffuse_light[0] + specular[index, 0] * specular_light[0]) * scale,
+            (ambient[index, 1] * ambient_light[1] + diffuse[index, 1] * diffuse_light[1] + specular[index, 1] * specular_light[1]) * scale,
+            (ambient[index, 2] * ambient_light[2] + diffuse[index, 2] * diffuse_light[2] + specular[index, 2] * specular_light[2]) * scale,
+            count)
+
+
+def _vector(vector) -> tuple:
+    return (float(vector.x), float(vector.y), float(vector.z))
+
+
+class KernelScene:
+    """
+    A scene flattened for the kernels above (see the module docstring for the
+    layout). Built from a scene whose acceleration structure is up to date, and
+    rebuilt rather than updated whenever that changes.
+    """
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.objects = scene.objects
+        self._indices = {id(object): index for index, object in enumerate(scene.objects)}
+        # Rotated cubes are intersected through their faces but still tell whether the ray started inside
+        self._rotated_cubes = set()
+        self._light_arrays = {}
+
+        objects = np.zeros((len(scene.objects), 4), dtype=np.int64)
+        params = np.zeros((len(scene.objects), 6), dtype=np.float64)
+        triangles, mesh_bounds, mesh_nodes = [], [], []
+        number_of_triangles = number_of_nodes = mesh_depth = 0
+        for index, object in enumerate(scene.objects):
+            if isinstance(object, SpherePrimitive):
+                objects[index, 0] = SPHERE
+                params[index, :4] = (*_vector(object.position), object.radius)
+            elif isinstance(object, CubePrimitive) and object.rotation is None:
+                objects[index, 0] = BOX
+                params[index] = (*object._minimum, *object._maximum)
+            elif isinstance(object, PlanePrimitive) and object.axis is not None:
+                objects[index] = (RECT, object.axis, 0, 0)
+                params[index] = (*object._minimum, *object._maximum)
+            elif isinstance(object, MeshPrimitive):
+                mesh = object.mesh
+                triangles.append(np.concatenate((mesh.v0, mesh.e1, mesh.e2, mesh.normals)).T)
+                bvh = object.bvh
+                mesh_bounds.append(bvh.node_bounds)
+                mesh_nodes.append(np.stack((bvh.node_left, bvh.node_right, bvh.node_start, bvh.node_count), axis=1))
+                objects[index] = (MESH, number_of_triangles, len(object), number_of_nodes)
+                number_of_triangles += len(object)
+                number_of_nodes += len(bvh)
+                mesh_depth = max(mesh_depth, bvh.depth())
+            elif isinstance(object, (TrianglePrimitive, CubePrimitive, PlanePrimitive)):
+                faces = (object,) if isinstance(object, TrianglePrimitive) else object.faces
+                triangles.append(np.array([(*face._v0, *face._edges, *face._normal) for face in faces], dtype=np.float64))
+                objects[index] = (TRIANGLES, number_of_triangles, len(faces), 0)
+                number_of_triangles += len(faces)
+                if isinstance(object, CubePrimitive):
+                    self._rotated_cubes.add(index)
+            else:
+                raise ValueError(f'The numba backend cannot intersect a {type(object).__name__}')
+
+        bvh = scene.bvh
+        self.arrays = (
+            objects,
+            params,
+            np.ascontiguousarray(np.concatenate(triangles), dtype=np.float64) if triangles else np.zeros((0, 12)),
+            np.ascontiguousarray(np.concatenate(mesh_bounds), dtype=np.float64) if mesh_bounds else np.zeros((0, 6)),
+            np.ascontiguousarray(np.concatenate(mesh_nodes), dtype=np.int64) if mesh_nodes else np.zeros((0, 4), dtype=np.int64),
+            np.ascontiguousarray(bvh.node_bounds, dtype=np.float64) if bvh is not None else np.zeros((0, 6)),
+            np.ascontiguousarray(np.stack((bvh.node_left, bvh.node_right, bvh.node_start, bvh.node_count), axis=1), dtype=np.int64) if bvh is not None else np.zeros((0, 4), dtype=np.int64),
+            np.ascontiguousarray(bvh.indices, dtype=np.int64) if bvh is not None else np.zeros(0, dtype=np.int64),
+            # A traversal pops one node and pushes at most two, so it never holds more than one entry per level plus the root
+            np.array((bvh.depth() + 1 if bvh is not None else 1, mesh_depth + 1), dtype=np.int64),
+        )
+
+        # Each object's material, gathered from the material table
+        materials = scene.materials.arrays()
+        material_ids = np.array([object.material_id for object in scene.objects], dtype=np.int64)
+        self.shading = tuple(np.ascontiguousarray(materials[name][material_ids]) for name in ('ambient', 'diffuse', 'specular', 'shininess', 'emission', 'is_emissive'))
+        self._lights = np.flatnonzero(self.shading[5]).astype(np.int64)
+        self._no_points = np.zeros((0, 3))
+        self._no_emitters = np.zeros(0, dtype=np.int64)
+        self._no_weights = np.zeros(0)
+
+    def nearest_intersection(self, ray) -> tuple:
+        index, distance, n_x, n_y, n_z, inside = intersect(self.arrays, _vector(ray.origin), _vector(ray.direction))
+        if index < 0:
+            return None, None
+        if index in self._rotated_cubes:
+            inside = self.objects[index].contains(point=ray.origin)
+        return self.objects[index], Hit(distance=distance, normal_to_surface=Q_Vector3d(n_x, n_y, n_z), is_inside=bool(inside), ray=ray)
+
+    def light_arrays(self, lighting_samples: int) -> tuple:
+        # Scene.light_samples as (patterns, samples, 3) points, (patterns, samples) emitter indices and weights
+        if lighting_samples not in self._light_arrays:
+            patterns = self.scene.light_samples(lighting_samples=lighting_samples)
+            points = np.array([[_vector(point) for _, point, _ in samples] for samples in patterns], dtype=np.float64).reshape(len(patterns), -1, 3)
+            emitters = np.array([[self._indices[id(emitter)] for emitter, _, _ in samples] for samples in patterns], dtype=np.int64).reshape(len(patterns), -1)
+            weights = np.array([[weight for _, _, weight in samples] for samples in patterns], dtype=np.float64).reshape(len(patterns), -1)
+            self._light_arrays[lighting_samples] = points, emitters, weights
+        return self._light_arrays[lighting_samples]
+
+    def calculate_lighting(self, this_object, origin: Q_Vector3d, direction_from_intersection_to_light: Q_Vector3d, object_hit: Hit, depth: int = 1) -> tuple:
+        # Scene.calculate_lighting's colour, and the number of shadow rays it took
+        scene = self.scene
+        lighting_samples = scene.lighting_samples
+        pattern = scene.sampler.pattern(x=scene._pixel[0], y=scene._pixel[1], dimension=depth, sample=scene._sample)
+        to_camera = _vector((scene.camera_position - object_hit.position).normalized())
+        if scene.light_sampling == 'cone':
+            points, emitters, weights = self._no_points, self._no_emitters, self._no_weights
+            cone_direction = _vector(direction_from_intersection_to_light)
+            cone_table = scene.cone_table(lighting_samples)[pattern]
+        else:
+            points, emitters, weights = (array[pattern] for array in self.light_arrays(lighting_samples=lighting_samples))
+            cone_direction = (0.0, 0.0, 1.0)
+            cone_table = self._no_points
+        r, g, b, rays = shade(self.arrays, self.shading, self._lights, self._indices[id(this_object)], _vector(origin), _vector(object_hit.normal_to_surface), to_camera,
+                              points, emitters, weights, cone_direction, cone_table, 1 / (lighting_samples ** 2))
+        return Q_Vector3d(r, g, b), rays
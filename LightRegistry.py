@@ -0,0 +1,112 @@
+import math
+
+from QFunctions.Q_Functions import Q_Vector3d
+
+LIGHT_WEIGHTINGS = ('power', 'area')
+
+
+class LightRegistry:
+    """
+    Every emissive primitive of a scene, indexed when its acceleration
+    structure is built, with an alias table for picking one in proportion to
+    its power (surface area times mean emission) or its area alone.
+
+    sample(u, v) turns two uniform numbers into a light, a point on its
+    surface and the probability density of that point with respect to
+    surface area, so a shadow ray can be aimed at any light in the scene
+    rather than at a single fixed position.
+    """
+
+    def __init__(self, emitters: list, weighting: str = 'power'):
+        if weighting not in LIGHT_WEIGHTINGS:
+            raise ValueError(f'Unknown light weighting {weighting!r}, expected one of {", ".join(LIGHT_WEIGHTINGS)}')
+        self.emitters = list(emitters)
+        self.areas = [emitter.surface_area() for emitter in self.emitters]
+        if weighting == 'power':
+            weights = [area * sum(emitter.emission.to_tuple()) / 3 for emitter, area in zip(self.emitters, self.areas)]
+        else:
+            weights = list(self.areas)
+        total = sum(weights)
+        self.probabilities = [weight / total for weight in weights] if total > 0 else [0.0] * len(weights)
+        self._build_alias_table()
+
+    def __len__(self) -> int:
+        return len(self.emitters)
+
+    def _build_alias_table(self) -> None:
+        # Vose's method: every column holds at most two lights, its own with probability self._keep and its alias
+        count = len(self.probabilities)
+        scaled = [probability * count for probability in self.probabilities]
+        # Columns never paired up keep themselves entirely, which only happens to absorb rounding
+        self._keep = [1.0] * count
+        self._alias = list(range(count))
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self._keep[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    def select(self, u: float) -> tuple:
+        """
+        Index of a light picked with one uniform number, and that number's unused fraction
+        rescaled back to [0, 1) so it can still place the point on the light.
+        """
+        count = len(self._keep)
+        column = min(int(u * count), count - 1)
+        fraction = u * count - column
+        keep = self._keep[column]
+        if fraction < keep:
+            return column, fraction / keep
+        return self._alias[column], (fraction - keep) / (1.0 - keep)
+
+    def sample(self, u: float, v: float) -> tuple:
+        # (light index, point on it, density of the point per unit area), or None without lights
+        if not self.emitters or not any(self.probabilities):
+            return None
+        index, u = self.select(u)
+        point = self.emitters[index].sample_surface(u=u, v=v)
+        return index, point, self.probabilities[index] / self.areas[index]
+
+    def samples(self, points) -> list:
+        """
+        (emitter, point, weight) for each (u, v) of points. u picks the light, so it should be
+        stratified over all of the points (true of every Sampler table). weight is 1 / selection
+        probability, so averaging emission * weight over the samples sums every light's emission
+        over the visible part of its surface.
+        """
+        samples = []
+        for u, v in points:
+            sample = self.sample(u=u, v=v)
+            if sample is not None:
+                index, point, _ = sample
+                samples.append((self.emitters[index], point, 1.0 / self.probabilities[index]))
+        return samples
+
+
+def triangle_area(v0: Q_Vector3d, v1: Q_Vector3d, v2: Q_Vector3d) -> float:
+    a_x, a_y, a_z = v1.x - v0.x, v1.y - v0.y, v1.z - v0.z
+    b_x, b_y, b_z = v2.x - v0.x, v2.y - v0.y, v2.z - v0.z
+    return 0.5 * math.sqrt((a_y * b_z - a_z * b_y) ** 2 + (a_z * b_x - a_x * b_z) ** 2 + (a_x * b_y - a_y * b_x) ** 2)
+
+
+def sample_triangle(v0: Q_Vector3d, v1: Q_Vector3d, v2: Q_Vector3d, u: float, v: float) -> Q_Vector3d:
+    # Uniform over the triangle's area
+    root = math.sqrt(u)
+    b1 = root * (1.0 - v)
+    b2 = root * v
+    b0 = 1.0 - b1 - b2
+    return Q_Vector3d(b0 * v0.x + b1 * v1.x + b2 * v2.x, b0 * v0.y + b1 * v1.y + b2 * v2.y, b0 * v0.z + b1 * v1.z + b2 * v2.z)
+
+
+def sample_faces(faces: tuple, u: float, v: float) -> Q_Vector3d:
+    # Pick a triangle face in proportion to its area with u, then reuse the rest of u inside it
+    areas = [triangle_area(*face.vertices) for face in faces]
+    target = u * sum(areas)
+    for face, area in zip(faces, areas):
+        if target < area or face is faces[-1]:
+            return sample_triangle(*face.vertices, u=min(target / area, 1.0) if area > 0 else 0.0, v=v)
+        target -= area
@@ -0,0 +1,122 @@
+import weakref
+
+import numpy as np
+
+from QFunctions.Q_Functions import Q_Vector3d
+
+
+class Material:
+    """
+    How a surface responds to light. Primitives do not hold these values
+    themselves, they hold the integer id of a Material in MATERIALS and the
+    registered Material itself, so every primitive (and every face of a cube
+    or plane) with the same look shares one entry.
+    """
+
+    def __init__(self, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
+        assert 0 <= shininess <= 100.0
+        assert 0 <= reflection <= 1.0
+        self.ambient = ambient
+        self.diffuse = diffuse
+        self.specular = specular
+        self.shininess = shininess
+        self.reflection = reflection
+        self.emission = emission
+        self.is_emissive = emission != Q_Vector3d(0, 0, 0)
+        self._key = None
+
+    def key(self) -> tuple:
+        # Flat tuple of every value, for spotting identical materials and for packing into arrays. Worked out once, a Material is not changed after it is made
+        if self._key is None:
+            self._key = (*self.ambient.to_tuple(), *self.diffuse.to_tuple(), *self.specular.to_tuple(), float(self.shininess), float(self.reflection), *self.emission.to_tuple())
+        return self._key
+
+    @staticmethod
+    def from_key(key: tuple) -> 'Material':
+        return Material(ambient=Q_Vector3d(*key[0:3]), diffuse=Q_Vector3d(*key[3:6]), specular=Q_Vector3d(*key[6:9]), shininess=key[9], reflection=key[10], emission=Q_Vector3d(*key[11:14]))
+
+
+class MaterialRegistry:
+    """
+    Process wide table of materials, indexed by material id. Registering a
+    material equal to one already present returns the existing id. arrays()
+    gives the whole table as numpy columns so batched shading can gather the
+    materials of many hits at once with one fancy index.
+
+    The table only holds weak references: the primitives using a material keep
+    it alive, and once none is left its id is free for the next new material.
+    Ids are therefore only meaningful within one process. A primitive pickles
+    with its Material and registers it again when it is unpickled, taking
+    whatever id the receiving process gives it, and a pickled registry is just
+    a reference to the registry of the process that unpickles it.
+    """
+
+    def __init__(self):
+        self._references = []
+        # Key of the material under each id, None for a free id, so releasing one does not have to search _ids
+        self._keys = []
+        self._ids = {}
+        self._free = []
+        # Ids whose material has been garbage collected, freed at the next registration or lookup of the table
+        self._dead = []
+        self._arrays = None
+
+    def register(self, material: Material) -> int:
+        self._release_dead()
+        key = material.key()
+        material_id = self._ids.get(key)
+        if material_id is None:
+            material_id = self._free.pop() if self._free else len(self._references)
+            reference = weakref.ref(material, lambda _, material_id=material_id: self._dead.append(material_id))
+            if material_id == len(self._references):
+                self._references.append(reference)
+                self._keys.append(key)
+            else:
+                self._references[material_id] = reference
+                self._keys[material_id] = key
+            self._ids[key] = material_id
+            self._arrays = None
+        return material_id
+
+    def _release_dead(self) -> None:
+        # Weak reference callbacks can run in the middle of anything, so they only queue the id and the bookkeeping happens here
+        while self._dead:
+            material_id = self._dead.pop()
+            del self._ids[self._keys[material_id]]
+            self._references[material_id] = None
+            self._keys[material_id] = None
+            self._free.append(material_id)
+            self._arrays = None
+
+    def __getitem__(self, material_id: int) -> Material:
+        reference = self._references[material_id] if 0 <= material_id < len(self._references) else None
+        material = reference() if reference is not None else None
+        if material is None:
+            raise KeyError(f'No material with id {material_id}, it has been released or was never registered')
+        return material
+
+    def __len__(self) -> int:
+        # Materials in use
+        self._release_dead()
+        return len(self._ids)
+
+    def arrays(self) -> dict:
+        # (M, 3) ambient, diffuse, specular and emission and (M,) shininess and reflection, rebuilt after a registration. Free ids get a row of zeros
+        self._release_dead()
+        if self._arrays is None:
+            keys = np.zeros((len(self._references), 14))
+            for key, material_id in self._ids.items():
+                keys[material_id] = key
+            self._arrays = {'ambient': keys[:, 0:3], 'diffuse': keys[:, 3:6], 'specular': keys[:, 6:9], 'shininess': keys[:, 9], 'reflection': keys[:, 10], 'emission': keys[:, 11:14],
+                            'is_emissive': np.any(keys[:, 11:14] != 0, axis=1)}
+        return self._arrays
+
+    def __reduce__(self) -> tuple:
+        return _process_registry, ()
+
+
+def _process_registry() -> MaterialRegistry:
+    return MATERIALS
+
+
+MATERIALS = MaterialRegistry()
@@ -0,0 +1,270 @@
+import math
+import os
+
+import numpy as np
+
+from BoundingBox import BoundingBox, inverse_direction
+from BVH import BVH
+from Hit import Hit
+from Material import Material
+from Primitive import Primitive
+from QFunctions.Q_Functions import Q_Vector3d
+from Ray import Ray
+from TriangleMesh import TriangleMesh
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+
+class MeshPrimitive(Primitive):
+    """
+    Triangle mesh held as contiguous numpy buffers rather than one
+    TrianglePrimitive per face. Triangles are sorted into the order of their own
+    BVH so every leaf is a contiguous run of the packed TriangleMesh and is
+    tested in one batched pass.
+    """
+
+    LEAF_SIZE = 16
+    MAX_LEAF_SIZE = 64
+
+    def __init__(self, vertices: np.ndarray, faces: np.ndarray, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), material: Material = None):
+        vertices = np.asarray(vertices).reshape(-1, 3)
+        faces = np.asarray(faces).reshape(-1, 3)
+        if not len(faces):
+            raise ValueError('A mesh needs at least one face')
+        corners = np.asarray(vertices[faces], dtype=np.float64)
+        minimum = corners.min(axis=(0, 1))
+        maximum = corners.max(axis=(0, 1))
+        Primitive.__init__(self, position=Q_Vector3d(*((minimum + maximum) * 0.5).tolist()), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission, material=material)
+        self._set_corners(corners=corners)
+
+    def _set_corners(self, corners: np.ndarray) -> None:
+        bvh = BVH(minimums=corners.min(axis=1), maximums=corners.max(axis=1), leaf_size=MeshPrimitive.LEAF_SIZE, max_leaf_size=MeshPrimitive.MAX_LEAF_SIZE)
+        self._set_packed(corners=corners[bvh.indices], bvh=bvh)
+
+    def _set_packed(self, corners: np.ndarray, bvh: BVH) -> None:
+        # corners are already in the order of the tree's leaves
+        self.bvh = bvh
+        self.mesh = TriangleMesh(vertices=corners)
+        self._bounding_box = BoundingBox(minimum=tuple(self.bvh.node_bounds[0, :3].tolist()), maximum=tuple(self.bvh.node_bounds[0, 3:].tolist()))
+
+    def __len__(self) -> int:
+        return len(self.mesh)
+
+    @staticmethod
+    def from_packed(corners: np.ndarray, bvh: BVH = None, **kwargs) -> 'MeshPrimitive':
+        """
+        Mesh from (N, 3, 3) triangle corners. With a bvh over them, e.g. one read back from a
+        SceneFile, the corners must already be in its leaf order and the tree is used as it is.
+        """
+        corners = np.asarray(corners).reshape(-1, 3, 3)
+        if bvh is None:
+            return MeshPrimitive(vertices=corners.reshape(-1, 3), faces=np.arange(3 * len(corners), dtype=np.int64).reshape(-1, 3), **kwargs)
+        mesh = MeshPrimitive.__new__(MeshPrimitive)
+        Primitive.__init__(mesh, position=Q_Vector3d(*((bvh.node_bounds[0, :3] + bvh.node_bounds[0, 3:]) * 0.5).tolist()), **kwargs)
+        mesh._set_packed(corners=corners, bvh=bvh)
+        return mesh
+
+    @staticmethod
+    def load(path: str, **kwargs) -> 'MeshPrimitive':
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.obj':
+            return MeshPrimitive.from_obj(path=path, **kwargs)
+        if extension == '.ply':
+            return MeshPrimitive.from_ply(path=path, **kwargs)
+        raise ValueError(f'Unsupported mesh format {extension!r}, expected .obj or .ply')
+
+    @staticmethod
+    def from_obj(path: str, **kwargs) -> 'MeshPrimitive':
+        vertices, faces = read_obj(path=path)
+        return MeshPrimitive(vertices=vertices, faces=faces, **kwargs)
+
+    @staticmethod
+    def from_ply(path: str, mmap: bool = True, **kwargs) -> 'MeshPrimitive':
+        vertices, faces = read_ply(path=path, mmap=mmap)
+        return MeshPrimitive(vertices=vertices, faces=faces, **kwargs)
+
+    def _nearest(self, ray: Ray, max_distance: float = math.inf) -> tuple:
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        mesh = self.mesh
+
+        def intersect_leaf(start: int, end: int, best_distance: float):
+            return mesh.nearest(origin=origin, direction=direction, start=start, end=end, max_distance=best_distance)
+
+        return self.bvh.traverse(origin=origin, inverse_direction=inverse_direction(ray.direction), intersect_leaf=intersect_leaf, max_distance=max_distance)
+
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        nearest = self._nearest(ray=ray)
+        if nearest is None:
+            return None
+        distance, index = nearest
+        normal = Q_Vector3d(*self.mesh.normal(index=index, direction=(ray.direction.x, ray.direction.y, ray.direction.z)))
+        if hit is None:
+            return Hit(distance=distance, normal_to_surface=normal, is_inside=False, ray=ray)
+        return hit.set(distance=distance, normal_to_surface=normal, is_inside=False, ray=ray)
+
+    def hit_distance(self, ray: Ray) -> float:
+        nearest = self._nearest(ray=ray)
+        return math.inf if nearest is None else nearest[0]
+
+    def occludes(self, ray: Ray, max_distance: float) -> bool:
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        mesh = self.mesh
+
+        def intersect_leaf(start: int, end: int, max_distance: float):
+            return True if mesh.any_hit(origin=origin, direction=direction, max_distance=max_distance, start=start, end=end) else None
+
+        return self.bvh.any_hit(origin=origin, inverse_direction=inverse_direction(ray.direction), intersect_leaf=intersect_leaf, max_distance=max_distance) is not None
+
+    def translate(self, offset: Q_Vector3d) -> None:
+        # Moving every triangle by the same amount leaves the tree valid, so its bounds are just shifted too
+        Primitive.translate(self, offset=offset)
+        shift = np.array(offset.to_tuple(), dtype=np.float64)
+        self.mesh = self.mesh.translated(offset=shift)
+        self.bvh.translate(offset=shift)
+        self._bounding_box = BoundingBox(minimum=tuple(self.bvh.node_bounds[0, :3].tolist()), maximum=tuple(self.bvh.node_bounds[0, 3:].tolist()))
+
+    def surface_area(self) -> float:
+        return float(self._cumulative_areas()[-1])
+
+    def _cumulative_areas(self) -> np.ndarray:
+        # Running total of triangle areas in mesh order, unchanged by translation so worked out once
+        if getattr(self, '_areas', None) is None:
+            self._areas = np.cumsum(0.5 * np.linalg.norm(np.cross(self.mesh.e1.T, self.mesh.e2.T), axis=1))
+        return self._areas
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        areas = self._cumulative_areas()
+        target = u * areas[-1]
+        index = min(int(np.searchsorted(areas, target, side='right')), len(areas) - 1)
+        start = areas[index - 1] if index else 0.0
+        u = min((target - start) / (areas[index] - start), 1.0) if areas[index] > start else 0.0
+        root = math.sqrt(u)
+        b1 = root * (1.0 - v)
+        b2 = root * v
+        return Q_Vector3d(*(self.mesh.v0[:, index] + self.mesh.e1[:, index] * b1 + self.mesh.e2[:, index] * b2).tolist())
+
+    def bounding_box(self) -> BoundingBox:
+        return self._bounding_box
+
+
+def read_obj(path: str) -> tuple:
+    """
+    Vertex positions and faces of a Wavefront OBJ file as (V, 3) float64 and
+    (F, 3) int64 arrays. Polygons are fan triangulated; texture and normal
+    indices are ignored.
+    """
+    vertices = []
+    faces = []
+    with open(path, 'r') as obj:
+        for line in obj:
+            if line.startswith('v '):
+                vertices.append(line.split()[1:4])
+            elif line.startswith('f '):
+                polygon = [int(corner.split('/')[0]) for corner in line.split()[1:]]
+                # OBJ indices are 1-based, negative ones count back from the latest vertex
+                polygon = [index - 1 if index > 0 else len(vertices) + index for index in polygon]
+                for i in range(1, len(polygon) - 1):
+                    faces.append((polygon[0], polygon[i], polygon[i + 1]))
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3)
+
+
+def _read_ply_header(ply) -> tuple:
+    if ply.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file')
+    file_format = None
+    elements = []
+    while True:
+        line = ply.readline()
+        if not line:
+            raise ValueError('PLY header has no end_header')
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'format':
+            file_format = words[1]
+        elif words[0] == 'element':
+            elements.append({'name': words[1], 'count': int(words[2]), 'properties': []})
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1]['properties'].append((words[4], 'list', PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+            else:
+                elements[-1]['properties'].append((words[2], PLY_TYPES[words[1]]))
+        elif words[0] == 'end_header':
+            return file_format, elements, ply.tell()
+
+
+def read_ply(path: str, mmap: bool = True) -> tuple:
+    """
+    Vertex positions and faces of an ASCII or binary PLY file. Binary vertex
+    and (all-triangle) face blocks are memory-mapped rather than read, so only
+    the x, y, z columns and vertex indices are ever copied out of the file.
+    """
+    with open(path, 'rb') as ply:
+        file_format, elements, offset = _read_ply_header(ply)
+        if file_format == 'ascii':
+            return _read_ply_ascii(ply=ply, elements=elements)
+
+    endian = '<' if file_format == 'binary_little_endian' else '>'
+    vertices = faces = None
+    for element in elements:
+        if any(prop[1] == 'list' for prop in element['properties']):
+            _, _, count_type, index_type = next(prop for prop in element['properties'] if prop[1] == 'list')
+            if element['name'] != 'face' or len(element['properties']) != 1:
+                raise ValueError(f'Unsupported PLY list element {element["name"]!r}')
+            # Fixed stride when every face is a triangle, which is checked after mapping
+            dtype = np.dtype([('count', endian + count_type), ('indices', endian + index_type, 3)])
+            block = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(element['count'],)) if mmap else np.fromfile(path, dtype=dtype, count=element['count'], offset=offset)
+            if element['count'] and not (block['count'] == 3).all():
+                faces, offset = _read_ply_polygons(path=path, offset=offset, count=element['count'], count_type=endian + count_type, index_type=endian + index_type)
+                continue
+            faces = np.asarray(block['indices'], dtype=np.int64)
+            offset += dtype.itemsize * element['count']
+        else:
+            dtype = np.dtype([(name, endian + kind) for name, kind in element['properties']])
+            block = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(element['count'],)) if mmap else np.fromfile(path, dtype=dtype, count=element['count'], offset=offset)
+            if element['name'] == 'vertex':
+                vertices = np.stack((block['x'], block['y'], block['z']), axis=1).astype(np.float64)
+            offset += dtype.itemsize * element['count']
+    if vertices is None or faces is None:
+        raise ValueError('PLY file needs vertex and face elements')
+    return vertices, faces
+
+
+def _read_ply_polygons(path: str, offset: int, count: int, count_type: str, index_type: str) -> tuple:
+    # Variable length faces have to be walked one at a time, then fan triangulated
+    count_dtype = np.dtype(count_type)
+    index_dtype = np.dtype(index_type)
+    faces = []
+    with open(path, 'rb') as ply:
+        ply.seek(offset)
+        for _ in range(count):
+            size = int(np.frombuffer(ply.read(count_dtype.itemsize), dtype=count_dtype)[0])
+            polygon = np.frombuffer(ply.read(index_dtype.itemsize * size), dtype=index_dtype).tolist()
+            for i in range(1, size - 1):
+                faces.append((polygon[0], polygon[i], polygon[i + 1]))
+        offset = ply.tell()
+    return np.array(faces, dtype=np.int64).reshape(-1, 3), offset
+
+
+def _read_ply_ascii(ply, elements: list) -> tuple:
+    vertices = []
+    faces = []
+    for element in elements:
+        names = [prop[0] for prop in element['properties']]
+        for _ in range(element['count']):
+            values = ply.readline().split()
+            if element['name'] == 'vertex':
+                vertices.append([float(values[names.index(axis)]) for axis in ('x', 'y', 'z')])
+            elif element['name'] == 'face':
+                size = int(values[0])
+                polygon = [int(value) for value in values[1:1 + size]]
+                for i in range(1, size - 1):
+                    faces.append((polygon[0], polygon[i], polygon[i + 1]))
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3)
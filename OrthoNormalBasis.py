@@ -1,6 +1,8 @@
 from QFunctions.Q_Functions import Q_Vector3d
 import math
 
+import numpy as np
+
 
 class OrthoNormalBasis:
     COINCIDENT = 0.9999
@@ -83,6 +85,22 @@ class OrthoNormalBasis:
             )
         ).normalized()
 
+    @staticmethod
+    def cone_table(cone_theta: float, points) -> np.ndarray:
+        # cone_sample's local (x, y, z) for every (u, v) of points, shape (..., 2) -> (..., 3), so the trig is done once per render
+        points = np.asarray(points, dtype=np.float64)
+        theta = cone_theta * (1.0 - (2.0 * np.arccos(points[..., 0]) / math.pi))
+        radius = np.sin(theta)
+        random_theta = points[..., 1] * 2 * math.pi
+        return np.stack((np.cos(random_theta) * radius, np.sin(random_theta) * radius, np.cos(theta)), axis=-1)
+
+    @staticmethod
+    def cone_samples(direction: Q_Vector3d, cone_table: list) -> list:
+        # cone_sample for every (x, y, z) row of a cone_table, building the basis around direction only once
+        basis = OrthoNormalBasis.fromZ(direction)
+        x, y, z = basis.x, basis.y, basis.z
+        return [Q_Vector3d(x.x * a + y.x * b + z.x * c, x.y * a + y.y * b + z.y * c, x.z * a + y.z * b + z.z * c).normalized() for a, b, c in cone_table]
+
 
 if __name__ == "__main__":
     vector = Q_Vector3d(0, 1, 0)
@@ -0,0 +1,287 @@
+import numpy as np
+
+from MeshPrimitive import MeshPrimitive
+from OrthoNormalBasis import OrthoNormalBasis
+from SpherePrimitive import SpherePrimitive
+from TriangleMesh import TriangleMesh
+from TrianglePrimitive import TrianglePrimitive
+
+
+def _vector_to_array(vector) -> np.ndarray:
+    return np.array([vector.x, vector.y, vector.z], dtype=np.float64)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum('...i,...i->...', a, b)
+
+
+class PacketRenderer:
+    """
+    Renders a block of pixels by pushing every ray of the block through the
+    scene as (N, 3) arrays. It follows Scene.render / trace_ray step for step
+    (same camera mapping, shadow ray sampling, reflection bounces) so the
+    two paths agree to within floating point noise. Rays that stop bouncing are
+    dropped from the arrays.
+    """
+
+    # Upper bound on rays x primitives evaluated per numpy call
+    BLOCK_SIZE = 1 << 20
+    SURFACE_OFFSET = 1e-5
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.camera_position = _vector_to_array(scene.camera_position)
+        self.light_position = _vector_to_array(scene.lights[0]['position']) if scene.lights else None
+        self._light_arrays = {}
+
+        sphere_centers, sphere_radii, sphere_owners = [], [], []
+        triangle_vertices, triangle_owners = [], []
+        for index, object in enumerate(scene.objects):
+            if isinstance(object, SpherePrimitive):
+                sphere_centers.append(_vector_to_array(object.position))
+                sphere_radii.append(object.radius)
+                sphere_owners.append(index)
+            elif isinstance(object, MeshPrimitive):
+                triangle_vertices.append(object.mesh.vertices)
+                triangle_owners.append(np.full(len(object), index, dtype=np.int64))
+            else:
+                # Planes and cubes are intersected through their triangle faces
+                triangles = (object,) if isinstance(object, TrianglePrimitive) else object.faces
+                triangle_vertices.append(np.array([[_vector_to_array(vertex) for vertex in triangle.vertices] for triangle in triangles], dtype=np.float64).reshape(-1, 3, 3))
+                triangle_owners.append(np.full(len(triangles), index, dtype=np.int64))
+
+        self.sphere_centers = np.array(sphere_centers, dtype=np.float64).reshape(-1, 3)
+        self.sphere_radii = np.array(sphere_radii, dtype=np.float64)
+        self.sphere_owners = np.array(sphere_owners, dtype=np.int64)
+
+        # Row-major views of the packed mesh, since here the rays are the batched axis
+        self.triangles = TriangleMesh(vertices=np.concatenate(triangle_vertices) if triangle_vertices else np.zeros((0, 3, 3)))
+        self.triangle_v0 = self.triangles.v0.T
+        self.triangle_e1 = self.triangles.e1.T
+        self.triangle_e2 = self.triangles.e2.T
+        self.triangle_normals = self.triangles.normals.T
+        self.triangle_owners = np.concatenate(triangle_owners) if triangle_owners else np.zeros(0, dtype=np.int64)
+
+        # Shading gathers from the material table through each object's material id
+        self.materials = scene.materials.arrays()
+        self.material_ids = np.array([object.material_id for object in scene.objects], dtype=np.int64)
+        self.reflection = self.materials['reflection'][self.material_ids]
+        self.is_emissive = self.materials['is_emissive'][self.material_ids]
+
+    def _blocks(self, number_of_rays: int, number_of_items: int):
+        step = max(1, PacketRenderer.BLOCK_SIZE // max(number_of_rays, 1))
+        for start in range(0, number_of_items, step):
+            yield start, min(start + step, number_of_items)
+
+    def intersect(self, origins: np.ndarray, directions: np.ndarray) -> tuple:
+        """
+        Closest hit for every ray. Returns (distance, owner, normal) where owner
+        is the index into scene.objects, or -1 for rays that hit nothing.
+        """
+        number_of_rays = len(origins)
+        self.scene.rays_traced += number_of_rays
+        best_distance = np.full(number_of_rays, np.inf)
+        best_sphere = np.full(number_of_rays, -1, dtype=np.int64)
+        best_triangle = np.full(number_of_rays, -1, dtype=np.int64)
+
+        for start, end in self._blocks(number_of_rays, len(self.sphere_radii)):
+            op = self.sphere_centers[np.newaxis, start:end] - origins[:, np.newaxis]
+            b = np.einsum('nmi,ni->nm', op, directions)
+            determinant = b * b - np.einsum('nmi,nmi->nm', op, op) + self.sphere_radii[np.newaxis, start:end] ** 2
+            hit = determinant >= 0
+            root = np.sqrt(np.where(hit, determinant, 0.0))
+            minus_t = b - root
+            plus_t = b + root
+            t = np.where(minus_t > SpherePrimitive.EPSILON, minus_t, plus_t)
+            t = np.where(hit & ((minus_t >= SpherePrimitive.EPSILON) | (plus_t >= SpherePrimitive.EPSILON)), t, np.inf)
+            self._keep_closest(t, start, best_distance, best_sphere, best_triangle)
+
+        for start, end in self._blocks(number_of_rays, len(self.triangle_owners)):
+            e1 = self.triangle_e1[np.newaxis, start:end]
+            e2 = self.triangle_e2[np.newaxis, start:end]
+            p_vector = np.cross(directions[:, np.newaxis], e2)
+            determinant = np.einsum('nmi,nmi->nm', e1, p_vector)
+            parallel = np.fabs(determinant) < TrianglePrimitive.EPSILON
+            inverse_determinant = 1.0 / np.where(parallel, 1.0, determinant)
+            t_vector = origins[:, np.newaxis] - self.triangle_v0[np.newaxis, start:end]
+            u = np.einsum('nmi,nmi->nm', t_vector, p_vector) * inverse_determinant
+            q_vector = np.cross(t_vector, e1)
+            v = np.einsum('ni,nmi->nm', directions, q_vector) * inverse_determinant
+            t = np.einsum('nmi,nmi->nm', e2, q_vector) * inverse_determinant
+            miss = parallel | (u < 0.0) | (u > 1.0) | (v < 0.0) | ((u + v) > 1.0) | (t < TrianglePrimitive.EPSILON)
+            t = np.where(miss, np.inf, t)
+            self._keep_closest(t, start, best_distance, best_triangle, best_sphere)
+
+        owner = np.full(number_of_rays, -1, dtype=np.int64)
+        normal = np.zeros((number_of_rays, 3))
+
+        sphere_rays = np.nonzero(best_sphere >= 0)[0]
+        if len(sphere_rays):
+            spheres = best_sphere[sphere_rays]
+            owner[sphere_rays] = self.sphere_owners[spheres]
+            positions = origins[sphere_rays] + directions[sphere_rays] * best_distance[sphere_rays, np.newaxis]
+            sphere_normals = _normalize(positions - self.sphere_centers[spheres])
+            inside = _dot(sphere_normals, directions[sphere_rays]) > 0
+            sphere_normals[inside] *= -1
+            normal[sphere_rays] = sphere_normals
+
+        triangle_rays = np.nonzero(best_triangle >= 0)[0]
+        if len(triangle_rays):
+            triangles = best_triangle[triangle_rays]
+            owner[triangle_rays] = self.triangle_owners[triangles]
+            determinant = _dot(self.triangle_e1[triangles], np.cross(directions[triangle_rays], self.triangle_e2[triangles]))
+            backfacing = determinant < TrianglePrimitive.EPSILON
+            triangle_normals = self.triangle_normals[triangles].copy()
+            triangle_normals[backfacing] *= -1
+            normal[triangle_rays] = triangle_normals
+
+        return best_distance, owner, normal
+
+    @staticmethod
+    def _keep_closest(t: np.ndarray, start: int, best_distance: np.ndarray, best_index: np.ndarray, other_index: np.ndarray) -> None:
+        column = np.argmin(t, axis=1)
+        closest = t[np.arange(len(t)), column]
+        closer = closest < best_distance
+        best_distance[closer] = closest[closer]
+        best_index[closer] = column[closer] + start
+        other_index[closer] = -1
+
+    def trace_pixels(self, width: int, height: int, xs: np.ndarray, ys: np.ndarray, offsets: np.ndarray, max_depth: int = 1, lighting_samples: int = 1, samples: np.ndarray = None) -> np.ndarray:
+        # Same contract as Scene.trace_pixels
+        origins, directions = self.scene.camera.rays(width=width, height=height, xs=xs, ys=ys, offsets=offsets)
+        return self.trace(origins, directions, max_depth, lighting_samples, xs, ys, samples)
+
+    @staticmethod
+    def cone_sample(directions: np.ndarray, cone_theta: float, u, v) -> np.ndarray:
+        # Vectorized OrthoNormalBasis.cone_sample, with u and v either single values or one per direction
+        local = OrthoNormalBasis.cone_table(cone_theta=cone_theta, points=np.stack(np.broadcast_arrays(u, v), axis=-1))
+        return PacketRenderer.cone_directions(directions, np.broadcast_to(local, directions.shape)[:, np.newaxis])[:, 0]
+
+    @staticmethod
+    def cone_directions(directions: np.ndarray, local: np.ndarray) -> np.ndarray:
+        # Vectorized OrthoNormalBasis.cone_samples: (N, samples, 3) cone_table rows around each of N directions, one basis per direction
+        coincident = np.fabs(directions[:, 0]) > 0.9999
+        axis = np.zeros_like(directions)
+        axis[coincident, 1] = 1.0
+        axis[~coincident, 0] = 1.0
+        x_axis = _normalize(np.cross(axis, directions))
+        y_axis = _normalize(np.cross(directions, x_axis))
+        samples = x_axis[:, np.newaxis] * local[..., 0:1] + y_axis[:, np.newaxis] * local[..., 1:2] + directions[:, np.newaxis] * local[..., 2:3]
+        return _normalize(samples)
+
+    def shade(self, positions: np.ndarray, normals: np.ndarray, owners: np.ndarray, lighting_samples: int, patterns: np.ndarray) -> np.ndarray:
+        """
+        Vectorized Scene.calculate_lighting for a batch of hit points, patterns being the sampler pattern of each.
+        """
+        shifted = positions + normals * PacketRenderer.SURFACE_OFFSET
+        to_camera = _normalize(self.camera_position - positions)
+        materials = self.material_ids[owners]
+        ambient = self.materials['ambient'][materials]
+        diffuse = self.materials['diffuse'][materials]
+        specular = self.materials['specular'][materials]
+        exponent = (self.materials['shininess'][materials] / 4)[:, np.newaxis]
+
+        illumination = np.zeros_like(positions)
+        for directions, emitter, weight in self.shadow_rays(shifted, lighting_samples, patterns):
+            _, light, _ = self.intersect(shifted, directions)
+            lit = light >= 0
+            if emitter is None:
+                lit[lit] = self.is_emissive[light[lit]]
+            else:
+                lit &= light == emitter
+            if not lit.any():
+                continue
+            emission = self.materials['emission'][self.material_ids[light[lit]]] * (weight[lit] if isinstance(weight, np.ndarray) else weight)
+            intensity = np.fabs(_dot(directions[lit], normals[lit]))[:, np.newaxis]
+            half_vector = _normalize(directions[lit] + to_camera[lit])
+            with np.errstate(invalid='ignore'):
+                highlight = np.power(_dot(normals[lit], half_vector)[:, np.newaxis], exponent[lit])
+            illumination[lit] += ambient[lit] * emission + diffuse[lit] * emission * intensity + specular[lit] * emission * np.nan_to_num(highlight)
+        return illumination * (1 / (lighting_samples ** 2))
+
+    def shadow_rays(self, shifted: np.ndarray, lighting_samples: int, patterns: np.ndarray):
+        # Vectorized Scene.shadow_rays: (directions, emitter index into scene.objects or None, weight) per sample
+        if self.scene.light_sampling == 'cone':
+            directions = PacketRenderer.cone_directions(_normalize(self.light_position - shifted), self.scene.cone_table(lighting_samples)[patterns])
+            for sample in range(directions.shape[1]):
+                yield directions[:, sample], None, 1.0
+            return
+        points, emitters, weights = self.light_arrays(lighting_samples)
+        for sample in range(points.shape[1]):
+            yield _normalize(points[patterns, sample] - shifted), emitters[patterns, sample], weights[patterns, sample, np.newaxis]
+
+    def light_arrays(self, lighting_samples: int) -> tuple:
+        # Scene.light_samples as (patterns, samples, 3) points, (patterns, samples) emitter indices and weights
+        if lighting_samples not in self._light_arrays:
+            indices = {id(object): index for index, object in enumerate(self.scene.objects)}
+            patterns = self.scene.light_samples(lighting_samples=lighting_samples)
+            points = np.array([[_vector_to_array(point) for _, point, _ in samples] for samples in patterns], dtype=np.float64).reshape(len(patterns), -1, 3)
+            emitters = np.array([[indices[id(emitter)] for emitter, _, _ in samples] for samples in patterns], dtype=np.int64).reshape(len(patterns), -1)
+            weights = np.array([[weight for _, _, weight in samples] for samples in patterns], dtype=np.float64).reshape(len(patterns), -1)
+            self._light_arrays[lighting_samples] = points, emitters, weights
+        return self._light_arrays[lighting_samples]
+
+    def trace(self, origins: np.ndarray, directions: np.ndarray, max_depth: int, lighting_samples: int, xs: np.ndarray = None, ys: np.ndarray = None, samples: np.ndarray = None) -> np.ndarray:
+        """
+        Vectorized Scene.trace_ray, ray i being sample number samples[i] of pixel (xs[i], ys[i]). Finished rays
+        are dropped from the active set. throughput is Scene.trace_ray's throughput for every ray.
+        """
+        if xs is None:
+            xs = ys = np.zeros(len(origins), dtype=np.int64)
+        if samples is None:
+            samples = np.zeros(len(origins), dtype=np.int64)
+        color = np.zeros_like(origins)
+        throughput = np.ones(len(origins))
+        active = np.arange(len(origins))
+        for depth in range(1, max_depth + 1):
+            distance, owner, normal = self.intersect(origins, directions)
+            hit = owner >= 0
+            active, origins, directions, distance, owner, normal = active[hit], origins[hit], directions[hit], distance[hit], owner[hit], normal[hit]
+            if not len(active):
+                break
+            positions = origins + directions * distance[:, np.newaxis]
+            patterns = self.scene.sampler.pixel_patterns(xs=xs[active], ys=ys[active], dimension=depth, samples=samples[active])
+            color[active] += self.shade(positions, normal, owner, lighting_samples, patterns) * throughput[active, np.newaxis]
+
+            throughput[active] *= self.reflection[owner]
+            bouncing = throughput[active] >= self.scene.MIN_THROUGHPUT
+            if depth < max_depth and self.scene.roulette_depth is not None and depth >= self.scene.roulette_depth:
+                survival = np.minimum(throughput[active], 1.0)
+                bouncing &= self.scene.sampler.pixel_values(xs=xs[active], ys=ys[active], dimension=-depth, samples=samples[active]) < survival
+                throughput[active[bouncing]] /= survival[bouncing]
+            if depth == max_depth or not bouncing.any():
+                break
+            active, positions, directions, normal = active[bouncing], positions[bouncing], directions[bouncing], normal[bouncing]
+            origins = positions + normal * PacketRenderer.SURFACE_OFFSET
+            directions = directions - normal * (2 * _dot(directions, normal))[:, np.newaxis]
+        return color
+
+    def render(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, rows: range = None, columns: range = None, offsets: list = None, first_sample: int = 0) -> np.ndarray:
+        """
+        Returns the (len(rows), len(columns), 3) block of the image. offsets, a list of (dx, dy)
+        pixel offsets, replaces the anti aliasing grid when given. The samples are numbered from first_sample.
+        """
+        rows = range(height) if rows is None else rows
+        columns = range(width) if columns is None else columns
+        grid_y, grid_x = np.meshgrid(np.asarray(rows), np.asarray(columns), indexing='ij')
+        xs, ys = grid_x.ravel(), grid_y.ravel()
+        if not offsets and anti_aliasing and self.scene.sampler.kind != 'grid':
+            # (pixels, samples, 2), every pixel with its own offsets
+            offsets = self.scene.sampled_offsets(width=width, height=height, xs=xs, ys=ys).transpose(1, 0, 2)
+        elif not offsets and anti_aliasing:
+            aa_x = 1 / (2 * width)
+            aa_y = 1 / (2 * height)
+            offsets = [(dx * aa_x, dy * aa_y) for dy in (1, 0, -1) for dx in (-1, 0, 1)]
+        elif not offsets:
+            offsets = [(0, 0)]
+
+        color = np.zeros((len(rows) * len(columns), 3))
+        for index, offset in enumerate(offsets):
+            origins, directions = self.scene.camera.rays(width=width, height=height, xs=xs, ys=ys, offsets=np.broadcast_to(np.asarray(offset, dtype=np.float64), (len(xs), 2)))
+            color += self.trace(origins, directions, max_depth, lighting_samples, xs, ys, np.full(len(xs), first_sample + index))
+        color = np.clip(color * (1 / len(offsets)), 0, 1)
+        return color.reshape(len(rows), len(columns), 3)
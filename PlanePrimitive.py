@@ -1,6 +1,9 @@
 import math
 
+from BoundingBox import BoundingBox
 from Hit import Hit
+from LightRegistry import sample_faces
+from Material import Material
 from Primitive import Primitive
 from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
@@ -16,8 +19,13 @@ class PlanePrimitive(Primitive):
     front_bottom_left
     (x1, y1, z1)
     """
-    def __init__(self, front_bottom_left: Q_Vector3d, rear_top_right: Q_Vector3d, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
-        Primitive.__init__(self, position=(rear_top_right + front_bottom_left) * (1 / 2), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
+
+    EPSILON = 0.000000001
+
+    def __init__(self, front_bottom_left: Q_Vector3d, rear_top_right: Q_Vector3d, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), material: Material = None):
+        Primitive.__init__(self, position=(rear_top_right + front_bottom_left) * (1 / 2), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission, material=material)
+        self.front_bottom_left = front_bottom_left
+        self.rear_top_right = rear_top_right
         front = Q_Vector3d(0, 0, front_bottom_left.z)
         bottom = Q_Vector3d(0, front_bottom_left.y, 0)
         left = Q_Vector3d(front_bottom_left.x, 0, 0)
@@ -25,26 +33,96 @@ class PlanePrimitive(Primitive):
         top = Q_Vector3d(0, rear_top_right.y, 0)
         right = Q_Vector3d(rear_top_right.x, 0, 0)
 
-        self.faces = (
-            # top face
-            TrianglePrimitive((front + bottom + left, rear + top + left, rear_top_right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-            TrianglePrimitive((front + bottom + left, front + bottom + right, rear_top_right), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission),
-        )
-
-    def intersect(self, ray: Ray) -> Hit:
-        # Call interct for all triangles in all faces
-        # Track objects and distances that have collissions
-        # Determine closest triangle
-        # Return this distance and that normal's triangle
+        if front_bottom_left.x == rear_top_right.x:
+            # Split along y instead, splitting along x would give two zero area triangles
+            self.faces = (
+                TrianglePrimitive((front + bottom + left, front + top + left, rear_top_right), material=self.material),
+                TrianglePrimitive((front + bottom + left, rear + bottom + left, rear_top_right), material=self.material),
+            )
+        else:
+            self.faces = (
+                # top face
+                TrianglePrimitive((front + bottom + left, rear + top + left, rear_top_right), material=self.material),
+                TrianglePrimitive((front + bottom + left, front + bottom + right, rear_top_right), material=self.material),
+            )
+
+        # Rectangles lying in an axis plane take the analytic path, sloped ones keep their triangles
+        self._minimum = tuple(min(a, b) for a, b in zip(front_bottom_left.to_tuple(), rear_top_right.to_tuple()))
+        self._maximum = tuple(max(a, b) for a, b in zip(front_bottom_left.to_tuple(), rear_top_right.to_tuple()))
+        flat = [axis for axis in range(3) if self._minimum[axis] == self._maximum[axis]]
+        self.axis = flat[0] if len(flat) == 1 else None
+        self._bounding_box = BoundingBox.from_points(vertex for face in self.faces for vertex in face.vertices)
+
+    def _rect_distance(self, ray: Ray) -> float:
+        axis = self.axis
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        if direction[axis] == 0:
+            return math.inf
+        t = (self._minimum[axis] - origin[axis]) / direction[axis]
+        if t < PlanePrimitive.EPSILON:
+            return math.inf
+        for other in range(3):
+            if other != axis:
+                p = origin[other] + direction[other] * t
+                if p < self._minimum[other] or p > self._maximum[other]:
+                    return math.inf
+        return t
+
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        if self.axis is not None:
+            distance = self._rect_distance(ray=ray)
+            if distance == math.inf:
+                return None
+            normal = Primitive.AXIS_NORMALS[self.axis][(ray.direction.x, ray.direction.y, ray.direction.z)[self.axis] > 0]
+            if hit is None:
+                return Hit(distance=distance, normal_to_surface=normal, is_inside=False, ray=ray)
+            return hit.set(distance=distance, normal_to_surface=normal, is_inside=False, ray=ray)
+
+        # Find the closest face by distance alone and only build the Hit for that one.
         # In theory, this should only have one intersection, but it's
         # possible the vector could be along the plane...
         min_distance = math.inf
-        normal_to_surface = None
+        nearest_face = None
         for triangle in self.faces:
-            # this_distance, this_normal_to_surface = triangle.intersect(ray=ray)
-            hit = triangle.intersect(ray=ray)
-            if hit and hit.distance < min_distance:
-                min_distance = hit.distance
-                normal_to_surface = hit.normal_to_surface
-        # return (min_distance, normal_to_surface)
-        return Hit(position=ray.position_at_distance(min_distance), distance=min_distance, normal_to_surface=normal_to_surface, is_inside=False)
+            distance = triangle.hit_distance(ray=ray)
+            if distance < min_distance:
+                min_distance = distance
+                nearest_face = triangle
+        if nearest_face is None:
+            return None
+        return nearest_face.intersect(ray=ray, hit=hit)
+
+    def hit_distance(self, ray: Ray) -> float:
+        if self.axis is not None:
+            return self._rect_distance(ray=ray)
+        return min(triangle.hit_distance(ray=ray) for triangle in self.faces)
+
+    def occludes(self, ray: Ray, max_distance: float) -> bool:
+        if self.axis is not None:
+            return self._rect_distance(ray=ray) < max_distance
+        # Any face closer than max_distance is enough, no need to find the closest one
+        return any(triangle.hit_distance(ray=ray) < max_distance for triangle in self.faces)
+
+    def translate(self, offset: Q_Vector3d) -> None:
+        Primitive.translate(self, offset=offset)
+        self.front_bottom_left = self.front_bottom_left + offset
+        self.rear_top_right = self.rear_top_right + offset
+        for face in self.faces:
+            face.translate(offset=offset)
+        self._minimum = tuple(value + shift for value, shift in zip(self._minimum, offset.to_tuple()))
+        self._maximum = tuple(value + shift for value, shift in zip(self._maximum, offset.to_tuple()))
+        self._bounding_box = BoundingBox.from_points(vertex for face in self.faces for vertex in face.vertices)
+
+    def surface_area(self) -> float:
+        return sum(face.surface_area() for face in self.faces)
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        if self.axis is not None:
+            # Straight across the rectangle, so a grid of (u, v) stays a grid on the light
+            spans = iter((u, v))
+            return Q_Vector3d(*(low if low == high else low + (high - low) * next(spans) for low, high in zip(self._minimum, self._maximum)))
+        return sample_faces(faces=self.faces, u=u, v=v)
+
+    def bounding_box(self) -> BoundingBox:
+        return self._bounding_box
@@ -1,22 +1,93 @@
+import math
+
+from BoundingBox import BoundingBox
+from Material import MATERIALS, Material
 from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
 from Hit import Hit
 
 
 class Primitive:
-    def __init__(self, position: Q_Vector3d, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
-        assert 0 <= shininess <= 100.0
-        assert 0 <= reflection <= 1.0
+
+    # Unit normals of the +/- axis planes, indexed [axis][direction component > 0] so they face the incoming ray
+    AXIS_NORMALS = (
+        (Q_Vector3d(1, 0, 0), Q_Vector3d(-1, 0, 0)),
+        (Q_Vector3d(0, 1, 0), Q_Vector3d(0, -1, 0)),
+        (Q_Vector3d(0, 0, 1), Q_Vector3d(0, 0, -1)),
+    )
+
+    def __init__(self, position: Q_Vector3d, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), material: Material = None):
+        # Either the surface values or a ready made Material; the registered, shared Material and its id are kept
         self.position = position
-        self.ambient = ambient
-        self.diffuse = diffuse
-        self.specular = specular
-        self.shininess = shininess
-        self.reflection = reflection
-        self.emission = emission
+        if material is None:
+            material = Material(ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
+        self._set_material(material=material)
+
+    def _set_material(self, material: Material) -> None:
+        # Holding the registered Material is what keeps its id taken
+        self.material_id = MATERIALS.register(material)
+        self._material = MATERIALS[self.material_id]
+
+    def __setstate__(self, state: dict) -> None:
+        # Material ids differ between processes, so take this process's id for the material that came along
+        self.__dict__.update(state)
+        self._set_material(material=self._material)
+
+    @property
+    def material(self) -> Material:
+        return self._material
+
+    @property
+    def ambient(self) -> Q_Vector3d:
+        return self._material.ambient
+
+    @property
+    def diffuse(self) -> Q_Vector3d:
+        return self._material.diffuse
+
+    @property
+    def specular(self) -> Q_Vector3d:
+        return self._material.specular
 
-        
+    @property
+    def shininess(self) -> float:
+        return self._material.shininess
 
-    def intersect(self, ray: Ray) -> Hit:
+    @property
+    def reflection(self) -> float:
+        return self._material.reflection
+
+    @property
+    def emission(self) -> Q_Vector3d:
+        return self._material.emission
+
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        # Returns None on a miss. When a Hit record is passed in it is filled in and returned instead of allocating a new one
         raise('Intersect function not implemented')
         return None
+
+    def hit_distance(self, ray: Ray) -> float:
+        # Distance to the closest hit, or math.inf. Subclasses override this to skip building a Hit
+        hit = self.intersect(ray=ray)
+        return hit.distance if hit else math.inf
+
+    def occludes(self, ray: Ray, max_distance: float) -> bool:
+        return self.hit_distance(ray=ray) < max_distance
+
+    @property
+    def is_emissive(self) -> bool:
+        return self._material.is_emissive
+
+    def translate(self, offset: Q_Vector3d) -> None:
+        # Move the primitive in place. Subclasses with more geometry than a position extend this
+        self.position = self.position + offset
+
+    def surface_area(self) -> float:
+        raise NotImplementedError('Surface area function not implemented')
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        # Point on the surface for two uniform numbers in [0, 1), uniformly distributed over its area
+        raise NotImplementedError('Surface sampling function not implemented')
+
+    def bounding_box(self) -> BoundingBox:
+        raise NotImplementedError('Bounding box function not implemented')
@@ -0,0 +1,69 @@
+import sys
+import time
+from datetime import timedelta
+
+
+class Progress:
+    """
+    One progress line for a render, updated by the parent process as tiles
+    come back from the workers, so workers never write to the terminal
+    themselves. Each update adds the pixels and rays of a finished piece of
+    work; the line shows how far along the render is, its rays per second and
+    the time left at the rate so far.
+
+    On a terminal the line is redrawn in place at most every interval seconds.
+    Other streams (log files, pipes) get a full line every 10 seconds instead.
+    A quiet Progress counts but never writes.
+    """
+
+    def __init__(self, total: int = None, label: str = 'Rendering', quiet: bool = False, stream=None, interval: float = 0.25):
+        self.total = total
+        self.label = label
+        self.quiet = quiet
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval if self.stream.isatty() else max(interval, 10.0)
+        self.done = 0
+        self.rays = 0
+        self._start = time.perf_counter()
+        self._last_draw = -float('inf')
+        self._width = 0
+
+    def update(self, done: int, rays: int = 0) -> None:
+        self.done += done
+        self.rays += rays
+        if not self.quiet and time.perf_counter() - self._last_draw >= self.interval:
+            self._draw()
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self._start
+        rays_per_second = self.rays / elapsed if elapsed > 0 else 0.0
+        if not self.total:
+            return f'{self.label}: {self.done} px, {rays_per_second:,.0f} rays/s, {timedelta(seconds=round(elapsed))} elapsed'
+        remaining = elapsed * (self.total - self.done) / self.done if self.done else None
+        eta = timedelta(seconds=round(remaining)) if remaining is not None else '?'
+        return f'{self.label}: {self.done / self.total:6.1%} {self.done}/{self.total} px, {rays_per_second:,.0f} rays/s, ETA {eta}'
+
+    def _draw(self) -> None:
+        self._last_draw = time.perf_counter()
+        line = self.line()
+        if self.stream.isatty():
+            # Pad over whatever is left of a longer previous line
+            self.stream.write('\r' + line.ljust(self._width))
+            self._width = len(line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def close(self) -> None:
+        if self.quiet:
+            return
+        self._draw()
+        if self.stream.isatty():
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def __enter__(self) -> 'Progress':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,34 @@
+"""
+State kept by each Pool worker process between tasks.
+
+initialize is the Pool initializer (see Scene.worker_pool): it receives the
+scene once, when the worker starts, and every task after that refers to this
+copy instead of carrying the scene with it, so a task is only the tile and the
+render settings. For frame sequences a task also carries the state of every
+frame up to its own, merged (see Scene.merge_frame), which the worker applies
+to its copy the first time it sees that frame, whichever frames it skipped.
+"""
+
+_SCENE = None
+_FRAME_NUMBER = None
+
+
+def initialize(scene) -> None:
+    global _SCENE, _FRAME_NUMBER
+    _SCENE = scene
+    _FRAME_NUMBER = None
+
+
+def render_tile(arguments: tuple) -> tuple:
+    # arguments are those of Scene._render_tile_task
+    return _SCENE._render_tile_task(arguments)
+
+
+def render_frame_tile(arguments: tuple) -> tuple:
+    # arguments is (frame number, merged frame state, Scene._render_tile_task arguments)
+    global _FRAME_NUMBER
+    frame_number, frame, tile_arguments = arguments
+    if frame_number != _FRAME_NUMBER:
+        _SCENE.apply_frame(frame=frame)
+        _FRAME_NUMBER = frame_number
+    return _SCENE._render_tile_task(tile_arguments)
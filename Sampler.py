@@ -0,0 +1,204 @@
+import functools
+
+import numpy as np
+
+SAMPLERS = ('sobol', 'halton', 'blue-noise', 'grid')
+
+
+class Sampler:
+    """
+    Sample positions in [0, 1)^2 for everything the renderer integrates over:
+    dimension 0 is the pixel footprint (anti aliasing offsets), dimension d >= 1
+    the light samples of the hit at bounce d, and -d the Russian roulette decision
+    after bounce d, drawn afresh for every sample of the pixel. Other dimensions
+    are free for any further per bounce decision.
+
+    Each kind has one base point set per sample count. A pixel does not use it
+    as it is but one of a few dozen scrambled copies of it, chosen per pixel,
+    dimension and sample number, so neighbouring pixels see different sample
+    positions and the error shows up as fine noise instead of bands, and every
+    sample of a pixel (anti aliasing offset or progressive pass) adds new ones:
+
+        sobol       (0, 2) sequence, random digit scrambled (an XOR of every point) per pattern
+        halton      bases 2 and 3, Cranley-Patterson rotated (shifted modulo 1) per pattern
+        blue-noise  unscrambled sobol points, rotated by a 7 x 7 grid of shifts that a pair
+                    of void-and-cluster masks hand out so nearby pixels get distant shifts
+        grid        the regular grid at the cell centres, the same for every pixel
+
+    table(count) holds every pattern at once, so a batch of rays gathers its
+    samples with one fancy index.
+    """
+
+    PATTERNS = 64
+    MASK_SIZE = 32
+    # Blue noise shifts are multiples of 1 / 7 on each axis, which no power of two sized net maps onto itself
+    ROTATIONS_PER_AXIS = 7
+
+    def __init__(self, kind: str = 'sobol', seed: int = 0):
+        if kind not in SAMPLERS:
+            raise ValueError(f'Unknown sampler {kind!r}, expected one of {", ".join(SAMPLERS)}')
+        self.kind = kind
+        self.seed = seed
+        self._tables = {}
+
+    @property
+    def patterns(self) -> int:
+        if self.kind == 'grid':
+            return 1
+        return Sampler.ROTATIONS_PER_AXIS ** 2 if self.kind == 'blue-noise' else Sampler.PATTERNS
+
+    def table(self, count: int) -> np.ndarray:
+        # (patterns, count, 2) sample positions, every pattern's count points
+        if count not in self._tables:
+            if self.kind == 'grid':
+                side = int(np.ceil(np.sqrt(count)))
+                cells = np.arange(count)
+                self._tables[count] = np.stack(((cells // side + 0.5) / side, (cells % side + 0.5) / side), axis=1)[np.newaxis]
+            elif self.kind == 'halton':
+                rotations = np.random.default_rng(self.seed).random((Sampler.PATTERNS, 1, 2))
+                self._tables[count] = (halton(count)[np.newaxis] + rotations) % 1.0
+            elif self.kind == 'sobol':
+                scrambles = np.random.default_rng(self.seed).integers(0, 1 << 32, size=(Sampler.PATTERNS, 1, 2), dtype=np.uint64)
+                self._tables[count] = (sobol_integers(count)[np.newaxis] ^ scrambles).astype(np.float64) / float(1 << 32)
+            else:
+                per_axis = Sampler.ROTATIONS_PER_AXIS
+                steps = np.arange(self.patterns)
+                rotations = (np.stack((steps // per_axis, steps % per_axis), axis=1)[:, np.newaxis] + 0.5) / per_axis
+                self._tables[count] = (sobol_integers(count).astype(np.float64)[np.newaxis] / float(1 << 32) + rotations) % 1.0
+        return self._tables[count]
+
+    def pattern(self, x: int, y: int, dimension: int, sample: int = 0) -> int:
+        return int(self.pixel_patterns(xs=np.array([x]), ys=np.array([y]), dimension=dimension, samples=sample)[0])
+
+    def pixel_patterns(self, xs: np.ndarray, ys: np.ndarray, dimension: int, samples=0) -> np.ndarray:
+        # Which pattern of table() each pixel uses for a dimension and sample number (one for all or one per pixel)
+        if self.kind == 'grid':
+            return np.zeros(len(xs), dtype=np.int64)
+        if self.kind == 'blue-noise':
+            size = Sampler.MASK_SIZE
+            # Each dimension and sample reads the masks at its own toroidal offset, so they do not repeat one another
+            samples = np.asarray(samples, dtype=np.int64)
+            rows = (np.asarray(ys, dtype=np.int64) + 11 * dimension + 5 * samples) % size
+            columns = (np.asarray(xs, dtype=np.int64) + 19 * dimension + 23 * samples) % size
+            u_mask, v_mask = blue_noise_mask(size=size, seed=self.seed), blue_noise_mask(size=size, seed=self.seed + 1)
+            per_axis = Sampler.ROTATIONS_PER_AXIS
+            return u_mask[rows, columns] * per_axis // (size * size) * per_axis + v_mask[rows, columns] * per_axis // (size * size)
+        return _hash(np.asarray(xs, dtype=np.uint64), np.asarray(ys, dtype=np.uint64), dimension, self.seed, samples=samples).astype(np.int64) % Sampler.PATTERNS
+
+    def value(self, x: int, y: int, dimension: int, sample: int = 0) -> float:
+        return float(self.pixel_values(xs=np.array([x]), ys=np.array([y]), dimension=dimension, samples=sample)[0])
+
+    def pixel_values(self, xs: np.ndarray, ys: np.ndarray, dimension: int, samples=0) -> np.ndarray:
+        # One uniform number in [0, 1) per pixel and sample number (one for all or one per pixel) for a single yes / no decision, hashed whatever the kind so even grid pixels differ
+        return _hash(np.asarray(xs, dtype=np.uint64), np.asarray(ys, dtype=np.uint64), dimension, self.seed + 1, samples=samples).astype(np.float64) / float(1 << 32)
+
+    def samples(self, count: int, x: int, y: int, dimension: int, sample: int = 0) -> np.ndarray:
+        # (count, 2) positions of one pixel, for scalar code
+        return self.table(count)[self.pattern(x=x, y=y, dimension=dimension, sample=sample)]
+
+    def __getstate__(self) -> dict:
+        # The tables are cheap to rebuild, leave them out of the copy sent to worker processes
+        return {'kind': self.kind, 'seed': self.seed, '_tables': {}}
+
+
+def _hash(xs: np.ndarray, ys: np.ndarray, dimension: int, seed: int, samples=0) -> np.ndarray:
+    # 32 bit integer mix of pixel, dimension, seed and sample number
+    mask = np.uint64(0xFFFFFFFF)
+    h = (xs * np.uint64(0x9E3779B1) + ys * np.uint64(0x85EBCA77) + np.asarray(samples, dtype=np.uint64) * np.uint64(0x27D4EB2F) + np.uint64(((dimension * 0xC2B2AE3D) + seed) & 0xFFFFFFFF)) & mask
+    h ^= h >> np.uint64(15)
+    h = (h * np.uint64(0x2C1B3C6D)) & mask
+    h ^= h >> np.uint64(12)
+    h = (h * np.uint64(0x297A2D39)) & mask
+    h ^= h >> np.uint64(15)
+    return h
+
+
+def _radical_inverse(indices: np.ndarray, base: int) -> np.ndarray:
+    result = np.zeros(len(indices))
+    scale = 1.0 / base
+    indices = indices.copy()
+    while indices.any():
+        result += (indices % base) * scale
+        indices //= base
+        scale /= base
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def halton(count: int) -> np.ndarray:
+    # (count, 2) Halton points in bases 2 and 3, skipping the point at the origin
+    indices = np.arange(1, count + 1)
+    points = np.stack((_radical_inverse(indices, 2), _radical_inverse(indices, 3)), axis=1)
+    points.flags.writeable = False
+    return points
+
+
+@functools.lru_cache(maxsize=None)
+def sobol_integers(count: int) -> np.ndarray:
+    """
+    (count, 2) first two Sobol dimensions as 32 bit integers: the base 2 van der Corput
+    sequence and the dimension with primitive polynomial x + 1. Kept as integers so
+    scrambling is a plain XOR.
+    """
+    directions = np.zeros((32, 2), dtype=np.uint64)
+    directions[:, 0] = [1 << (31 - bit) for bit in range(32)]
+    directions[0, 1] = 1 << 31
+    for bit in range(1, 32):
+        directions[bit, 1] = directions[bit - 1, 1] ^ (directions[bit - 1, 1] >> np.uint64(1))
+    indices = np.arange(count, dtype=np.uint64)
+    points = np.zeros((count, 2), dtype=np.uint64)
+    for bit in range(32):
+        if not (indices >> np.uint64(bit)).any():
+            break
+        chosen = ((indices >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+        points[chosen] ^= directions[bit]
+    points.flags.writeable = False
+    return points
+
+
+@functools.lru_cache(maxsize=None)
+def blue_noise_mask(size: int = 32, sigma: float = 1.5, seed: int = 0) -> np.ndarray:
+    """
+    (size, size) ranks 0 .. size^2 - 1 from Ulichney's void-and-cluster method, tiling
+    seamlessly. Every threshold of the ranks picks pixels spread evenly over the tile,
+    so neighbouring pixels hold distant values.
+    """
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(distance[:, np.newaxis] ** 2 + distance[np.newaxis, :] ** 2) / (2 * sigma ** 2))
+
+    def splat(index: int) -> np.ndarray:
+        return np.roll(kernel, divmod(index, size), axis=(0, 1)).ravel()
+
+    rng = np.random.default_rng(seed)
+    pattern = np.zeros(size * size, dtype=bool)
+    pattern[rng.choice(size * size, size * size // 10, replace=False)] = True
+    energy = np.real(np.fft.ifft2(np.fft.fft2(pattern.reshape(size, size)) * np.fft.fft2(kernel))).ravel()
+
+    # Move the tightest cluster into the largest void until that changes nothing
+    while True:
+        cluster = int(np.argmax(np.where(pattern, energy, -np.inf)))
+        pattern[cluster] = False
+        energy -= splat(cluster)
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        energy += splat(void)
+        if void == cluster:
+            break
+
+    ranks = np.zeros(size * size, dtype=np.int64)
+    ones = int(pattern.sum())
+    # Rank the initial points by taking away tightest clusters, then fill the voids for the rest
+    remaining, remaining_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = int(np.argmax(np.where(remaining, remaining_energy, -np.inf)))
+        remaining[cluster] = False
+        remaining_energy -= splat(cluster)
+        ranks[cluster] = rank
+    for rank in range(ones, size * size):
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        energy += splat(void)
+        ranks[void] = rank
+    ranks = ranks.reshape(size, size)
+    ranks.flags.writeable = False
+    return ranks
@@ -1,71 +1,498 @@
+import contextlib
 import math
+import os
+import random
+import time
+import warnings
 from datetime import datetime as dt
 from multiprocessing import Pool, cpu_count
 
-import matplotlib.pyplot as plt
 import numpy as np
 
+from AccumulationBuffer import AccumulationBuffer
+from BoundingBox import inverse_direction
+from BVH import BVH
+from Camera import Camera
+from FrameBuffer import FRAMEBUFFER_DTYPES, SharedFrameBuffer
+from ImageWriter import ImageWriter, heatmap, write_image
+from Kernels import KERNEL_BACKENDS, KernelScene, numba
+from Instrumentation import Instrumentation, format_statistics, merge_statistics
+from Progress import Progress
+from LightRegistry import LightRegistry
+from Material import MATERIALS
 from OrthoNormalBasis import OrthoNormalBasis
-from QFunctions.Q_Functions import Q_buckets, Q_map, Q_Vector3d
+from PacketRenderer import PacketRenderer
+from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
 from Primitive import Primitive
+import RenderWorker
+from Sampler import Sampler
 from Hit import Hit
+from TileScheduler import Tile, generate_tiles, order_tiles
 
 
 class Scene:
-    def __init__(self, camera_position: Q_Vector3d, objects: list = [], lights: list = []):
-        self.camera_position = camera_position
+
+    # Adaptive anti aliasing: a pixel is refined when it differs from a neighbour by more than the
+    # threshold, and keeps taking samples until the standard error of its mean drops below it
+    ADAPTIVE_THRESHOLD = 0.05
+    ADAPTIVE_BATCH = 4
+
+    # 'lights' aims shadow rays at points sampled over every emissive primitive (see LightRegistry),
+    # 'cone' wobbles them in a narrow cone around the first entry of lights, as the renderer always did
+    LIGHT_SAMPLING = ('lights', 'cone')
+
+    # Half angle of the cone shadow rays are spread over in 'cone' mode
+    CONE_THETA = math.pi / 56.0
+
+    # Paths stop once their throughput drops below MIN_THROUGHPUT, and from ROULETTE_DEPTH on (off by default)
+    # survive each further bounce with probability equal to their throughput
+    MIN_THROUGHPUT = 1 / 1024
+    ROULETTE_DEPTH = None
+
+    # Anti aliasing takes this many samples per pixel, on the fixed 3 x 3 grid or from the sampler
+    ANTI_ALIASING_SAMPLES = 9
+
+    def __init__(self, camera_position: Q_Vector3d = None, objects: list = [], lights: list = [], use_bvh: bool = True, camera: Camera = None, light_sampling: str = 'lights', light_weighting: str = 'power', sampler: str = 'sobol', backend: str = 'python'):
+        if light_sampling not in Scene.LIGHT_SAMPLING:
+            raise ValueError(f'Unknown light sampling {light_sampling!r}, expected one of {", ".join(Scene.LIGHT_SAMPLING)}')
+        # A bare camera_position gets the original fixed camera looking through the z = 0 plane
+        self.camera = camera if camera is not None else Camera(position=camera_position)
         self.objects = objects
         self.lights = lights
+        # Held here so pickling the scene for worker processes carries the materials its objects refer to
+        self.materials = MATERIALS
+        self.use_bvh = use_bvh
+        # Workers count and time what each tile does when set, see Instrumentation
+        self.instrument = False
+        # Closest hit and shadow rays traced by this copy of the scene, for progress reports
+        self.rays_traced = 0
+        # Bounce from which Russian roulette applies, None to always follow paths to max_depth
+        self.roulette_depth = Scene.ROULETTE_DEPTH
+        self.light_sampling = light_sampling
+        self.light_weighting = light_weighting
+        self.light_registry = None
+        self._light_samples = {}
+        self._cone_tables = {}
+        self._packet_renderer = None
+        self._kernel_scene = None
+        # 'numba' answers closest hit queries and shades hits with the compiled kernels of Kernels.py
+        self.backend = backend
+        self.sampler = Sampler(kind=sampler)
+        # Pixel the scalar path is tracing, which picks its sampler patterns
+        self._pixel = (0, 0)
+        # Number of the pixel's sample being traced, so each sample draws its own Russian roulette decisions
+        self._sample = 0
+        self.bvh = None
+        self.occluder_bvh = None
+        self.emitters = None
+        self.occluders = None
+        self._last_occluder = None
+        self._applied_offsets = {}
+
+    @property
+    def camera_position(self) -> Q_Vector3d:
+        return self.camera.position
+
+    @camera_position.setter
+    def camera_position(self, position: Q_Vector3d) -> None:
+        self.camera.set(position=position)
+
+    @property
+    def sampler(self) -> Sampler:
+        return self._sampler
+
+    @sampler.setter
+    def sampler(self, sampler: Sampler) -> None:
+        # Light samples are laid out by the sampler, so they are worked out again for a new one
+        self._sampler = sampler
+        self._light_samples = {}
+        self._cone_tables = {}
+        self._packet_renderer = None
+        self._kernel_scene = None
+
+    @property
+    def backend(self) -> str:
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend: str) -> None:
+        if backend not in KERNEL_BACKENDS:
+            raise ValueError(f'Unknown backend {backend!r}, expected one of {", ".join(KERNEL_BACKENDS)}')
+        if backend == 'numba' and numba is None:
+            warnings.warn('Numba is not installed, rendering with the python backend instead')
+            backend = 'python'
+        self._backend = backend
+        self._kernel_scene = None
+
+    def kernel_scene(self) -> KernelScene:
+        # The scene flattened for the numba backend, built on first use after the acceleration structure changes
+        if self._kernel_scene is None:
+            if self.emitters is None:
+                self.build_acceleration_structure()
+            self._kernel_scene = KernelScene(scene=self)
+        return self._kernel_scene
+
+    def build_acceleration_structure(self) -> None:
+        # Built once before rendering so the trees are pickled to the workers with the scene
+        self.emitters = [object for object in self.objects if object.is_emissive]
+        self.occluders = [object for object in self.objects if not object.is_emissive]
+        self.light_registry = LightRegistry(emitters=self.emitters, weighting=self.light_weighting)
+        self._light_samples = {}
+        self._last_occluder = None
+        self._packet_renderer = None
+        self._kernel_scene = None
+        if not self.use_bvh or not self.objects:
+            self.bvh = None
+            self.occluder_bvh = None
+            return
+        self.bvh = BVH.from_bounding_boxes([object.bounding_box() for object in self.objects])
+        self._bvh_objects = [self.objects[index] for index in self.bvh.indices.tolist()]
+        self.occluder_bvh = BVH.from_bounding_boxes([object.bounding_box() for object in self.occluders]) if self.occluders else None
+        self._occluder_bvh_objects = [self.occluders[index] for index in self.occluder_bvh.indices.tolist()] if self.occluders else []
+
+    def refit_acceleration_structure(self) -> None:
+        # Objects have moved but none were added or removed, so keep both trees and only update their bounds
+        self._light_samples = {}
+        self._last_occluder = None
+        self._packet_renderer = None
+        self._kernel_scene = None
+        if self.bvh is None:
+            if self.emitters is None and self.use_bvh:
+                self.build_acceleration_structure()
+            return
+        self.bvh.refit_bounding_boxes([object.bounding_box() for object in self.objects])
+        if self.occluder_bvh is not None:
+            self.occluder_bvh.refit_bounding_boxes([object.bounding_box() for object in self.occluders])
+
+    def apply_frame(self, frame: dict) -> None:
+        """
+        Puts the scene into the state of one animation frame:
+            'camera': keyword arguments for Camera.set
+            'offsets': {index into objects: translation from where the object started}
+            'lights': replacement for the lights list
+        Offsets are measured from where each object started, but a frame only changes the camera
+        settings and objects it lists and leaves the rest as the frames before it left them. A scene
+        that may have missed frames needs the merged state of every frame so far (see merge_frame).
+        """
+        if frame.get('camera'):
+            self.camera.set(**frame['camera'])
+        if 'lights' in frame:
+            self.lights = frame['lights']
+        moved = False
+        for index, offset in frame.get('offsets', {}).items():
+            applied = self._applied_offsets.get(index, Q_Vector3d(0, 0, 0))
+            if offset != applied:
+                self.objects[index].translate(offset=offset - applied)
+                self._applied_offsets[index] = offset
+                moved = True
+        if moved:
+            self.refit_acceleration_structure()
+        elif frame.get('camera') or 'lights' in frame:
+            self._packet_renderer = None
+            self._kernel_scene = None
+
+    @staticmethod
+    def merge_frame(state: dict, frame: dict) -> dict:
+        # The frame state equivalent to applying state and then frame: camera settings and offsets add up, lights are replaced
+        merged = {'camera': {**state.get('camera', {}), **frame.get('camera', {})}, 'offsets': {**state.get('offsets', {}), **frame.get('offsets', {})}}
+        if 'lights' in frame or 'lights' in state:
+            merged['lights'] = frame['lights'] if 'lights' in frame else state['lights']
+        return merged
+
+    def light_samples(self, lighting_samples: int) -> list:
+        # LightRegistry.samples of every sampler pattern for the current light positions, worked out once per sample count
+        if self.emitters is None:
+            self.build_acceleration_structure()
+        if lighting_samples not in self._light_samples:
+            table = self.sampler.table(lighting_samples * lighting_samples)
+            self._light_samples[lighting_samples] = [self.light_registry.samples(points=points.tolist()) for points in table]
+        return self._light_samples[lighting_samples]
+
+    def cone_table(self, lighting_samples: int) -> np.ndarray:
+        # (patterns, lighting_samples ** 2, 3) OrthoNormalBasis.cone_table of every sampler pattern
+        if lighting_samples not in self._cone_tables:
+            self._cone_tables[lighting_samples] = OrthoNormalBasis.cone_table(cone_theta=Scene.CONE_THETA, points=self.sampler.table(lighting_samples * lighting_samples))
+        return self._cone_tables[lighting_samples]
+
+    def nearest_intersection(self, ray: Ray) -> tuple[Primitive, Hit]:
+        self.rays_traced += 1
+        if self._backend == 'numba':
+            return self.kernel_scene().nearest_intersection(ray=ray)
+        if self.bvh is not None:
+            return self._nearest_intersection_bvh(ray=ray)
+        return self._nearest_intersection_linear(ray=ray)
 
-    def nearest_intersection(self, ray: Ray) -> tuple[Primitive, Hit]:  # Could this be optimized by asking "does a ray of length(this_distance so far) intersect this object" ?
+    def _nearest_intersection_bvh(self, ray: Ray) -> tuple[Primitive, Hit]:
+        bvh_objects = self._bvh_objects
+        # [scratch, best]: primitives fill the scratch record and it swaps with best on an improvement
+        records = [Hit(), None]
+
+        def intersect_leaf(start: int, end: int, min_distance: float):
+            nearest = None
+            for index in range(start, end):
+                hit = bvh_objects[index].intersect(ray=ray, hit=records[0])
+                if hit and hit.distance < min_distance:
+                    min_distance = hit.distance
+                    records[0] = records[1] or Hit()
+                    records[1] = hit
+                    nearest = (min_distance, bvh_objects[index], hit)
+            return nearest
+
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        nearest = self.bvh.traverse(origin=origin, inverse_direction=inverse_direction(ray.direction), intersect_leaf=intersect_leaf)
+        if nearest is None:
+            return None, None
+        return nearest[1], nearest[2]
+
+    def _nearest_intersection_linear(self, ray: Ray) -> tuple[Primitive, Hit]:
         min_distance = math.inf
         obj = None
         nearest_hit = None
+        scratch = Hit()
         for object in self.objects:
-            hit = object.intersect(ray=ray)
+            hit = object.intersect(ray=ray, hit=scratch)
             if hit and hit.distance < min_distance:
                 obj = object
+                scratch = nearest_hit or Hit()
                 nearest_hit = hit
                 min_distance = hit.distance
         return obj, nearest_hit
 
-    @staticmethod
-    def write_ppm_file(image_data) -> None:
-        height = len(image_data)
-        width = len(image_data[0])
-        # PPM format
-        with open("image.ppm", "w") as pic:
-            pic.write(f"P3\n{width} {height}\n255\n")
-            for row in image_data:
-                for col in row:
-                    pic.write(f"{int(col[0] * 255)} {int(col[1] * 255)} {int(col[2] * 255)} ")
-                pic.write("\n")
-
-    def multi_render(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, cores_to_use: int = 1) -> None:
-        number_of_buckets = 10
+    def visible_emitter(self, ray: Ray) -> Primitive:
+        """
+        Shadow ray query: returns the emissive object the ray reaches first, or
+        None if the ray misses every emitter or something blocks it on the way.
+        Gives the same answer as checking nearest_intersection for emission, but
+        only the emitters need a closest hit; every other object only has to
+        answer "is there anything in the way", which stops at the first blocker.
+        """
+        self.rays_traced += 1
+        if self.emitters is None:
+            self.build_acceleration_structure()
+
+        light = None
+        light_distance = math.inf
+        for emitter in self.emitters:
+            distance = emitter.hit_distance(ray=ray)
+            if distance < light_distance:
+                light = emitter
+                light_distance = distance
+        if light is None:
+            return None
+
+        # Neighbouring shadow rays tend to be blocked by the same object, so try the last blocker first
+        if self._last_occluder is not None and self._last_occluder.occludes(ray=ray, max_distance=light_distance):
+            return None
+        occluder = self.find_occluder(ray=ray, max_distance=light_distance)
+        if occluder is not None:
+            self._last_occluder = occluder
+            return None
+        return light
+
+    def find_occluder(self, ray: Ray, max_distance: float) -> Primitive:
+        # Any non-emissive object hit closer than max_distance, or None
+        if self.occluder_bvh is None:
+            for object in self.occluders:
+                if object.occludes(ray=ray, max_distance=max_distance):
+                    return object
+            return None
+
+        occluder_objects = self._occluder_bvh_objects
+
+        def intersect_leaf(start: int, end: int, max_distance: float):
+            for index in range(start, end):
+                if occluder_objects[index].occludes(ray=ray, max_distance=max_distance):
+                    return occluder_objects[index]
+            return None
+
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        return self.occluder_bvh.any_hit(origin=origin, inverse_direction=inverse_direction(ray.direction), intersect_leaf=intersect_leaf, max_distance=max_distance)
+
+    def multi_render(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, cores_to_use: int = 1, packet: bool = False, tile_size: int = 16, tile_order: str = 'spiral', framebuffer_dtype: str = 'float64',
+                     adaptive: bool = False, max_samples: int = 16, adaptive_threshold: float = ADAPTIVE_THRESHOLD, output: tuple = ('image.png', 'image.ppm'), instrument: bool = False, quiet: bool = False) -> None:
+        # Every path in output (see ImageWriter for the formats) is written row by row while the render runs.
+        # instrument reports what the workers spent their time on and saves the time each tile took as tile_costs.png.
+        # quiet prints nothing, progress included
         cores_to_use = max(cores_to_use, 1) if cores_to_use != 0 else cpu_count()
-        pool = Pool(processes=cores_to_use)
-        arguments = [(width, height, max_depth, anti_aliasing, lighting_samples, {'start': start, 'end': end}) for start, end in Q_buckets(number_of_items=height, number_of_buckets=number_of_buckets)]
         start_time = dt.now()
-        print(f'Render started @ {width}x{height}x{lighting_samples}spp {"with anti aliasing " if anti_aliasing else ""}using {cores_to_use} cores at {start_time}.')
-        print()
-        output = [pool.apply_async(self.render, args=(*arg,)) for arg in arguments]
-        results = [o.get() for o in output]
-        print(f'Render completed in {dt.now() - start_time}.')
-        print('Saving image...')
-        image = np.zeros((height, width, 3))
-        for result in results:
-            image += result
-        plt.imsave('image.png', image)
-        Scene.write_ppm_file(image_data=image.tolist())
+        log = print if not quiet else lambda message: None
+        log(f'Render started @ {width}x{height}x{lighting_samples}spp {"with adaptive anti aliasing " if adaptive else "with anti aliasing " if anti_aliasing else ""}{"in packet mode " if packet else ""}using {cores_to_use} cores at {start_time}.')
+        with Progress(total=width * height, quiet=quiet) as progress:
+            self.render_tiles(width=width, height=height, max_depth=max_depth, anti_aliasing=anti_aliasing, lighting_samples=lighting_samples, cores_to_use=cores_to_use, packet=packet, tile_size=tile_size, tile_order=tile_order, framebuffer_dtype=framebuffer_dtype,
+                              adaptive=(max_samples, adaptive_threshold) if adaptive else None, output=output, instrument=instrument, progress=progress)
+        log(f'Render completed in {dt.now() - start_time}.')
+        log(f'{self.render_statistics["tiles"]} tiles, core utilisation {self.render_statistics["utilisation"]:.0%}.')
+        log(f'Image saved to {", ".join(output)}.')
+        if adaptive:
+            log(f'{self.render_statistics["samples_per_pixel"]:.2f} samples per pixel on average, heatmap saved to samples.png.')
+            Scene.write_heatmap(values=self.sample_counts, path='samples.png')
+        if instrument:
+            for line in format_statistics(merged=self.render_statistics['instrumentation'], wall_time=self.render_statistics['wall_time']):
+                log(line)
+            Scene.write_heatmap(values=self.tile_costs / max(float(self.tile_costs.max()), 1e-12), path='tile_costs.png')
+            log('Tile cost heatmap saved to tile_costs.png.')
 
-    def render(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, row_range: dict = {}) -> np.array:
-        image = np.zeros((height, width, 3))
-        self.lighting_samples = lighting_samples
-        SCREEN_RATIO = float(width) / float(height)
-        SCREEN_DIMS = {'left': -1, 'top': 1 / SCREEN_RATIO, 'right': 1, 'bottom': -1 / SCREEN_RATIO}
+    @staticmethod
+    def write_heatmap(values: np.ndarray, path: str) -> None:
+        write_image(path=path, image=heatmap(values=values), bit_depth=8)
+
+    def render_sequence(self, frames: list, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, cores_to_use: int = 1, packet: bool = False, tile_size: int = 16, tile_order: str = 'spiral',
+                        output: str = 'frame_{:04d}.png', framebuffer_dtype: str = 'float64') -> list:
+        """
+        Renders one image per frame state in frames (see apply_frame). One pool serves the whole
+        sequence: each worker receives the scene once, from the pool initializer, and after that only
+        the frame states, which it applies to its own copy, refitting rather than rebuilding the BVH.
+        A worker may get no tiles of some frames, so every task carries the state merged over all
+        frames so far rather than the frame alone.
+        Frames are saved to output.format(frame number); returns the file names, or the images
+        themselves when output is None. The scene is left in the state of the last frame.
+        """
+        if framebuffer_dtype not in FRAMEBUFFER_DTYPES:
+            raise ValueError(f'Unknown framebuffer dtype {framebuffer_dtype!r}, expected one of {", ".join(FRAMEBUFFER_DTYPES)}')
+        cores_to_use = max(cores_to_use, 1) if cores_to_use != 0 else cpu_count()
+        self.build_acceleration_structure()
+        tiles = generate_tiles(width=width, height=height, tile_size=tile_size)
+        framebuffer = SharedFrameBuffer(width=width, height=height, dtype=framebuffer_dtype)
+        results = []
+        start_time = time.perf_counter()
+        try:
+            with self.worker_pool(cores_to_use=cores_to_use) as pool:
+                state = {}
+                for frame_number, frame in enumerate(frames):
+                    self.apply_frame(frame=frame)
+                    state = Scene.merge_frame(state=state, frame=frame)
+                    ordered = order_tiles(tiles=tiles, width=width, height=height, order=tile_order,
+                                          estimate_cost=lambda tile: self.estimate_tile_cost(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, tile=tile))
+                    arguments = [(frame_number, state, (width, height, max_depth, anti_aliasing, lighting_samples, tile, packet, framebuffer, None, None, 0)) for tile in ordered]
+                    for _ in pool.imap_unordered(RenderWorker.render_frame_tile, arguments, chunksize=1):
+                        pass
+                    if output is None:
+                        results.append(framebuffer.to_array())
+                    else:
+                        results.append(output.format(frame_number))
+                        write_image(path=results[-1], image=framebuffer.array)
+        finally:
+            framebuffer.close()
+        wall_time = time.perf_counter() - start_time
+        self.sequence_statistics = {'frames': len(results), 'cores': cores_to_use, 'wall_time': wall_time, 'frames_per_second': len(results) / wall_time if wall_time > 0 else 0.0}
+        return results
+
+    def worker_pool(self, cores_to_use: int) -> Pool:
+        """
+        Pool whose workers each hold a copy of this scene, handed over once by the pool initializer
+        (inherited outright where workers are forked), so tasks sent to RenderWorker only carry tiles.
+        Changes made to the scene after the pool starts are not seen by its workers.
+        """
+        if self.emitters is None:
+            self.build_acceleration_structure()
+        return Pool(processes=cores_to_use, initializer=RenderWorker.initialize, initargs=(self,))
+
+    def render_tiles(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, cores_to_use: int = 1, packet: bool = False, tile_size: int = 16, tile_order: str = 'spiral', shared_framebuffer: bool = True, framebuffer_dtype: str = 'float64', offsets: dict = None, pool: Pool = None, adaptive: tuple = None,
+                     output: tuple = (), instrument: bool = False, progress: Progress = None, first_sample: int = 0) -> np.array:
+        # adaptive is (max_samples, threshold) to supersample only where needed, see render_tile_adaptive. Each
+        # tile goes to the ImageWriter of every path in output as it finishes, which writes rows out once it can (see ImageWriter).
+        # With instrument the workers started here gather Instrumentation statistics (a pool passed in keeps the setting it started with).
+        # Every finished tile's pixels and rays are added to progress. The acceleration structure is built on the first
+        # render only, as the workers of a pool passed in keep their own copies; call build_acceleration_structure after changing objects.
+        # first_sample numbers the first of the samples (offsets), so every pass of a progressive render draws its own Russian roulette decisions
+        if framebuffer_dtype not in FRAMEBUFFER_DTYPES:
+            raise ValueError(f'Unknown framebuffer dtype {framebuffer_dtype!r}, expected one of {", ".join(FRAMEBUFFER_DTYPES)}')
+        if self.emitters is None:
+            self.build_acceleration_structure()
+        self.instrument = instrument
+        tiles = order_tiles(tiles=generate_tiles(width=width, height=height, tile_size=tile_size), width=width, height=height, order=tile_order,
+                            estimate_cost=lambda tile: self.estimate_tile_cost(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, tile=tile))
+        # Workers write straight into the shared framebuffer and only send back which tile they finished
+        framebuffer = SharedFrameBuffer(width=width, height=height, dtype=framebuffer_dtype) if shared_framebuffer else None
+        image = framebuffer.array if framebuffer is not None else np.zeros((height, width, 3), dtype=framebuffer_dtype)
+        self.sample_counts = np.zeros((height, width), dtype=np.int64)
+        # Seconds per pixel of the tile each pixel belongs to
+        self.tile_costs = np.zeros((height, width))
+        arguments = [(width, height, max_depth, anti_aliasing, lighting_samples, tile, packet, framebuffer, offsets, adaptive, first_sample) for tile in tiles]
+        tile_statistics = []
+        busy_time = 0.0
+        start_time = time.perf_counter()
+        # A caller rendering several passes can hand in its own pool (from worker_pool) rather than starting one per pass
+        owns_pool = pool is None
+        pool = self.worker_pool(cores_to_use=cores_to_use) if owns_pool else pool
+        try:
+            with contextlib.ExitStack() as writers:
+                # The writers read finished rows back from image, so under any tile order the image is only held once
+                writers = [writers.enter_context(ImageWriter(path=path, width=width, height=height, source=image)) for path in output]
+                # Tiles are handed out one at a time from the pool's shared queue, so a worker that
+                # finishes early keeps pulling tiles instead of waiting on a fixed share of the rows
+                for tile, pixels, samples, elapsed, rays, statistics in pool.imap_unordered(RenderWorker.render_tile, arguments, chunksize=1):
+                    if pixels is not None:
+                        image[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] = pixels
+                    self.sample_counts[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] = samples
+                    self.tile_costs[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] = elapsed / (tile.width * tile.height)
+                    busy_time += elapsed
+                    if statistics is not None:
+                        tile_statistics.append(statistics)
+                    if progress is not None:
+                        progress.update(done=tile.width * tile.height, rays=rays)
+                    for writer in writers:
+                        writer.write_tile(tile=tile, pixels=image[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width])
+            if framebuffer is not None:
+                image = framebuffer.to_array()
+        finally:
+            if owns_pool:
+                pool.terminate()
+            if framebuffer is not None:
+                framebuffer.close()
+        wall_time = time.perf_counter() - start_time
+        self.render_statistics = {'tiles': len(tiles), 'cores': cores_to_use, 'wall_time': wall_time, 'busy_time': busy_time, 'utilisation': busy_time / (wall_time * cores_to_use) if wall_time > 0 else 0.0,
+                                 'samples_per_pixel': float(self.sample_counts.mean()) if self.sample_counts.size else 0.0,
+                                 'instrumentation': merge_statistics(results=tile_statistics) if tile_statistics else None}
+        return image
 
+    def _render_tile_task(self, arguments: tuple) -> tuple:
+        # Returns the tile, its pixels (None once written to framebuffer), samples per pixel, seconds taken, rays traced and Instrumentation statistics or None
+        if self.instrument:
+            with Instrumentation(scene=self) as instrumentation:
+                tile, pixels, samples, elapsed, rays, _ = self._render_tile(arguments=arguments)
+            return tile, pixels, samples, elapsed, rays, instrumentation.result()
+        return self._render_tile(arguments=arguments)
+
+    def _render_tile(self, arguments: tuple) -> tuple:
+        width, height, max_depth, anti_aliasing, lighting_samples, tile, packet, framebuffer, offsets, adaptive, first_sample = arguments
+        start_time = time.perf_counter()
+        rays_traced = self.rays_traced
+        if adaptive is not None:
+            max_samples, threshold = adaptive
+            pixels, samples = self.render_tile_adaptive(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, tile=tile, max_samples=max_samples, threshold=threshold, packet=packet)
+        else:
+            render_function = self.render_packet_tile if packet else self.render_tile
+            pixels = render_function(width=width, height=height, max_depth=max_depth, anti_aliasing=anti_aliasing, lighting_samples=lighting_samples, tile=tile, offsets=offsets, first_sample=first_sample)
+            samples = len(offsets or Scene.anti_aliasing_offsets(width=width, height=height, anti_aliasing=anti_aliasing))
+        if framebuffer is not None:
+            framebuffer.write_tile(tile=tile, pixels=pixels)
+            pixels = None
+        return tile, pixels, samples, time.perf_counter() - start_time, self.rays_traced - rays_traced, None
+
+    def estimate_tile_cost(self, width: int, height: int, max_depth: int, lighting_samples: int, tile: Tile) -> float:
+        # Follow a few probe rays through their reflections and count the rays they would spawn
+        cost = 0
+        probes = ((tile.x, tile.y), (tile.x + tile.width - 1, tile.y), (tile.x, tile.y + tile.height - 1), (tile.x + tile.width - 1, tile.y + tile.height - 1), (tile.x + tile.width // 2, tile.y + tile.height // 2))
+        for x, y in probes:
+            ray = self.primary_ray(x=x, y=y, width=width, height=height)
+            for _ in range(max_depth):
+                cost += 1
+                nearest_object, object_hit = self.nearest_intersection(ray=ray)
+                if nearest_object is None:
+                    break
+                cost += lighting_samples ** 2
+                if nearest_object.reflection == 0:
+                    break
+                ray = Ray(origin=object_hit.position + object_hit.normal_to_surface * 1e-5, direction=ray.direction.reflected(other_vector=object_hit.normal_to_surface))
+        return cost
+
+    def primary_ray(self, x: int, y: int, width: int, height: int, offset: tuple = (0, 0)) -> Ray:
+        return self.camera.primary_ray(x=x, y=y, width=width, height=height, offset=offset)
+
+    @staticmethod
+    def anti_aliasing_offsets(width: int, height: int, anti_aliasing: bool) -> dict:
         ###############################
         #   Anti-aliasing offsets
         #       _____________
@@ -80,18 +507,87 @@ class Scene:
         if anti_aliasing:
             ANTI_ALIASING_X = 1 / (2 * width)
             ANTI_ALIASING_Y = 1 / (2 * height)
-            ANTI_ALIASING_OFFSETS = {'top-left': (-1 * ANTI_ALIASING_X, ANTI_ALIASING_Y),
-                                     'top': (0, ANTI_ALIASING_Y),
-                                     'top-right': (ANTI_ALIASING_X, ANTI_ALIASING_Y),
-                                     'left': (-1 * ANTI_ALIASING_X, 0),
-                                     'center': (0, 0),
-                                     'right': (ANTI_ALIASING_X, 0),
-                                     'bottom-left': (-1 * ANTI_ALIASING_X, - 1 * ANTI_ALIASING_Y),
-                                     'bottom': (0, -1 * ANTI_ALIASING_Y),
-                                     'bottom-right': (ANTI_ALIASING_X, - 1 * ANTI_ALIASING_Y)}
-        else:
-            ANTI_ALIASING_OFFSETS = {'center': (0, 0)}
+            return {'top-left': (-1 * ANTI_ALIASING_X, ANTI_ALIASING_Y),
+                    'top': (0, ANTI_ALIASING_Y),
+                    'top-right': (ANTI_ALIASING_X, ANTI_ALIASING_Y),
+                    'left': (-1 * ANTI_ALIASING_X, 0),
+                    'center': (0, 0),
+                    'right': (ANTI_ALIASING_X, 0),
+                    'bottom-left': (-1 * ANTI_ALIASING_X, - 1 * ANTI_ALIASING_Y),
+                    'bottom': (0, -1 * ANTI_ALIASING_Y),
+                    'bottom-right': (ANTI_ALIASING_X, - 1 * ANTI_ALIASING_Y)}
+        return {'center': (0, 0)}
+
+    def sampled_offsets(self, width: int, height: int, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        # (len(xs), ANTI_ALIASING_SAMPLES, 2) per pixel anti aliasing offsets from the sampler, over the footprint of the fixed grid
+        table = self.sampler.table(Scene.ANTI_ALIASING_SAMPLES)
+        return (table[self.sampler.pixel_patterns(xs=xs, ys=ys, dimension=0)] - 0.5) * np.array([3 / (2 * width), 3 / (2 * height)])
+
+    @staticmethod
+    def progressive_offsets(width: int, height: int, pass_index: int) -> dict:
+        # The first nine passes walk the anti aliasing grid, centre first, so nine passes match an anti aliased render.
+        # Later passes jitter across the same area, seeded by the pass so a resumed render repeats them exactly
+        grid = Scene.anti_aliasing_offsets(width=width, height=height, anti_aliasing=True)
+        names = ['center'] + [name for name in grid if name != 'center']
+        if pass_index < len(names):
+            return {names[pass_index]: grid[names[pass_index]]}
+        rng = random.Random(pass_index)
+        return {'jitter': ((rng.random() - 0.5) * 3 / (2 * width), (rng.random() - 0.5) * 3 / (2 * height))}
 
+    def progressive_render(self, width: int, height: int, max_depth: int = 1, lighting_samples: int = 1, cores_to_use: int = 1, packet: bool = False, tile_size: int = 16, tile_order: str = 'spiral',
+                           target_samples: int = None, time_budget: float = None, checkpoint_path: str = 'render_checkpoint.npz', checkpoint_interval: float = 60.0, preview_path: str = 'image.png', resume: bool = True, quiet: bool = False) -> np.array:
+        """
+        Renders the image in passes of one sample per pixel, accumulating them until target_samples
+        passes are done or time_budget seconds have gone (checked between passes). Every
+        checkpoint_interval seconds, and at the end, the accumulation buffer is saved to
+        checkpoint_path and a preview to preview_path. An existing checkpoint for the same
+        settings is picked up where it stopped. With no stop condition it renders nine passes.
+        Progress is reported on one line unless quiet.
+        """
+        if target_samples is None and time_budget is None:
+            target_samples = len(Scene.anti_aliasing_offsets(width=width, height=height, anti_aliasing=True))
+        cores_to_use = max(cores_to_use, 1) if cores_to_use != 0 else cpu_count()
+        # Everything that changes what a pass estimates, so passes from a different estimator are never averaged in
+        settings = {'width': width, 'height': height, 'max_depth': max_depth, 'lighting_samples': lighting_samples, 'camera_position': self.camera_position.to_tuple(),
+                    'sampler': self.sampler.kind, 'light_sampling': self.light_sampling, 'roulette_depth': self.roulette_depth}
+
+        accumulation = AccumulationBuffer(width=width, height=height, settings=settings)
+        if resume and checkpoint_path and os.path.exists(checkpoint_path):
+            checkpoint = AccumulationBuffer.load(path=checkpoint_path)
+            if checkpoint.settings != accumulation.settings:
+                raise ValueError(f'Checkpoint {checkpoint_path} was rendered with different settings ({checkpoint.settings}), remove it or pass resume=False')
+            accumulation = checkpoint
+            if not quiet:
+                print(f'Resuming from {checkpoint_path} after {accumulation.passes} passes.')
+
+        start_time = time.perf_counter()
+        last_checkpoint = start_time
+        # Counts the pixels of the passes still to render, so the ETA does not include those already in a checkpoint
+        total = (target_samples - accumulation.passes) * width * height if target_samples is not None else None
+        with self.worker_pool(cores_to_use=cores_to_use) as pool, Progress(total=total, quiet=quiet) as progress:
+            while target_samples is None or accumulation.passes < target_samples:
+                if time_budget is not None and time.perf_counter() - start_time >= time_budget:
+                    break
+                offsets = Scene.progressive_offsets(width=width, height=height, pass_index=accumulation.passes)
+                progress.label = f'Pass {accumulation.passes + 1}{f"/{target_samples}" if target_samples else ""}'
+                pixels = self.render_tiles(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, cores_to_use=cores_to_use, packet=packet, tile_size=tile_size, tile_order=tile_order, offsets=offsets, pool=pool,
+                                           first_sample=accumulation.passes, progress=progress)
+                accumulation.add(pixels=pixels)
+                if time.perf_counter() - last_checkpoint >= checkpoint_interval:
+                    self._save_progress(accumulation=accumulation, checkpoint_path=checkpoint_path, preview_path=preview_path)
+                    last_checkpoint = time.perf_counter()
+        self._save_progress(accumulation=accumulation, checkpoint_path=checkpoint_path, preview_path=preview_path)
+        return accumulation.image
+
+    @staticmethod
+    def _save_progress(accumulation: AccumulationBuffer, checkpoint_path: str, preview_path: str) -> None:
+        if checkpoint_path:
+            accumulation.save(path=checkpoint_path)
+        if preview_path:
+            write_image(path=preview_path, image=accumulation.image)
+
+    def render(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, row_range: dict = {}, progress: Progress = None) -> np.array:
+        image = np.zeros((height, width, 3))
         if not row_range:
             starting_row = 0
             ending_row = height
@@ -100,81 +596,221 @@ class Scene:
             ending_row = row_range['end']
 
         for y in range(starting_row, ending_row):
-            print(f'{y + 1}/{ending_row}', end='\n')
-            yy = Q_map(value=-y, lower_limit=-(height - 1), upper_limit=0, scaled_lower_limit=SCREEN_DIMS['bottom'], scaled_upper_limit=SCREEN_DIMS['top'])
-            for x in range(width):
-                xx = Q_map(value=x, lower_limit=0, upper_limit=width - 1, scaled_lower_limit=-1.0, scaled_upper_limit=1.0)
+            rays_traced = self.rays_traced
+            image[y] = self.render_tile(width=width, height=height, max_depth=max_depth, anti_aliasing=anti_aliasing, lighting_samples=lighting_samples, tile=Tile(x=0, y=y, width=width, height=1))[0]
+            if progress is not None:
+                progress.update(done=width, rays=self.rays_traced - rays_traced)
+
+        return image
+
+    def render_tile(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, tile: Tile = None, offsets: dict = None, first_sample: int = 0) -> np.array:
+        # Returns only the (tile.height, tile.width, 3) block of the image. offsets, when given, replaces the anti aliasing offsets; the samples are numbered from first_sample
+        tile = tile or Tile(x=0, y=0, width=width, height=height)
+        pixels = np.zeros((tile.height, tile.width, 3))
+        self.lighting_samples = lighting_samples
+        if self.emitters is None:
+            self.build_acceleration_structure()
+        ANTI_ALIASING_OFFSETS = list((offsets or Scene.anti_aliasing_offsets(width=width, height=height, anti_aliasing=anti_aliasing)).values())
+        if anti_aliasing and not offsets and self.sampler.kind != 'grid':
+            # Every pixel gets its own offsets instead of the shared grid
+            ys, xs = np.mgrid[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width]
+            pixel_offsets = self.sampled_offsets(width=width, height=height, xs=xs.ravel(), ys=ys.ravel()).reshape(tile.height, tile.width, -1, 2).tolist()
+        else:
+            pixel_offsets = None
+        camera = self.camera
+        camera.screen(width=width, height=height)  # Work out the frame's row and column increments before the loop
+
+        for y in range(tile.y, tile.y + tile.height):
+            for x in range(tile.x, tile.x + tile.width):
+                self._pixel = (x, y)
                 color_value = Q_Vector3d(0, 0, 0)
-                for num_samples, offset in enumerate(ANTI_ALIASING_OFFSETS):
-                    # Initial setup
-                    pixel = Q_Vector3d(xx + ANTI_ALIASING_OFFSETS[offset][0], yy + ANTI_ALIASING_OFFSETS[offset][1], 0)
-                    origin = self.camera_position
-                    direction = (pixel - origin).normalized()
-                    color_value += self.trace_ray(ray=Ray(origin=origin, direction=direction), max_depth=max_depth)
+                samples = ANTI_ALIASING_OFFSETS if pixel_offsets is None else pixel_offsets[y - tile.y][x - tile.x]
+                for index, offset in enumerate(samples):
+                    self._sample = first_sample + index
+                    ray = camera.primary_ray(x=x, y=y, width=width, height=height, offset=offset)
+                    color_value += self.trace_ray(ray=ray, max_depth=max_depth)
+
+                pixels[y - tile.y, x - tile.x] = (color_value * (1 / len(samples))).clamp(0, 1).to_tuple()
+
+        return pixels
+
+    def trace_pixels(self, width: int, height: int, xs: np.ndarray, ys: np.ndarray, offsets: np.ndarray, max_depth: int = 1, lighting_samples: int = 1, samples: np.ndarray = None) -> np.ndarray:
+        # One unclamped sample per entry: pixel (xs[i], ys[i]) shifted by offsets[i] in screen space, the pixel's sample number samples[i] (0 when not given)
+        self.lighting_samples = lighting_samples
+        if self.emitters is None:
+            self.build_acceleration_structure()
+        samples = np.zeros(len(xs), dtype=np.int64) if samples is None else samples
+        colors = np.zeros((len(xs), 3))
+        for i, (x, y, offset, sample) in enumerate(zip(xs.tolist(), ys.tolist(), offsets.tolist(), samples.tolist())):
+            self._pixel = (x, y)
+            self._sample = sample
+            colors[i] = self.trace_ray(ray=self.primary_ray(x=x, y=y, width=width, height=height, offset=offset), max_depth=max_depth).to_tuple()
+        return colors
+
+    def render_tile_adaptive(self, width: int, height: int, max_depth: int = 1, lighting_samples: int = 1, tile: Tile = None, max_samples: int = 16, threshold: float = ADAPTIVE_THRESHOLD, packet: bool = False) -> tuple:
+        """
+        Adaptive anti aliasing. Every pixel gets one centred sample; pixels that differ from a
+        neighbour by more than threshold get stratified, jittered samples in batches until the
+        standard error of their mean drops below threshold or they reach max_samples.
+        Returns the (tile.height, tile.width, 3) pixels and how many samples each pixel took.
+        """
+        tile = tile or Tile(x=0, y=0, width=width, height=height)
+        if packet:
+            if self._packet_renderer is None:
+                self._packet_renderer = PacketRenderer(scene=self)
+            trace = self._packet_renderer.trace_pixels
+        else:
+            trace = self.trace_pixels
+
+        # Centre samples over the tile and a one pixel border, so edges along the tile boundary are seen too
+        left, top = max(tile.x - 1, 0), max(tile.y - 1, 0)
+        right, bottom = min(tile.x + tile.width + 1, width), min(tile.y + tile.height + 1, height)
+        ys, xs = np.mgrid[top:bottom, left:right]
+        centre = trace(width=width, height=height, xs=xs.ravel(), ys=ys.ravel(), offsets=np.zeros((xs.size, 2)), max_depth=max_depth, lighting_samples=lighting_samples).reshape(xs.shape + (3,))
+        clamped = np.clip(centre, 0, 1)
+        padded = np.pad(clamped, ((1, 1), (1, 1), (0, 0)), mode='edge')
+        contrast = np.zeros(xs.shape)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                contrast = np.maximum(contrast, np.abs(padded[dy:dy + xs.shape[0], dx:dx + xs.shape[1]] - clamped).max(axis=-1))
+        inner = (slice(tile.y - top, tile.y - top + tile.height), slice(tile.x - left, tile.x - left + tile.width))
 
-                image[y, x] = (color_value * (1 / (num_samples + 1))).clamp(0, 1).to_tuple()
+        total = centre[inner].reshape(-1, 3).copy()
+        total_squared = clamped[inner].reshape(-1, 3) ** 2
+        total_clamped = clamped[inner].reshape(-1, 3).copy()
+        samples = np.ones(len(total), dtype=np.int64)
+        active = np.nonzero(contrast[inner].ravel() > threshold)[0] if max_samples > 1 else np.zeros(0, dtype=np.int64)
+        pixel_x = xs[inner].ravel()
+        pixel_y = ys[inner].ravel()
 
+        # Each refined pixel visits the strata of a k x k grid over the anti aliasing footprint in its own random order
+        strata = math.ceil(math.sqrt(max_samples - 1)) if max_samples > 1 else 1
+        rng = np.random.default_rng((tile.x, tile.y, width, height))
+        order = rng.permuted(np.tile(np.arange(strata * strata), (len(total), 1)), axis=1)
+        extent = np.array([3 / (2 * width), 3 / (2 * height)])
+        while len(active):
+            for _ in range(Scene.ADAPTIVE_BATCH):
+                active = active[samples[active] < max_samples]
+                if not len(active):
+                    break
+                stratum = order[active, (samples[active] - 1) % (strata * strata)]
+                cell = np.stack((stratum % strata, stratum // strata), axis=1)
+                offsets = ((cell + rng.random((len(active), 2))) / strata - 0.5) * extent
+                color = trace(width=width, height=height, xs=pixel_x[active], ys=pixel_y[active], offsets=offsets, max_depth=max_depth, lighting_samples=lighting_samples, samples=samples[active])
+                total[active] += color
+                color = np.clip(color, 0, 1)
+                total_clamped[active] += color
+                total_squared[active] += color ** 2
+                samples[active] += 1
+            if not len(active):
+                break
+            count = samples[active, np.newaxis]
+            mean = total_clamped[active] / count
+            variance = np.maximum(total_squared[active] / count - mean ** 2, 0)
+            standard_error = np.sqrt(variance / count).max(axis=1)
+            active = active[(standard_error >= threshold) & (samples[active] < max_samples)]
+
+        pixels = np.clip(total / samples[:, np.newaxis], 0, 1)
+        return pixels.reshape(tile.height, tile.width, 3), samples.reshape(tile.height, tile.width)
+
+    def render_packet(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, row_range: dict = {}) -> np.array:
+        # Same contract as render, but every primary ray of the row range is traced at once as numpy arrays
+        image = np.zeros((height, width, 3))
+        starting_row = row_range.get('start', 0)
+        ending_row = row_range.get('end', height)
+        image[starting_row:ending_row] = self.render_packet_tile(width=width, height=height, max_depth=max_depth, anti_aliasing=anti_aliasing, lighting_samples=lighting_samples, tile=Tile(x=0, y=starting_row, width=width, height=ending_row - starting_row))
         return image
 
-    def trace_ray(self, ray: Ray, max_depth: int, current_depth: int = 1, reflection: float = 1.0) -> Q_Vector3d:
-        nearest_object, object_hit = self.nearest_intersection(ray=ray)
+    def render_packet_tile(self, width: int, height: int, max_depth: int = 1, anti_aliasing: bool = False, lighting_samples: int = 1, tile: Tile = None, offsets: dict = None, first_sample: int = 0) -> np.array:
+        tile = tile or Tile(x=0, y=0, width=width, height=height)
+        if self._packet_renderer is None:
+            self._packet_renderer = PacketRenderer(scene=self)
+        return self._packet_renderer.render(width=width, height=height, max_depth=max_depth, anti_aliasing=anti_aliasing, lighting_samples=lighting_samples, rows=range(tile.y, tile.y + tile.height), columns=range(tile.x, tile.x + tile.width), offsets=list(offsets.values()) if offsets else None, first_sample=first_sample)
+
+    def trace_ray(self, ray: Ray, max_depth: int) -> Q_Vector3d:
+        """
+        Follows ray through up to max_depth reflections, carrying the path's throughput (the share of
+        what a hit sends back that reaches the pixel) instead of recursing. Paths end when throughput
+        falls below MIN_THROUGHPUT. From roulette_depth on each further bounce is taken with probability
+        equal to the throughput (decided per pixel, bounce and sample number), and a path that goes on divides its throughput by that probability, so
+        the expected colour is unchanged while deep, dim bounces are mostly skipped.
+        """
         color_value = Q_Vector3d(0, 0, 0)
+        throughput = 1.0
+        for depth in range(1, max_depth + 1):
+            nearest_object, object_hit = self.nearest_intersection(ray=ray)
 
-        # Did we even hit anything?
-        if nearest_object is None:
-            return color_value
-
-        shifted_point = object_hit.position + object_hit.normal_to_surface * 1e-5
-        direction_from_intersection_to_light = (self.lights[0]['position'] - shifted_point).normalized()
-
-        # Lighting
-        illumination = self.calculate_lighting(this_object=nearest_object, origin=shifted_point, direction_from_intersection_to_light=direction_from_intersection_to_light, object_hit=object_hit)
-
-        # Reflection
-        color_value += illumination * reflection
-
-        # Handle reflection and continue
-        reflection *= nearest_object.reflection
-        if reflection == 0:
-            return color_value
-
-        if current_depth == max_depth:
-            return color_value
-
-        # Reset origination and direction to this point and continue recursively
-        origin = shifted_point
-        direction = ray.direction.reflected(other_vector=object_hit.normal_to_surface)
-        return color_value + self.trace_ray(Ray(origin=origin, direction=direction), max_depth=max_depth, current_depth=current_depth + 1, reflection=reflection)
-
-    def calculate_lighting(self, this_object: Primitive, origin: Q_Vector3d, direction_from_intersection_to_light: Q_Vector3d, object_hit: Hit) -> Q_Vector3d:
-        CONE_THETA = math.pi / 56.0
-        illumination = Q_Vector3d(0, 0, 0)
-        for u in range(self.lighting_samples):
-            for v in range(self.lighting_samples):
-                # Fire ray(s) towards where the light source is
-                wobbled_direction = OrthoNormalBasis.cone_sample(direction=direction_from_intersection_to_light, cone_theta=CONE_THETA, u=u / self.lighting_samples, v=v / self.lighting_samples)
-                ray = Ray(origin=origin, direction=wobbled_direction)
-                illumination += self.calculate_illumination(ray=ray, this_object=this_object, hit=object_hit)
-        return illumination * (1 / (self.lighting_samples ** 2))
+            # Did we even hit anything?
+            if nearest_object is None:
+                break
 
-    def calculate_illumination(self, ray: Ray, this_object: Primitive, hit: Hit) -> Q_Vector3d:
-        illumination = Q_Vector3d(0, 0, 0)
-        nearest_light, _ = self.nearest_intersection(ray=ray)
-        is_shadowed = nearest_light is None or nearest_light.emission == Q_Vector3d(0, 0, 0)
+            shifted_point = object_hit.position + object_hit.normal_to_surface * 1e-5
+            direction_from_intersection_to_light = (self.lights[0]['position'] - shifted_point).normalized() if self.light_sampling == 'cone' else None
 
-        # Is the point we hit able to see a light?
-        if is_shadowed:
-            return illumination
+            # Lighting
+            illumination = self.calculate_lighting(this_object=nearest_object, origin=shifted_point, direction_from_intersection_to_light=direction_from_intersection_to_light, object_hit=object_hit, depth=depth)
+            color_value += illumination * throughput
+
+            # Handle reflection and continue
+            throughput *= nearest_object.reflection
+            if throughput < self.MIN_THROUGHPUT or depth == max_depth:
+                break
+            if self.roulette_depth is not None and depth >= self.roulette_depth:
+                survival = min(throughput, 1.0)
+                if self.sampler.value(x=self._pixel[0], y=self._pixel[1], dimension=-depth, sample=self._sample) >= survival:
+                    break
+                throughput /= survival
 
-        # Ambient lighting
-        illumination += this_object.ambient * nearest_light.emission
+            # Reset origination and direction to this point and continue
+            ray = Ray(origin=shifted_point, direction=ray.direction.reflected(other_vector=object_hit.normal_to_surface))
+        return color_value
 
-        # Diffuse lighting
-        intensity = math.fabs(ray.direction.dot_product(hit.normal_to_surface))
-        illumination += this_object.diffuse * nearest_light.emission * intensity
+    def calculate_lighting(self, this_object: Primitive, origin: Q_Vector3d, direction_from_intersection_to_light: Q_Vector3d, object_hit: Hit, depth: int = 1) -> Q_Vector3d:
+        """
+        Shades a hit with all of its light samples at once. Every term is the material's colour times the
+        light's emission times a geometric factor, so the samples only sum emission, emission * intensity
+        and emission * highlight, and the material is looked up and applied once for the whole batch.
+        """
+        if self._backend == 'numba':
+            illumination, rays = self.kernel_scene().calculate_lighting(this_object=this_object, origin=origin, direction_from_intersection_to_light=direction_from_intersection_to_light, object_hit=object_hit, depth=depth)
+            self.rays_traced += rays
+            return illumination
+        material = self.materials[this_object.material_id]
+        normal = object_hit.normal_to_surface
+        intersection_to_camera = (self.camera_position - object_hit.position).normalized()
+        exponent = material.shininess / 4
+        ambient_light = Q_Vector3d(0, 0, 0)
+        diffuse_light = Q_Vector3d(0, 0, 0)
+        specular_light = Q_Vector3d(0, 0, 0)
+        for direction, emitter, weight in self.shadow_rays(origin=origin, direction_from_intersection_to_light=direction_from_intersection_to_light, dimension=depth):
+            ray = Ray(origin=origin, direction=direction)
+            nearest_light = self.visible_emitter(ray=ray)
+
+            # Is the point we hit able to see the light this sample was aimed at?
+            if nearest_light is None or (emitter is not None and nearest_light is not emitter):
+                continue
+            emission = self.materials[nearest_light.material_id].emission
+            if weight != 1.0:
+                emission = emission * weight
+            ambient_light += emission
+            diffuse_light += emission * math.fabs(direction.dot_product(normal))
+            H = (direction + intersection_to_camera).normalized()
+            specular_light += emission * (normal.dot_product(H)) ** exponent
+        illumination = material.ambient * ambient_light + material.diffuse * diffuse_light + material.specular * specular_light
+        return illumination * (1 / (self.lighting_samples ** 2))
 
-        # Specular lighting
-        intersection_to_camera = (self.camera_position - hit.position).normalized()
-        H = (ray.direction + intersection_to_camera).normalized()
-        illumination += this_object.specular * nearest_light.emission * (hit.normal_to_surface.dot_product(H)) ** (this_object.shininess / 4)
-        return illumination
+    def shadow_rays(self, origin: Q_Vector3d, direction_from_intersection_to_light: Q_Vector3d, dimension: int = 1):
+        """
+        (direction, emitter, weight) of each shadow ray from origin, placed by the sampler pattern of the
+        current pixel and sample for this dimension (the bounce depth). In 'lights' mode the ray is aimed at a sampled
+        point of emitter and only counts if it reaches that emitter; weight undoes the chance of picking it.
+        In 'cone' mode emitter is None and any emitter the ray reaches counts.
+        """
+        pattern = self.sampler.pattern(x=self._pixel[0], y=self._pixel[1], dimension=dimension, sample=self._sample)
+        if self.light_sampling == 'cone':
+            # Fire ray(s) towards where the light source is
+            for direction in OrthoNormalBasis.cone_samples(direction=direction_from_intersection_to_light, cone_table=self.cone_table(self.lighting_samples)[pattern].tolist()):
+                yield direction, None, 1.0
+            return
+        for emitter, point, weight in self.light_samples(lighting_samples=self.lighting_samples)[pattern]:
+            yield (point - origin).normalized(), emitter, weight
@@ -0,0 +1,201 @@
+"""
+Binary scene files.
+
+Layout: the 8 byte magic, a little endian uint32 format version and uint64
+header length, a UTF-8 JSON header (camera, lights, and the dtype, shape and
+offset of every array), then the arrays themselves, each starting on a
+64 byte boundary so they can be memory-mapped in place:
+
+    materials       (M, 14) float64  ambient, diffuse, specular, shininess, reflection, emission
+    objects         (O, 2)  int64    kind (see PRIMITIVE_KINDS) and row in that kind's arrays
+    spheres         (S, 4)  float64  centre, radius
+    cubes           (C, 9)  float64  front bottom left, rear top right, rotation angles
+    planes          (P, 6)  float64  front bottom left, rear top right
+    mesh_corners    (T, 3, 3) float64, every mesh's triangles back to back, in the leaf order of its BVH
+    mesh_offsets    (K + 1,) int64   first triangle of each mesh
+    *_materials     int64            material row of each sphere, cube, plane and mesh
+
+and, when the file carries the mesh BVHs, their nodes back to back:
+
+    bvh_bounds      (N, 6)  float64
+    bvh_nodes       (N, 4)  int64    left, right, start, count, relative to the mesh
+    bvh_offsets     (K + 1,) int64   first node of each mesh
+
+Loose TrianglePrimitives are packed into one mesh per material, which takes
+the place of the first of them in the object order.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from BVH import BVH
+from Camera import Camera
+from CubePrimitive import CubePrimitive
+from Material import Material
+from MeshPrimitive import MeshPrimitive
+from PlanePrimitive import PlanePrimitive
+from QFunctions.Q_Functions import Q_Vector3d
+from Scene import Scene
+from SpherePrimitive import SpherePrimitive
+from TrianglePrimitive import TrianglePrimitive
+
+MAGIC = b'PYRTSCN\x00'
+VERSION = 1
+ALIGNMENT = 64
+PRIMITIVE_KINDS = ('sphere', 'cube', 'plane', 'mesh')
+MATERIAL_WIDTH = 14
+_PREAMBLE = struct.Struct('<IQ')
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_json(value):
+    return list(value.to_tuple()) if isinstance(value, Q_Vector3d) else value
+
+
+def _from_json(value):
+    return Q_Vector3d(*value) if isinstance(value, list) and len(value) == 3 else value
+
+
+def write_scene(scene: Scene, path: str, bvh: bool = True) -> None:
+    """
+    Convert a Scene built in Python into a scene file. With bvh the tree of every mesh is
+    stored as well, so loading the file never runs the BVH builder.
+    """
+    materials = {}
+    objects = []
+    rows = {kind: [] for kind in PRIMITIVE_KINDS}
+    material_rows = {kind: [] for kind in PRIMITIVE_KINDS}
+    meshes = []
+    triangle_groups = {}
+
+    def add(kind: str, row, primitive) -> None:
+        objects.append((PRIMITIVE_KINDS.index(kind), len(rows[kind])))
+        rows[kind].append(row)
+        material_rows[kind].append(materials.setdefault(primitive.material.key(), len(materials)))
+
+    for primitive in scene.objects:
+        if isinstance(primitive, SpherePrimitive):
+            add('sphere', (*primitive.position.to_tuple(), primitive.radius), primitive)
+        elif isinstance(primitive, CubePrimitive):
+            add('cube', (*primitive.front_bottom_left.to_tuple(), *primitive.rear_top_right.to_tuple(), *(primitive.angles or (0.0, 0.0, 0.0))), primitive)
+        elif isinstance(primitive, PlanePrimitive):
+            add('plane', (*primitive.front_bottom_left.to_tuple(), *primitive.rear_top_right.to_tuple()), primitive)
+        elif isinstance(primitive, MeshPrimitive):
+            add('mesh', len(meshes), primitive)
+            meshes.append(primitive)
+        elif isinstance(primitive, TrianglePrimitive):
+            key = primitive.material.key()
+            if key not in triangle_groups:
+                triangle_groups[key] = []
+                add('mesh', len(meshes), primitive)
+                meshes.append((key, triangle_groups[key]))
+            triangle_groups[key].append([vertex.to_tuple() for vertex in primitive.vertices])
+        else:
+            raise ValueError(f'Scene files cannot hold a {type(primitive).__name__}')
+
+    # Loose triangles become meshes, built here so they get their tree like any other mesh
+    meshes = [mesh if isinstance(mesh, MeshPrimitive) else MeshPrimitive.from_packed(corners=np.array(mesh[1], dtype=np.float64), material=Material.from_key(mesh[0])) for mesh in meshes]
+
+    arrays = {
+        'materials': np.array(list(materials), dtype='<f8').reshape(-1, MATERIAL_WIDTH),
+        'objects': np.array(objects, dtype='<i8').reshape(-1, 2),
+        'spheres': np.array(rows['sphere'], dtype='<f8').reshape(-1, 4),
+        'cubes': np.array(rows['cube'], dtype='<f8').reshape(-1, 9),
+        'planes': np.array(rows['plane'], dtype='<f8').reshape(-1, 6),
+        'mesh_corners': np.concatenate([mesh.mesh.vertices for mesh in meshes]).astype('<f8') if meshes else np.zeros((0, 3, 3), dtype='<f8'),
+        'mesh_offsets': np.cumsum([0] + [len(mesh) for mesh in meshes]).astype('<i8'),
+    }
+    for kind, name in zip(PRIMITIVE_KINDS, ('sphere_materials', 'cube_materials', 'plane_materials', 'mesh_materials')):
+        arrays[name] = np.array(material_rows[kind], dtype='<i8')
+    if bvh:
+        arrays['bvh_bounds'] = np.concatenate([mesh.bvh.node_bounds for mesh in meshes]).astype('<f8') if meshes else np.zeros((0, 6), dtype='<f8')
+        arrays['bvh_nodes'] = np.concatenate([np.stack((mesh.bvh.node_left, mesh.bvh.node_right, mesh.bvh.node_start, mesh.bvh.node_count), axis=1) for mesh in meshes]).astype('<i8') if meshes else np.zeros((0, 4), dtype='<i8')
+        arrays['bvh_offsets'] = np.cumsum([0] + [len(mesh.bvh) for mesh in meshes]).astype('<i8')
+
+    camera = scene.camera
+    header = {
+        'version': VERSION,
+        'camera': {name: _to_json(getattr(camera, name)) for name in ('position', 'look_at', 'up', 'fov', 'aspect', 'aperture', 'focus_distance')},
+        'lights': [{name: _to_json(value) for name, value in light.items()} for light in scene.lights],
+        'use_bvh': scene.use_bvh,
+        'light_sampling': scene.light_sampling,
+        'light_weighting': scene.light_weighting,
+        'sampler': scene.sampler.kind,
+        'arrays': {},
+    }
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + _PREAMBLE.size + len(header_bytes))
+
+    with open(path, 'wb') as scene_file:
+        scene_file.write(MAGIC + _PREAMBLE.pack(VERSION, len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            scene_file.write(b'\x00' * (data_start + header['arrays'][name]['offset'] - scene_file.tell()))
+            scene_file.write(np.ascontiguousarray(array).tobytes())
+
+
+def read_scene(path: str, mmap: bool = True) -> Scene:
+    """
+    Load a scene file written by write_scene. The arrays are memory-mapped (or read straight
+    into numpy with mmap=False) and handed to the primitives as they are; stored mesh trees are
+    used as they are instead of being rebuilt.
+    """
+    with open(path, 'rb') as scene_file:
+        if scene_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a scene file')
+        version, header_length = _PREAMBLE.unpack(scene_file.read(_PREAMBLE.size))
+        if version > VERSION:
+            raise ValueError(f'{path} is scene file version {version}, this reader only knows up to {VERSION}')
+        header = json.loads(scene_file.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + _PREAMBLE.size + header_length)
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        shape = tuple(layout['shape'])
+        if not np.prod(shape):
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + layout['offset'], shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=data_start + layout['offset']).reshape(shape)
+
+    # One Material per row, shared by every primitive using it
+    materials = [Material.from_key(row) for row in arrays['materials'].tolist()]
+    spheres = arrays['spheres'].tolist()
+    cubes = arrays['cubes'].tolist()
+    planes = arrays['planes'].tolist()
+    mesh_offsets = arrays['mesh_offsets'].tolist()
+    bvh_offsets = arrays['bvh_offsets'].tolist() if 'bvh_offsets' in arrays else None
+    material_index = {kind: arrays[f'{kind}_materials'].tolist() for kind in PRIMITIVE_KINDS}
+
+    objects = []
+    for kind, row in arrays['objects'].tolist():
+        kind = PRIMITIVE_KINDS[kind]
+        material = materials[material_index[kind][row]]
+        if kind == 'sphere':
+            objects.append(SpherePrimitive(position=Q_Vector3d(*spheres[row][:3]), radius=spheres[row][3], material=material))
+        elif kind == 'cube':
+            objects.append(CubePrimitive(front_bottom_left=Q_Vector3d(*cubes[row][:3]), rear_top_right=Q_Vector3d(*cubes[row][3:6]), rotation=tuple(cubes[row][6:]), material=material))
+        elif kind == 'plane':
+            objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(*planes[row][:3]), rear_top_right=Q_Vector3d(*planes[row][3:]), material=material))
+        else:
+            corners = arrays['mesh_corners'][mesh_offsets[row]:mesh_offsets[row + 1]]
+            tree = None
+            if bvh_offsets is not None:
+                nodes = arrays['bvh_nodes'][bvh_offsets[row]:bvh_offsets[row + 1]]
+                tree = BVH.from_arrays(node_bounds=arrays['bvh_bounds'][bvh_offsets[row]:bvh_offsets[row + 1]], node_left=nodes[:, 0], node_right=nodes[:, 1], node_start=nodes[:, 2], node_count=nodes[:, 3],
+                                       leaf_size=MeshPrimitive.LEAF_SIZE, max_leaf_size=MeshPrimitive.MAX_LEAF_SIZE)
+            objects.append(MeshPrimitive.from_packed(corners=corners, bvh=tree, material=material))
+
+    camera = Camera(**{name: _from_json(value) for name, value in header['camera'].items()})
+    lights = [{name: _from_json(value) for name, value in light.items()} for light in header['lights']]
+    return Scene(camera=camera, objects=objects, lights=lights, use_bvh=header['use_bvh'], light_sampling=header.get('light_sampling', 'lights'), light_weighting=header.get('light_weighting', 'power'), sampler=header.get('sampler', 'sobol'))
@@ -1,6 +1,8 @@
 import math
 
+from BoundingBox import BoundingBox
 from Hit import Hit
+from Material import Material
 from Primitive import Primitive
 from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
@@ -15,52 +17,70 @@ class SpherePrimitive(Primitive):
 
     EPSILON = 1e-5  # 0.000000001
 
-    def __init__(self, position: Q_Vector3d, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, radius: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
+    def __init__(self, position: Q_Vector3d, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, radius: float = 1.0, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), material: Material = None):
         # self.center = center
-        Primitive.__init__(self, position=position, ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
+        Primitive.__init__(self, position=position, ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission, material=material)
         self.radius = float(radius)
 
-    def intersect(self, ray: Ray) -> Hit:
-        b = 2 * ray.direction.dot_product(other_vector=(ray.origin - self.position))
-        # c = ((ray.origin - self.position).length_squared) - (self.radius ** 2)
-
-        # Test
-        # ray_origin = np.array([ray.origin.x, ray.origin.y, ray.origin.z])
-        # center = np.array([self.center.x, self.center.y, self.center.z])
-        # radius = self.radius
-        # c = np.linalg.norm(ray_origin - center) ** 2 - radius ** 2
-
-        # delta = b ** 2 - 4 * c
-        # if delta > 0:
-        #     t1 = (-b + math.sqrt(delta)) / 2
-        #     t2 = (-b - math.sqrt(delta)) / 2
-        #     print(b, c, delta, t1, t2)
-        #     if t1 > 0 and t2 > 0:
-        #         distance = min(t1, t2)
-        #         intersection_point = ray.origin + ray.direction * distance
-        #         normal_to_surface = (intersection_point - self.position).normalized()  # What if we're inside the sphere?
-        #         return distance, normal_to_surface
-
-        op = self.position - ray.origin
-        radiusSquared = self.radius ** 2
-        b = op.dot_product(ray.direction)
-        determinant = b * b - (op.length_squared) + radiusSquared
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        # Plain float maths on squared lengths; the normal is the only vector built and the position is left to Hit
+        origin = ray.origin
+        direction = ray.direction
+        op_x = self.position.x - origin.x
+        op_y = self.position.y - origin.y
+        op_z = self.position.z - origin.z
+        b = op_x * direction.x + op_y * direction.y + op_z * direction.z
+        determinant = b * b - (op_x * op_x + op_y * op_y + op_z * op_z) + self.radius * self.radius
         if (determinant < 0):
-            # return None, None
             return None
 
         determinant = math.sqrt(determinant)
         minusT = b - determinant
         plusT = b + determinant
         if (minusT < SpherePrimitive.EPSILON and plusT < SpherePrimitive.EPSILON):
-            # return None, None
             return None
 
         t = minusT if minusT > SpherePrimitive.EPSILON else plusT
-        hitPosition = ray.origin + (ray.direction * t)
-        normal = (hitPosition - self.position).normalized()
-        inside = normal.dot_product(ray.direction) > 0
-        if inside:
-            normal = normal * -1
-        # return t, normal
-        return Hit(position=ray.position_at_distance(t), distance=t, normal_to_surface=normal, is_inside=inside)
+        normal_x = origin.x + direction.x * t - self.position.x
+        normal_y = origin.y + direction.y * t - self.position.y
+        normal_z = origin.z + direction.z * t - self.position.z
+        length = math.sqrt(normal_x * normal_x + normal_y * normal_y + normal_z * normal_z)
+        inside = (normal_x * direction.x + normal_y * direction.y + normal_z * direction.z) > 0
+        scale = (-1.0 if inside else 1.0) / length
+        normal = Q_Vector3d(normal_x * scale, normal_y * scale, normal_z * scale)
+        if hit is None:
+            return Hit(distance=t, normal_to_surface=normal, is_inside=inside, ray=ray)
+        return hit.set(distance=t, normal_to_surface=normal, is_inside=inside, ray=ray)
+
+    def hit_distance(self, ray: Ray) -> float:
+        # Same maths as intersect on plain floats, without building a Hit or any vectors
+        origin = ray.origin
+        direction = ray.direction
+        op_x = self.position.x - origin.x
+        op_y = self.position.y - origin.y
+        op_z = self.position.z - origin.z
+        b = op_x * direction.x + op_y * direction.y + op_z * direction.z
+        determinant = b * b - (op_x * op_x + op_y * op_y + op_z * op_z) + self.radius * self.radius
+        if determinant < 0:
+            return math.inf
+        determinant = math.sqrt(determinant)
+        t = b - determinant
+        if t > SpherePrimitive.EPSILON:
+            return t
+        t = b + determinant
+        if t >= SpherePrimitive.EPSILON:
+            return t
+        return math.inf
+
+    def surface_area(self) -> float:
+        return 4 * math.pi * self.radius * self.radius
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        z = 1 - 2 * u
+        ring = math.sqrt(max(0.0, 1 - z * z))
+        phi = 2 * math.pi * v
+        return self.position + Q_Vector3d(ring * math.cos(phi), ring * math.sin(phi), z) * self.radius
+
+    def bounding_box(self) -> BoundingBox:
+        return BoundingBox(minimum=(self.position.x - self.radius, self.position.y - self.radius, self.position.z - self.radius),
+                           maximum=(self.position.x + self.radius, self.position.y + self.radius, self.position.z + self.radius))
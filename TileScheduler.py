@@ -0,0 +1,47 @@
+import math
+from collections import namedtuple
+
+Tile = namedtuple("Tile", ["x", "y", "width", "height"])
+
+TILE_ORDERS = ('spiral', 'cost', 'scanline')
+
+
+def generate_tiles(width: int, height: int, tile_size: int = 16) -> list:
+    tile_size = max(int(tile_size), 1)
+    return [Tile(x=x, y=y, width=min(tile_size, width - x), height=min(tile_size, height - y))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def spiral_order(tiles: list, width: int, height: int) -> list:
+    # Ring by ring outwards from the centre of the frame, walking each ring by angle
+    if not tiles:
+        return []
+    tile_size = max(max(tile.width, tile.height) for tile in tiles)
+    centre_x = width / 2
+    centre_y = height / 2
+
+    def key(tile: Tile) -> tuple:
+        dx = (tile.x + tile.width / 2 - centre_x) / tile_size
+        dy = (tile.y + tile.height / 2 - centre_y) / tile_size
+        return (round(max(math.fabs(dx), math.fabs(dy))), math.atan2(dy, dx))
+
+    return sorted(tiles, key=key)
+
+
+def cost_order(tiles: list, estimate_cost) -> list:
+    # Most expensive first, so the long tiles start early and cheap ones fill the gaps at the end
+    costs = {tile: estimate_cost(tile) for tile in tiles}
+    return sorted(tiles, key=lambda tile: -costs[tile])
+
+
+def order_tiles(tiles: list, width: int, height: int, order: str = 'spiral', estimate_cost=None) -> list:
+    if order == 'spiral':
+        return spiral_order(tiles=tiles, width=width, height=height)
+    if order == 'cost':
+        if estimate_cost is None:
+            raise ValueError('Ordering tiles by cost needs an estimate_cost function')
+        return cost_order(tiles=tiles, estimate_cost=estimate_cost)
+    if order == 'scanline':
+        return list(tiles)
+    raise ValueError(f'Unknown tile order {order!r}, expected one of {", ".join(TILE_ORDERS)}')
@@ -0,0 +1,108 @@
+import copy
+import math
+
+import numpy as np
+
+
+class TriangleMesh:
+    """
+    Structure-of-arrays triangle store. First vertices, both edges, unit normals
+    and bounds are packed component-major as (3, N) float64 arrays so a ray can be
+    tested against any run of triangles in one batched Moller-Trumbore pass
+    without per-triangle Python objects.
+
+    The fixed cost of a numpy pass is a few dozen microseconds, so it pays off
+    from a few dozen triangles up; the handful of faces of a single plane or
+    cube are still quicker through TrianglePrimitive.hit_distance.
+    """
+
+    EPSILON = 0.000000001
+
+    def __init__(self, vertices: np.ndarray):
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3, 3)
+        self.v0 = np.ascontiguousarray(vertices[:, 0].T)
+        self.e1 = np.ascontiguousarray((vertices[:, 1] - vertices[:, 0]).T)
+        self.e2 = np.ascontiguousarray((vertices[:, 2] - vertices[:, 0]).T)
+        normals = np.cross(self.e1.T, self.e2.T)
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        self.normals = np.ascontiguousarray(np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0).T)
+        # Pairwise over the three corners, a strided min(axis=1) is several times slower on big meshes
+        self.minimums = np.minimum(np.minimum(vertices[:, 0], vertices[:, 1]), vertices[:, 2])
+        self.maximums = np.maximum(np.maximum(vertices[:, 0], vertices[:, 1]), vertices[:, 2])
+        for array in (self.v0, self.e1, self.e2, self.normals, self.minimums, self.maximums):
+            array.flags.writeable = False
+
+    @staticmethod
+    def from_triangles(triangles) -> 'TriangleMesh':
+        return TriangleMesh(vertices=np.array([[(vertex.x, vertex.y, vertex.z) for vertex in triangle.vertices] for triangle in triangles], dtype=np.float64).reshape(-1, 3, 3))
+
+    def translated(self, offset: np.ndarray) -> 'TriangleMesh':
+        # Edges and normals do not change under a translation, so the copy shares them
+        offset = np.asarray(offset, dtype=np.float64)
+        moved = copy.copy(self)
+        moved.v0 = self.v0 + offset[:, np.newaxis]
+        moved.minimums = self.minimums + offset
+        moved.maximums = self.maximums + offset
+        for array in (moved.v0, moved.minimums, moved.maximums):
+            array.flags.writeable = False
+        return moved
+
+    def __len__(self) -> int:
+        return self.v0.shape[1]
+
+    @property
+    def vertices(self) -> np.ndarray:
+        # (N, 3, 3) copy of the corners, for consumers that want them back in triangle-major order
+        v0 = self.v0.T
+        return np.stack((v0, v0 + self.e1.T, v0 + self.e2.T), axis=1)
+
+    def hit_distances(self, origin: tuple, direction: tuple, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        Distance along the ray to each triangle in [start, end), np.inf where it misses.
+        Same tests and thresholds as TrianglePrimitive.hit_distance.
+        """
+        v0_x, v0_y, v0_z = self.v0[:, start:end]
+        e1_x, e1_y, e1_z = self.e1[:, start:end]
+        e2_x, e2_y, e2_z = self.e2[:, start:end]
+        d_x, d_y, d_z = direction
+        p_x = d_y * e2_z - d_z * e2_y
+        p_y = d_z * e2_x - d_x * e2_z
+        p_z = d_x * e2_y - d_y * e2_x
+        det = e1_x * p_x + e1_y * p_y + e1_z * p_z
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0 / det
+            t_x = origin[0] - v0_x
+            t_y = origin[1] - v0_y
+            t_z = origin[2] - v0_z
+            u = (t_x * p_x + t_y * p_y + t_z * p_z) * inv_det
+            q_x = t_y * e1_z - t_z * e1_y
+            q_y = t_z * e1_x - t_x * e1_z
+            q_z = t_x * e1_y - t_y * e1_x
+            v = (d_x * q_x + d_y * q_y + d_z * q_z) * inv_det
+            t = (e2_x * q_x + e2_y * q_y + e2_z * q_z) * inv_det
+            miss = (np.fabs(det) < TriangleMesh.EPSILON) | (u < 0.0) | (u > 1.0) | (v < 0.0) | ((u + v) > 1.0) | (t < TriangleMesh.EPSILON)
+        t[miss] = np.inf
+        return t
+
+    def nearest(self, origin: tuple, direction: tuple, start: int = 0, end: int = None, max_distance: float = math.inf) -> tuple:
+        """
+        Returns (distance, triangle index) of the closest hit in [start, end) nearer than max_distance, or None.
+        """
+        t = self.hit_distances(origin=origin, direction=direction, start=start, end=end)
+        if not len(t):
+            return None
+        index = int(np.argmin(t))
+        distance = float(t[index])
+        if distance >= max_distance:
+            return None
+        return distance, start + index
+
+    def any_hit(self, origin: tuple, direction: tuple, max_distance: float, start: int = 0, end: int = None) -> bool:
+        return bool((self.hit_distances(origin=origin, direction=direction, start=start, end=end) < max_distance).any())
+
+    def normal(self, index: int, direction: tuple) -> tuple:
+        # Face normal turned to face the incoming ray
+        n_x, n_y, n_z = self.normals[:, index].tolist()
+        if n_x * direction[0] + n_y * direction[1] + n_z * direction[2] > 0:
+            return (-n_x, -n_y, -n_z)
+        return (n_x, n_y, n_z)
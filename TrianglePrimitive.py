@@ -1,6 +1,9 @@
 import math
 
+from BoundingBox import BoundingBox
 from Hit import Hit
+from LightRegistry import sample_triangle, triangle_area
+from Material import Material
 from Primitive import Primitive
 from QFunctions.Q_Functions import Q_Vector3d
 from Ray import Ray
@@ -10,78 +13,103 @@ class TrianglePrimitive(Primitive):
 
     EPSILON = 0.000000001
 
-    def __init__(self, vertices: tuple, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float, emission: Q_Vector3d = Q_Vector3d(0, 0, 0)):
-        Primitive.__init__(self, position=Q_Vector3d(0, 0, 0), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission)
-        self.vertices = vertices
-        self.position = self._position
+    def __init__(self, vertices: tuple, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None, emission: Q_Vector3d = Q_Vector3d(0, 0, 0), material: Material = None):
+        Primitive.__init__(self, position=Q_Vector3d(0, 0, 0), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection, emission=emission, material=material)
+        self._set_vertices(vertices=vertices)
+
+    def _set_vertices(self, vertices: tuple) -> None:
+        # Everything intersect needs is derived here once; the vertices are read-only afterwards
+        v0, v1, v2 = self._vertices = tuple(vertices)
+        self._u_vector = v1 - v0
+        self._v_vector = v2 - v0
+        e1_x, e1_y, e1_z = self._u_vector.x, self._u_vector.y, self._u_vector.z
+        e2_x, e2_y, e2_z = self._v_vector.x, self._v_vector.y, self._v_vector.z
+        self._v0 = (v0.x, v0.y, v0.z)
+        self._edges = (e1_x, e1_y, e1_z, e2_x, e2_y, e2_z)
+
+        n_x = e1_y * e2_z - e1_z * e2_y
+        n_y = e1_z * e2_x - e1_x * e2_z
+        n_z = e1_x * e2_y - e1_y * e2_x
+        length = math.sqrt(n_x * n_x + n_y * n_y + n_z * n_z)
+        scale = 1.0 / length if length > 0 else 0.0  # Degenerate triangles are never hit, so any normal will do
+        self._normal = (n_x * scale, n_y * scale, n_z * scale)
+        self._face_normal = Q_Vector3d(*self._normal)
+        self._back_normal = self._face_normal * -1
+
+        self.position = (v0 + v1 + v2) * (1 / 3)
+        self._bounding_box = BoundingBox.from_points(self._vertices)
 
     @staticmethod
-    def from_vertices(vertex_1: Q_Vector3d, vertex_2: Q_Vector3d, vertex_3: Q_Vector3d, ambient: Q_Vector3d, diffuse: Q_Vector3d, specular: Q_Vector3d, shininess: float, reflection: float):
+    def from_vertices(vertex_1: Q_Vector3d, vertex_2: Q_Vector3d, vertex_3: Q_Vector3d, ambient: Q_Vector3d = None, diffuse: Q_Vector3d = None, specular: Q_Vector3d = None, shininess: float = None, reflection: float = None):
         return TrianglePrimitive(vertices=(vertex_1, vertex_2, vertex_3), ambient=ambient, diffuse=diffuse, specular=specular, shininess=shininess, reflection=reflection)
 
+    @property
+    def vertices(self) -> tuple:
+        return self._vertices
+
     def vertex(self, index: int):
-        return self.vertices[index]
+        return self._vertices[index]
 
     @property
     def u_vector(self) -> Q_Vector3d:
-        return self.vertices[1] - self.vertices[0]
+        return self._u_vector
 
     @property
     def v_vector(self) -> Q_Vector3d:
-        return self.vertices[2] - self.vertices[0]
+        return self._v_vector
 
     @property
     def face_normal(self) -> Q_Vector3d:
-        return self.u_vector.cross_product(self.v_vector).normalized()
-
-    @property
-    def _position(self) -> Q_Vector3d:
-        return (self.vertices[0] + self.vertices[1] + self.vertices[2]) * (1 / 3)
-        # return self.face_normal
-
-    def intersect(self, ray: Ray) -> Hit:
-        # E1 = self.u_vector
-        # E2 = self.v_vector
-        # N = E1.cross_product(E2)
-
-        # det = -1 * ray.direction.dot_product(other_vector=N)
-        # invdet = 1.0 / det
-
-        # A0 = ray.origin - self.vertices[0]
-        # DA0 = A0.cross_product(other_vector=ray.direction)
+        return self._face_normal
 
-        # u = E2.dot_product(DA0) * invdet
-        # v = -1 * E1.dot_product(DA0) * invdet
-        # t = A0.dot_product(N) * invdet
-        # if (det >= 1e-6 and t >= 0.0 and u >= 0.0 and v >= 0.0 and (u + v) <= 1.0):
-        #     return t
-
-        pVec = ray.direction.cross_product(self.v_vector)
-        det = self.u_vector.dot_product(pVec)
-
-        # ray and triangle are parallel if det is close to 0
-        if (math.fabs(det) < TrianglePrimitive.EPSILON):
-            # return None, None
-            return None
-
-        backfacing = det < TrianglePrimitive.EPSILON
-
-        invDet = 1.0 / float(det)
-        tVec = ray.origin - self.vertices[0]
-        u = tVec.dot_product(pVec) * invDet
-        qVec = tVec.cross_product(self.u_vector)
-        v = ray.direction.dot_product(qVec) * invDet
-        if u < 0.0 or u > 1.0 or v < 0.0 or (u + v) > 1.0:
-            # return None, None
-            return None
+    def translate(self, offset: Q_Vector3d) -> None:
+        self._set_vertices(vertices=tuple(vertex + offset for vertex in self._vertices))
 
-        t = self.v_vector.dot_product(qVec) * invDet
-        if (t < TrianglePrimitive.EPSILON):
-            # return None, None
+    def intersect(self, ray: Ray, hit: Hit = None) -> Hit:
+        t = self.hit_distance(ray=ray)
+        if t == math.inf:
             return None
 
-        if not backfacing:
-            # return t, self.face_normal
-            return Hit(position=ray.position_at_distance(t), distance=t, normal_to_surface=self.face_normal, is_inside=False)
-        else:
-            return Hit(position=ray.position_at_distance(t), distance=t, normal_to_surface=self.face_normal * -1, is_inside=False)
+        # det = u . (d x v) = -d . (u x v), so the ray sees the back of the face when d . normal > 0
+        n_x, n_y, n_z = self._normal
+        direction = ray.direction
+        normal = self._back_normal if direction.x * n_x + direction.y * n_y + direction.z * n_z > 0 else self._face_normal
+        if hit is None:
+            return Hit(distance=t, normal_to_surface=normal, is_inside=False, ray=ray)
+        return hit.set(distance=t, normal_to_surface=normal, is_inside=False, ray=ray)
+
+    def hit_distance(self, ray: Ray) -> float:
+        # Moller-Trumbore on plain floats with the precomputed edges, without building a Hit or any vectors
+        v0_x, v0_y, v0_z = self._v0
+        e1_x, e1_y, e1_z, e2_x, e2_y, e2_z = self._edges
+        d_x, d_y, d_z = ray.direction.x, ray.direction.y, ray.direction.z
+        p_x = d_y * e2_z - d_z * e2_y
+        p_y = d_z * e2_x - d_x * e2_z
+        p_z = d_x * e2_y - d_y * e2_x
+        det = e1_x * p_x + e1_y * p_y + e1_z * p_z
+        if math.fabs(det) < TrianglePrimitive.EPSILON:
+            return math.inf
+        inv_det = 1.0 / det
+        t_x, t_y, t_z = ray.origin.x - v0_x, ray.origin.y - v0_y, ray.origin.z - v0_z
+        u = (t_x * p_x + t_y * p_y + t_z * p_z) * inv_det
+        if u < 0.0 or u > 1.0:
+            return math.inf
+        q_x = t_y * e1_z - t_z * e1_y
+        q_y = t_z * e1_x - t_x * e1_z
+        q_z = t_x * e1_y - t_y * e1_x
+        v = (d_x * q_x + d_y * q_y + d_z * q_z) * inv_det
+        if v < 0.0 or (u + v) > 1.0:
+            return math.inf
+        t = (e2_x * q_x + e2_y * q_y + e2_z * q_z) * inv_det
+        if t < TrianglePrimitive.EPSILON:
+            return math.inf
+        return t
+
+    def surface_area(self) -> float:
+        return triangle_area(*self._vertices)
+
+    def sample_surface(self, u: float, v: float) -> Q_Vector3d:
+        return sample_triangle(*self._vertices, u=u, v=v)
+
+    def bounding_box(self) -> BoundingBox:
+        return self._bounding_box
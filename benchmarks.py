@@ -0,0 +1,906 @@
+import argparse
+import gc
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime as dt
+from multiprocessing import Pipe, Pool, Process, cpu_count
+
+import numpy as np
+
+from Camera import Camera
+from CubePrimitive import CubePrimitive
+from FrameBuffer import SharedFrameBuffer
+from Hit import Hit
+from ImageWriter import IMAGE_FORMATS, ImageWriter, write_image
+from Instrumentation import format_statistics
+from Kernels import numba
+from Material import Material
+from MeshPrimitive import MeshPrimitive
+from OrthoNormalBasis import OrthoNormalBasis
+from PacketRenderer import PacketRenderer
+from PlanePrimitive import PlanePrimitive
+from QFunctions.Q_Functions import Q_buckets, Q_map, Q_Vector3d
+from Ray import Ray
+import RenderWorker
+from ray_tracing_python_native import build_scene
+from Sampler import SAMPLERS, Sampler
+from Scene import Scene
+from SceneFile import read_scene, write_scene
+from SpherePrimitive import SpherePrimitive
+from TileScheduler import Tile, generate_tiles
+from TriangleMesh import TriangleMesh
+from TrianglePrimitive import TrianglePrimitive
+
+DEMO_CAMERA = Q_Vector3d(0, 0.1, -1.5)
+
+
+def random_triangles(number_of_triangles: int, extent: float = 100.0, size: float = 1.0, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    colour = Q_Vector3d(0.5, 0.5, 0.5)
+    triangles = []
+    for _ in range(number_of_triangles):
+        corner = Q_Vector3d(rng.uniform(-extent, extent), rng.uniform(-extent, extent), rng.uniform(-extent, extent))
+        vertices = (corner,
+                    corner + Q_Vector3d(rng.uniform(-size, size), rng.uniform(-size, size), rng.uniform(-size, size)),
+                    corner + Q_Vector3d(rng.uniform(-size, size), rng.uniform(-size, size), rng.uniform(-size, size)))
+        triangles.append(TrianglePrimitive(vertices, ambient=colour, diffuse=colour, specular=colour, shininess=10, reflection=0))
+    return triangles
+
+
+def random_rays(number_of_rays: int, extent: float = 100.0, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    rays = []
+    for _ in range(number_of_rays):
+        origin = Q_Vector3d(rng.uniform(-extent, extent), rng.uniform(-extent, extent), -2 * extent)
+        target = Q_Vector3d(rng.uniform(-extent, extent), rng.uniform(-extent, extent), rng.uniform(-extent, extent))
+        rays.append(Ray.from_two_vectors(origin, target))
+    return rays
+
+
+def time_rays(function, rays: list) -> float:
+    start = time.perf_counter()
+    for ray in rays:
+        function(ray=ray)
+    return time.perf_counter() - start
+
+
+def benchmark_bvh(sizes: tuple = (10, 1_000, 100_000), number_of_rays: int = 200, linear_ray_budget: int = 2_000_000) -> None:
+    print(f'{"primitives":>12} {"build (s)":>10} {"linear rays/s":>15} {"bvh rays/s":>12} {"speedup":>8}')
+    for size in sizes:
+        scene = Scene(camera_position=Q_Vector3d(0, 0, 0), objects=random_triangles(number_of_triangles=size), lights=[])
+        rays = random_rays(number_of_rays=number_of_rays)
+        # Keep the linear scan to a bounded number of primitive tests at large sizes
+        linear_rays = rays[:max(1, min(len(rays), linear_ray_budget // size))]
+        linear_time = time_rays(scene.nearest_intersection, linear_rays)
+
+        start = time.perf_counter()
+        scene.build_acceleration_structure()
+        build_time = time.perf_counter() - start
+        bvh_time = time_rays(scene.nearest_intersection, rays)
+
+        linear_rate = len(linear_rays) / linear_time
+        bvh_rate = len(rays) / bvh_time
+        print(f'{size:>12} {build_time:>10.3f} {linear_rate:>15.1f} {bvh_rate:>12.1f} {bvh_rate / linear_rate:>7.1f}x')
+
+
+def shadow_rays(scene: Scene, width: int = 40, height: int = 30, lighting_samples: int = 3) -> list:
+    # Shadow rays exactly as Scene.calculate_lighting fires them, from the primary hits of a small frame
+    rays = []
+    ratio = width / height
+    for y in range(height):
+        for x in range(width):
+            pixel = Q_Vector3d(-1 + 2 * x / (width - 1), (1 - 2 * y / (height - 1)) / ratio, 0)
+            nearest_object, hit = scene.nearest_intersection(ray=Ray.from_two_vectors(scene.camera_position, pixel))
+            if nearest_object is None:
+                continue
+            shifted_point = hit.position + hit.normal_to_surface * 1e-5
+            to_light = (scene.lights[0]['position'] - shifted_point).normalized()
+            for u in range(lighting_samples):
+                for v in range(lighting_samples):
+                    direction = OrthoNormalBasis.cone_sample(direction=to_light, cone_theta=math.pi / 56.0, u=u / lighting_samples, v=v / lighting_samples)
+                    rays.append(Ray(origin=shifted_point, direction=direction))
+    return rays
+
+
+def benchmark_shadow_rays(width: int = 40, height: int = 30, lighting_samples: int = 3) -> None:
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    scene.build_acceleration_structure()
+    rays = shadow_rays(scene=scene, width=width, height=height, lighting_samples=lighting_samples)
+
+    def closest_hit(ray: Ray):
+        nearest_light, _ = scene.nearest_intersection(ray=ray)
+        return nearest_light is not None and nearest_light.emission != Q_Vector3d(0, 0, 0)
+
+    closest_time = time_rays(closest_hit, rays)
+    any_hit_time = time_rays(scene.visible_emitter, rays)
+    print(f'{len(rays)} shadow rays')
+    print(f'closest hit: {len(rays) / closest_time:>10.1f} shadow rays/s')
+    print(f'any hit:     {len(rays) / any_hit_time:>10.1f} shadow rays/s ({closest_time / any_hit_time:.1f}x)')
+
+
+def _timed_bucket(arguments: tuple) -> float:
+    scene, width, height, max_depth, lighting_samples, row_range = arguments
+    start = time.perf_counter()
+    scene.render(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, row_range=row_range)
+    return time.perf_counter() - start
+
+
+def benchmark_scheduler(width: int = 192, height: int = 108, max_depth: int = 3, lighting_samples: int = 2, tile_size: int = 16) -> None:
+    cores = cpu_count()
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    scene.build_acceleration_structure()
+
+    # The previous scheme: 10 fixed row buckets, each worker returning a full frame
+    arguments = [(scene, width, height, max_depth, lighting_samples, {'start': start, 'end': end}) for start, end in Q_buckets(number_of_items=height, number_of_buckets=10)]
+    start = time.perf_counter()
+    with Pool(processes=cores) as pool:
+        busy_time = sum(pool.map(_timed_bucket, arguments, chunksize=1))
+    wall_time = time.perf_counter() - start
+    print(f'{"row buckets":<16} wall {wall_time:>8.2f}s  utilisation {busy_time / (wall_time * cores):>5.0%}')
+
+    for order in ('scanline', 'spiral', 'cost'):
+        scene.render_tiles(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, cores_to_use=cores, tile_size=tile_size, tile_order=order)
+        statistics = scene.render_statistics
+        print(f'{"tiles " + order:<16} wall {statistics["wall_time"]:>8.2f}s  utilisation {statistics["utilisation"]:>5.0%}')
+
+
+def benchmark_framebuffer(width: int = 3840, height: int = 2160, tile_size: int = 16, render_width: int = 160, render_height: int = 90) -> None:
+    # Bytes pickled back through the pool for one frame under each scheme
+    tiles = generate_tiles(width=width, height=height, tile_size=tile_size)
+    full_frame = len(pickle.dumps(np.zeros((height, width, 3)))) * 10
+    tile_results = sum(len(pickle.dumps((tile, np.zeros((tile.height, tile.width, 3)), 0.0))) for tile in tiles[:64]) * len(tiles) / min(len(tiles), 64)
+    with SharedFrameBuffer(width=width, height=height, dtype='float32') as framebuffer:
+        shared_results = len(pickle.dumps((Tile(0, 0, tile_size, tile_size), None, 0.0))) * len(tiles)
+        handle = len(pickle.dumps(framebuffer))
+        shared_bytes = framebuffer.nbytes
+    print(f'{width}x{height} frame, {len(tiles)} tiles of {tile_size}px')
+    print(f'{"10 full-frame float64 arrays":<34} {full_frame / 1e6:>10.1f} MB through pipes')
+    print(f'{"float64 tiles":<34} {tile_results / 1e6:>10.1f} MB through pipes')
+    print(f'{"shared float32 framebuffer":<34} {shared_results / 1e6:>10.3f} MB through pipes ({handle} byte handle per task, {shared_bytes / 1e6:.1f} MB shared)')
+
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    for shared, dtype in ((False, 'float64'), (True, 'float64'), (True, 'float32')):
+        scene.render_tiles(width=render_width, height=render_height, cores_to_use=cpu_count(), tile_size=tile_size, shared_framebuffer=shared, framebuffer_dtype=dtype)
+        print(f'{"shared" if shared else "returned"} {dtype:<8} render wall {scene.render_statistics["wall_time"]:.2f}s')
+
+
+class AllocationCounter:
+    """
+    Counts constructions of the given classes by wrapping their __init__ for the
+    duration of a with block.
+    """
+
+    def __init__(self, *classes):
+        self.classes = classes
+        self.counts = {cls.__name__: 0 for cls in classes}
+
+    def __enter__(self) -> 'AllocationCounter':
+        self._originals = {cls: cls.__init__ for cls in self.classes}
+        for cls, original in self._originals.items():
+            def counting_init(instance, *args, _original=original, _name=cls.__name__, **kwargs):
+                self.counts[_name] += 1
+                _original(instance, *args, **kwargs)
+            cls.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for cls, original in self._originals.items():
+            cls.__init__ = original
+
+
+def benchmark_allocations(number_of_rays: int = 2000) -> None:
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    scene.build_acceleration_structure()
+    rays = shadow_rays(scene=scene, width=20, height=15, lighting_samples=2)[:number_of_rays]
+    rays += random_rays(number_of_rays=number_of_rays - len(rays), extent=30.0) if len(rays) < number_of_rays else []
+    record = Hit()
+
+    cases = {
+        'scene.nearest_intersection': lambda ray: scene.nearest_intersection(ray=ray),
+        'object.intersect (new Hit)': lambda ray: [object.intersect(ray=ray) for object in scene.objects],
+        'object.intersect (reused Hit)': lambda ray: [object.intersect(ray=ray, hit=record) for object in scene.objects],
+        'object.hit_distance': lambda ray: [object.hit_distance(ray=ray) for object in scene.objects],
+    }
+    print(f'{"query":<32} {"Q_Vector3d/ray":>15} {"Hit/ray":>8} {"Ray/ray":>8} {"rays/s":>10}')
+    for name, query in cases.items():
+        with AllocationCounter(Q_Vector3d, Hit, Ray) as counter:
+            for ray in rays:
+                query(ray)
+        elapsed = time_rays(lambda ray: query(ray), rays)
+        counts = {key: value / len(rays) for key, value in counter.counts.items()}
+        print(f'{name:<32} {counts["Q_Vector3d"]:>15.2f} {counts["Hit"]:>8.2f} {counts["Ray"]:>8.2f} {len(rays) / elapsed:>10.1f}')
+
+
+def benchmark_triangles(sizes: tuple = (2, 12, 100, 1_000), number_of_rays: int = 500) -> None:
+    # Closest hit over N triangles: per-object loop over TrianglePrimitive versus one packed TriangleMesh pass
+    print(f'{"triangles":>10} {"objects rays/s":>15} {"mesh rays/s":>12}')
+    for size in sizes:
+        triangles = random_triangles(number_of_triangles=size, extent=10.0, size=3.0)
+        mesh = TriangleMesh.from_triangles(triangles)
+        rays = random_rays(number_of_rays=number_of_rays, extent=10.0)
+
+        def object_loop(ray: Ray):
+            return min(triangle.hit_distance(ray=ray) for triangle in triangles)
+
+        def packed(ray: Ray):
+            return mesh.nearest(origin=(ray.origin.x, ray.origin.y, ray.origin.z), direction=(ray.direction.x, ray.direction.y, ray.direction.z))
+
+        object_time = time_rays(object_loop, rays)
+        mesh_time = time_rays(packed, rays)
+        print(f'{size:>10} {len(rays) / object_time:>15.1f} {len(rays) / mesh_time:>12.1f}')
+
+
+def write_ply(path: str, corners: np.ndarray) -> None:
+    vertices = corners.reshape(-1, 3).astype('<f4')
+    faces = np.zeros(len(corners), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+    faces['count'] = 3
+    faces['indices'] = np.arange(len(vertices)).reshape(-1, 3)
+    with open(path, 'wb') as ply:
+        ply.write(f'ply\nformat binary_little_endian 1.0\nelement vertex {len(vertices)}\nproperty float x\nproperty float y\nproperty float z\nelement face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n'.encode('ascii'))
+        ply.write(vertices.tobytes())
+        ply.write(faces.tobytes())
+
+
+def benchmark_mesh(sizes: tuple = (10_000, 100_000, 1_000_000), number_of_rays: int = 500) -> None:
+    # Load a binary PLY of N triangles into a MeshPrimitive and trace random rays through its BVH
+    print(f'{"triangles":>10} {"load (s)":>9} {"MB":>8} {"rays/s":>10}')
+    colour = Q_Vector3d(0.5, 0.5, 0.5)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            corners = rng.uniform(-100, 100, size=(size, 1, 3)) + rng.uniform(-1, 1, size=(size, 3, 3))
+            path = os.path.join(directory, f'{size}.ply')
+            write_ply(path=path, corners=corners)
+            start = time.perf_counter()
+            mesh = MeshPrimitive.load(path=path, ambient=colour, diffuse=colour, specular=colour, shininess=10, reflection=0)
+            load_time = time.perf_counter() - start
+            packed = sum(array.nbytes for array in (mesh.mesh.v0, mesh.mesh.e1, mesh.mesh.e2, mesh.mesh.normals, mesh.mesh.minimums, mesh.mesh.maximums, mesh.bvh.node_bounds))
+            elapsed = time_rays(mesh.intersect, random_rays(number_of_rays=number_of_rays))
+            print(f'{size:>10} {load_time:>9.2f} {packed / 2 ** 20:>8.1f} {number_of_rays / elapsed:>10.1f}')
+
+
+def benchmark_scene_file(number_of_triangles: int = 100_000, mesh_size: int = 1_000_000) -> None:
+    # Startup from Python scene definitions against loading the same scene from a scene file
+    colour = Q_Vector3d(0.5, 0.5, 0.5)
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(-100, 100, size=(mesh_size, 1, 3)) + rng.uniform(-1, 1, size=(mesh_size, 3, 3))
+    print(f'{"scene":<34} {"startup (s)":>12}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, build in ((f'{number_of_triangles} loose triangles', lambda: random_triangles(number_of_triangles=number_of_triangles)),
+                            (f'{mesh_size} triangle mesh', lambda: [MeshPrimitive.from_packed(corners=corners, ambient=colour, diffuse=colour, specular=colour, shininess=10, reflection=0)])):
+            start = time.perf_counter()
+            scene = build_scene(camera_position=DEMO_CAMERA)
+            scene.objects.extend(build())
+            print(f'{name + " in Python":<34} {time.perf_counter() - start:>12.2f}')
+            for bvh in (False, True):
+                path = os.path.join(directory, 'scene.bin')
+                write_scene(scene=scene, path=path, bvh=bvh)
+                start = time.perf_counter()
+                with open(path, 'rb') as scene_file:
+                    scene_file.read()
+                read_time = time.perf_counter() - start
+                start = time.perf_counter()
+                read_scene(path=path)
+                print(f'{"  file" + (" with BVH" if bvh else ""):<34} {time.perf_counter() - start:>12.2f}  ({os.path.getsize(path) / 2 ** 20:.1f} MB, {read_time:.2f}s to read)')
+
+
+class UnregisteredTrianglePrimitive(TrianglePrimitive):
+    # The layout before the material registry: every triangle keeps a Material of its own and nothing is shared
+    def _set_material(self, material: Material) -> None:
+        self.material_id = None
+        self._material = material
+
+
+def benchmark_materials(number_of_triangles: int = 100_000) -> None:
+    # Traced memory per TrianglePrimitive: each triangle with its own colour vectors and material, as before the
+    # registry, then through the registry with colours given per triangle and with colours shared by every triangle
+    rng = random.Random(0)
+    corners = [tuple(Q_Vector3d(rng.uniform(-100, 100), rng.uniform(-100, 100), rng.uniform(-100, 100)) for _ in range(3)) for _ in range(number_of_triangles)]
+
+    def own_colours() -> dict:
+        return dict(ambient=Q_Vector3d(0.1, 0.1, 0.1), diffuse=Q_Vector3d(0.5, 0.5, 0.5), specular=Q_Vector3d(1, 1, 1), shininess=10, reflection=0)
+
+    shared = own_colours()
+    cases = (('own material (before)', UnregisteredTrianglePrimitive, lambda: dict(material=Material(**own_colours()))),
+             ('registry, own colours', TrianglePrimitive, own_colours),
+             ('registry, shared colours', TrianglePrimitive, lambda: shared))
+    for name, primitive, material in cases:
+        gc.collect()
+        tracemalloc.start()
+        triangles = [primitive(vertices, **material()) for vertices in corners]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'{name:<26} {size / len(triangles):>8.0f} bytes per triangle, {len({id(triangle.material) for triangle in triangles})} distinct materials')
+        del triangles
+
+
+def benchmark_boxes(number_of_rays: int = 20_000) -> None:
+    # Analytic slab / rectangle test against the old loop over the triangle faces
+    colour = Q_Vector3d(0.5, 0.5, 0.5)
+    material = dict(ambient=colour, diffuse=colour, specular=colour, shininess=10, reflection=0)
+    primitives = {
+        'cube': CubePrimitive(front_bottom_left=Q_Vector3d(-20, -20, -20), rear_top_right=Q_Vector3d(20, 20, 20), **material),
+        'plane': PlanePrimitive(front_bottom_left=Q_Vector3d(-50, -5, -50), rear_top_right=Q_Vector3d(50, -5, 50), **material),
+    }
+    rays = random_rays(number_of_rays=number_of_rays, extent=20.0)
+    print(f'{"primitive":<10} {"faces rays/s":>13} {"analytic rays/s":>16} {"speedup":>8}')
+    for name, primitive in primitives.items():
+
+        def face_loop(ray: Ray):
+            return min(triangle.hit_distance(ray=ray) for triangle in primitive.faces)
+
+        face_time = time_rays(face_loop, rays)
+        analytic_time = time_rays(primitive.hit_distance, rays)
+        print(f'{name:<10} {len(rays) / face_time:>13.1f} {len(rays) / analytic_time:>16.1f} {face_time / analytic_time:>7.1f}x')
+
+
+def benchmark_camera(width: int = 320, height: int = 180) -> None:
+    # Primary ray generation alone, for every pixel and all nine anti aliasing offsets
+    offsets = list(Scene.anti_aliasing_offsets(width=width, height=height, anti_aliasing=True).values())
+    number_of_rays = width * height * len(offsets)
+
+    def mapped() -> None:
+        # What render_tile used to do: two Q_map calls per pixel and a normalise per offset
+        screen_ratio = float(width) / float(height)
+        for y in range(height):
+            yy = Q_map(value=-y, lower_limit=-(height - 1), upper_limit=0, scaled_lower_limit=-1 / screen_ratio, scaled_upper_limit=1 / screen_ratio)
+            for x in range(width):
+                xx = Q_map(value=x, lower_limit=0, upper_limit=width - 1, scaled_lower_limit=-1.0, scaled_upper_limit=1.0)
+                for offset in offsets:
+                    Ray(origin=DEMO_CAMERA, direction=(Q_Vector3d(xx + offset[0], yy + offset[1], 0) - DEMO_CAMERA).normalized())
+
+    def indexed() -> None:
+        camera = Camera(position=DEMO_CAMERA)
+        for y in range(height):
+            for x in range(width):
+                for offset in offsets:
+                    camera.primary_ray(x=x, y=y, width=width, height=height, offset=offset)
+
+    def centred() -> None:
+        camera = Camera(position=DEMO_CAMERA)
+        for _ in offsets:
+            for y in range(height):
+                for x in range(width):
+                    camera.primary_ray(x=x, y=y, width=width, height=height)
+
+    def arrays() -> None:
+        camera = Camera(position=DEMO_CAMERA)
+        ys, xs = np.mgrid[0:height, 0:width]
+        for offset in offsets:
+            camera.rays(width=width, height=height, xs=xs.ravel(), ys=ys.ravel(), offsets=np.broadcast_to(np.array(offset), (xs.size, 2)))
+
+    print(f'{"generator":<36} {"Mrays/s":>8}')
+    for name, function in (('Q_map per pixel', mapped), ('Camera.primary_ray with offsets', indexed), ('Camera.primary_ray, centred', centred), ('Camera.rays (numpy)', arrays)):
+        start = time.perf_counter()
+        function()
+        print(f'{name:<36} {number_of_rays / (time.perf_counter() - start) / 1e6:>8.2f}')
+
+
+def turntable_frames(number_of_frames: int, centre: Q_Vector3d = Q_Vector3d(0, 0, 30), radius: float = 31.5) -> list:
+    # Camera circling the demo scene while the first sphere bobs up and down
+    frames = []
+    for frame in range(number_of_frames):
+        angle = 2 * math.pi * frame / number_of_frames
+        position = centre + Q_Vector3d(radius * math.sin(angle), 0.1, -radius * math.cos(angle))
+        frames.append({'camera': {'position': position, 'look_at': centre}, 'offsets': {0: Q_Vector3d(0, 3 * math.sin(2 * angle), 0)}})
+    return frames
+
+
+def benchmark_sequence(number_of_frames: int = 120, width: int = 64, height: int = 36, cores_to_use: int = 2) -> None:
+    # A turntable rendered by one persistent pool, against a fresh scene, BVH and pool for every frame
+    frames = turntable_frames(number_of_frames=number_of_frames)
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        for frame_number, frame in enumerate(frames):
+            scene = build_scene(camera_position=DEMO_CAMERA)
+            scene.apply_frame(frame=frame)
+            image = scene.render_tiles(width=width, height=height, max_depth=2, lighting_samples=1, cores_to_use=cores_to_use)
+            write_image(path=os.path.join(directory, f'{frame_number}.png'), image=image)
+        per_frame = time.perf_counter() - start
+
+        scene = build_scene(camera_position=DEMO_CAMERA)
+        start = time.perf_counter()
+        scene.render_sequence(frames=frames, width=width, height=height, max_depth=2, lighting_samples=1, cores_to_use=cores_to_use, output=os.path.join(directory, 'frame_{:04d}.png'))
+        sequence = time.perf_counter() - start
+    print(f'{number_of_frames} frames at {width}x{height} on {cores_to_use} cores')
+    print(f'{"mode":<28} {"total (s)":>10} {"frames/s":>9}')
+    print(f'{"new pool and scene a frame":<28} {per_frame:>10.2f} {number_of_frames / per_frame:>9.2f}')
+    print(f'{"render_sequence":<28} {sequence:>10.2f} {number_of_frames / sequence:>9.2f}')
+
+
+def benchmark_workers(number_of_triangles: int = 100_000, width: int = 64, height: int = 32, tile_size: int = 16, cores_to_use: int = 2) -> None:
+    # The demo scene plus a large triangle soup behind the camera, so setup and IPC dominate the render
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    for triangle in random_triangles(number_of_triangles=number_of_triangles):
+        triangle.translate(offset=Q_Vector3d(0, 0, -500))
+        scene.objects.append(triangle)
+    scene.build_acceleration_structure()
+    start = time.perf_counter()
+    size = len(pickle.dumps(scene))
+    pickle_time = time.perf_counter() - start
+    tiles = generate_tiles(width=width, height=height, tile_size=tile_size)
+    arguments = [(width, height, 1, False, 1, tile, False, None, None, None, 0) for tile in tiles]
+    print(f'{len(scene.objects)} objects, scene pickles to {size / 1e6:.1f} MB in {pickle_time:.2f}s, {len(tiles)} tiles on {cores_to_use} cores')
+
+    # The previous scheme: a bound method as the task function, so the scene goes with every tile
+    start = time.perf_counter()
+    with Pool(processes=cores_to_use) as pool:
+        for _ in pool.imap_unordered(scene._render_tile_task, arguments, chunksize=1):
+            pass
+    per_task = time.perf_counter() - start
+    per_task_bytes = size * len(tiles)
+
+    start = time.perf_counter()
+    with scene.worker_pool(cores_to_use=cores_to_use) as pool:
+        setup = time.perf_counter() - start
+        for _ in pool.imap_unordered(RenderWorker.render_tile, arguments, chunksize=1):
+            pass
+    per_worker = time.perf_counter() - start
+    per_worker_bytes = sum(len(pickle.dumps(task)) for task in arguments)
+    print(f'{"scene in every task":<22} wall {per_task:>7.2f}s  {per_task_bytes / 1e6:>9.1f} MB through pipes')
+    print(f'{"scene once per worker":<22} wall {per_worker:>7.2f}s  {per_worker_bytes / 1e6:>9.3f} MB through pipes (pool setup {setup:.2f}s)')
+
+
+def benchmark_lights(width: int = 96, height: int = 54, reference_samples: int = 12, sample_counts: tuple = (1, 2, 3, 4, 6)) -> None:
+    # RMS error against a high sample render of the demo scene with a second light off to the left. The
+    # cone only ever aims at the first light, so it converges to an image without the second one
+    white = Q_Vector3d(1, 1, 1)
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-30, 5, 5), rear_top_right=Q_Vector3d(-30, 15, 15), ambient=white, diffuse=white, specular=white, shininess=100, reflection=0, emission=Q_Vector3d(0.5, 0.5, 0.5)))
+    reference = scene.render_packet(width=width, height=height, max_depth=2, lighting_samples=reference_samples)
+    print(f'{"mode":<8} {"shadow rays/pixel":>18} {"rms error":>10} {"time (s)":>9}')
+    for mode in Scene.LIGHT_SAMPLING:
+        scene.light_sampling = mode
+        for lighting_samples in sample_counts:
+            start = time.perf_counter()
+            image = scene.render_packet(width=width, height=height, max_depth=2, lighting_samples=lighting_samples)
+            elapsed = time.perf_counter() - start
+            print(f'{mode:<8} {lighting_samples ** 2:>18} {np.sqrt(np.mean((image - reference) ** 2)):>10.4f} {elapsed:>9.2f}')
+
+
+def benchmark_samplers(width: int = 96, height: int = 54, reference_samples: int = 32, sample_counts: tuple = (1, 2, 3, 4, 6, 8), block: int = 4) -> None:
+    """
+    Error of the demo scene's lighting against a 1024 shadow ray render on the regular grid, for every sampler and light
+    sampling mode: RMS per pixel, then RMS after averaging block x block pixels, which keeps the
+    structured error (bands that every pixel shares) and averages away independent noise.
+    """
+
+    def blocked(image: np.ndarray) -> np.ndarray:
+        rows, columns = height // block * block, width // block * block
+        return image[:rows, :columns].reshape(rows // block, block, columns // block, block, 3).mean(axis=(1, 3))
+
+    print(f'{"mode":<8} {"sampler":<12} {"error":<9} ' + ' '.join(f'{n * n:>7}' for n in sample_counts) + '  (shadow rays/pixel)')
+    for mode in Scene.LIGHT_SAMPLING:
+        scene = build_scene(camera_position=DEMO_CAMERA)
+        scene.light_sampling = mode
+        scene.sampler = Sampler(kind='grid')
+        reference = scene.render_packet(width=width, height=height, max_depth=2, lighting_samples=reference_samples)
+        for kind in SAMPLERS:
+            scene.sampler = Sampler(kind=kind)
+            differences = [scene.render_packet(width=width, height=height, max_depth=2, lighting_samples=n) - reference for n in sample_counts]
+            print(f'{mode:<8} {kind:<12} {"pixel":<9} ' + ' '.join(f'{np.sqrt(np.mean(difference ** 2)):>7.4f}' for difference in differences))
+            print(f'{"":<8} {"":<12} {f"{block}x{block}":<9} ' + ' '.join(f'{np.sqrt(np.mean(blocked(difference) ** 2)):>7.4f}' for difference in differences))
+
+
+def benchmark_cone(number_of_points: int = 2_000, sample_counts: tuple = (1, 2, 4, 8)) -> None:
+    # Cone shadow ray directions for a batch of shading points: a basis and the trig per sample against one basis per point and a precomputed trig table
+    rng = np.random.default_rng(0)
+    directions = rng.normal(size=(number_of_points, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    vectors = [Q_Vector3d(*direction) for direction in directions.tolist()]
+    sampler = Sampler(kind='sobol')
+    patterns = sampler.pixel_patterns(xs=np.arange(number_of_points) % 64, ys=np.arange(number_of_points) // 64, dimension=1)
+    print(f'{"shadow rays/point":>18} {"per sample":>11} {"batched":>9} {"speedup":>8} {"packet per sample":>18} {"packet batched":>15} {"speedup":>8}  (M directions/s)')
+    for n in sample_counts:
+        table = sampler.table(n * n)
+        cone_table = OrthoNormalBasis.cone_table(cone_theta=Scene.CONE_THETA, points=table)
+        number_of_directions = number_of_points * n * n
+
+        start = time.perf_counter()
+        for vector, pattern in zip(vectors, patterns.tolist()):
+            for u, v in table[pattern].tolist():
+                OrthoNormalBasis.cone_sample(direction=vector, cone_theta=Scene.CONE_THETA, u=u, v=v)
+        per_sample = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for vector, pattern in zip(vectors, patterns.tolist()):
+            OrthoNormalBasis.cone_samples(direction=vector, cone_table=cone_table[pattern].tolist())
+        batched = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for sample in range(n * n):
+            PacketRenderer.cone_sample(directions, Scene.CONE_THETA, table[patterns, sample, 0], table[patterns, sample, 1])
+        packet_per_sample = time.perf_counter() - start
+
+        start = time.perf_counter()
+        PacketRenderer.cone_directions(directions, cone_table[patterns])
+        packet_batched = time.perf_counter() - start
+        rates = [number_of_directions / elapsed / 1e6 for elapsed in (per_sample, batched, packet_per_sample, packet_batched)]
+        print(f'{n * n:>18} {rates[0]:>11.3f} {rates[1]:>9.3f} {per_sample / batched:>7.1f}x {rates[2]:>18.2f} {rates[3]:>15.2f} {packet_per_sample / packet_batched:>7.1f}x')
+
+
+def benchmark_depth(width: int = 64, height: int = 36, depths: tuple = (1, 2, 4, 8, 16, 32), roulette_depth: int = 3) -> None:
+    # Render time against max_depth for the demo scene walled in by mirrors, following every path to max_depth
+    # (only stopping at a zero reflection, as trace_ray used to) and with the throughput cut off and Russian roulette from bounce roulette_depth
+    grey = Q_Vector3d(0.3, 0.3, 0.3)
+    mirror = dict(ambient=grey * 0.1, diffuse=grey, specular=grey, shininess=50, reflection=0.9)
+    scene = build_scene(camera_position=DEMO_CAMERA)
+    for x in (-12, 12):
+        scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(x, -15, -5), rear_top_right=Q_Vector3d(x, 40, 60), **mirror))
+    for z in (-5, 60):
+        scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-12, -15, z), rear_top_right=Q_Vector3d(12, 40, z), **mirror))
+    scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-12, 40, -5), rear_top_right=Q_Vector3d(12, 40, 60), **mirror))
+    print(f'{"max depth":>9} {"every bounce (s)":>17} {"roulette (s)":>13} {"speedup":>8} {"mean difference":>16} {"rms difference":>15}')
+    for depth in depths:
+        timings, images = [], []
+        for roulette, min_throughput in ((None, 0.0), (roulette_depth, Scene.MIN_THROUGHPUT)):
+            scene.roulette_depth, scene.MIN_THROUGHPUT = roulette, min_throughput
+            start = time.perf_counter()
+            images.append(scene.render_tile(width=width, height=height, max_depth=depth, lighting_samples=1))
+            timings.append(time.perf_counter() - start)
+        print(f'{depth:>9} {timings[0]:>17.2f} {timings[1]:>13.2f} {timings[0] / timings[1]:>7.1f}x {np.mean(images[1] - images[0]):>16.4f} {np.sqrt(np.mean((images[0] - images[1]) ** 2)):>15.4f}')
+
+
+def benchmark_instrumentation(width: int = 96, height: int = 54, max_depth: int = 3, lighting_samples: int = 2, repeats: int = 3) -> None:
+    # Render time of the demo scene on one core without and with Instrumentation, best of repeats
+    scene = demo_scene()
+    timings = {False: math.inf, True: math.inf}
+    for _ in range(repeats):
+        for instrument in (False, True):
+            scene.render_tiles(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, instrument=instrument)
+            timings[instrument] = min(timings[instrument], scene.render_statistics['wall_time'])
+    print(f'{width}x{height}, max depth {max_depth}, {lighting_samples ** 2} light samples per hit')
+    print(f'without instrumentation {timings[False]:.2f}s, with {timings[True]:.2f}s ({timings[True] / timings[False] - 1:+.0%})')
+    for line in format_statistics(merged=scene.render_statistics['instrumentation'], wall_time=timings[True]):
+        print(line)
+
+
+def write_p3(image: np.ndarray, path: str) -> None:
+    # The ASCII PPM writer the renderer used before ImageWriter, for comparison
+    height, width = image.shape[:2]
+    with open(path, 'w') as pic:
+        pic.write(f'P3\n{width} {height}\n255\n')
+        for row in image.tolist():
+            for col in row:
+                pic.write(f'{int(col[0] * 255)} {int(col[1] * 255)} {int(col[2] * 255)} ')
+            pic.write('\n')
+
+
+def benchmark_output(width: int = 3840, height: int = 2160, tile_size: int = 16) -> None:
+    # Time and peak Python memory (beyond the frame itself) to save one frame, the old way and through ImageWriter
+    image = np.random.default_rng(0).random((height, width, 3))
+    tiles = generate_tiles(width=width, height=height, tile_size=tile_size)
+
+    def stream(path: str) -> None:
+        with ImageWriter(path=path, width=width, height=height, source=image) as writer:
+            for tile in tiles:
+                writer.write_tile(tile=tile, pixels=image[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width])
+
+    writers = [('P3 ppm from tolist (old)', 'ppm', write_p3)]
+    try:
+        import matplotlib.pyplot as plt
+        writers.append(('matplotlib imsave png (old)', 'png', lambda image, path: plt.imsave(path, image)))
+    except ImportError:
+        pass
+    writers += [(f'write_image {extension}', extension, lambda image, path: write_image(path=path, image=image)) for extension in IMAGE_FORMATS]
+    writers += [(f'{len(tiles)} tiles streamed {extension}', extension, lambda image, path: stream(path=path)) for extension in IMAGE_FORMATS]
+    print(f'{width}x{height} frame')
+    print(f'{"writer":<30} {"time (s)":>9} {"peak (MB)":>10} {"file (MB)":>10}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, extension, write in writers:
+            path = os.path.join(directory, f'image.{extension}')
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            write(image, path)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{name:<30} {elapsed:>9.2f} {peak / 1e6:>10.1f} {os.path.getsize(path) / 1e6:>10.1f}')
+            os.remove(path)
+
+
+def demo_scene() -> Scene:
+    return build_scene(camera_position=DEMO_CAMERA)
+
+
+def mesh_scene(stacks: int = 51, slices: int = 100) -> Scene:
+    # The demo's floor and light around a 10,000 triangle UV sphere, 2 * slices * (stacks - 1) triangles
+    theta = np.linspace(0, math.pi, stacks)[:, np.newaxis]
+    phi = np.linspace(0, 2 * math.pi, slices + 1)[np.newaxis, :]
+    vertices = (np.stack((np.sin(theta) * np.cos(phi), np.cos(theta) * np.ones_like(phi), np.sin(theta) * np.sin(phi)), axis=-1) * 9.0 + (0, -4, 32)).reshape(-1, 3)
+    rows, columns = np.mgrid[0:stacks - 1, 0:slices]
+    corner = rows * (slices + 1) + columns
+    quads = np.stack((corner, corner + 1, corner + slices + 2, corner + slices + 1), axis=-1).reshape(-1, 4)
+    faces = np.concatenate((quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]))
+    colour = Q_Vector3d(0.2, 0.5, 0.7)
+    scene = demo_scene()
+    scene.objects = [primitive for primitive in scene.objects if not isinstance(primitive, SpherePrimitive)]
+    scene.objects.append(MeshPrimitive(vertices=vertices, faces=faces, ambient=colour * 0.1, diffuse=colour, specular=Q_Vector3d(1, 1, 1), shininess=40, reflection=0.2))
+    return scene
+
+
+def many_lights_scene(rows: int = 4, columns: int = 4) -> Scene:
+    # The demo's spheres and floor lit by a grid of small coloured panels instead of one light
+    scene = demo_scene()
+    scene.objects = [primitive for primitive in scene.objects if not primitive.is_emissive]
+    rng = random.Random(0)
+    for row in range(rows):
+        for column in range(columns):
+            x, y = -24 + column * 48 / (columns - 1), 18 + row * 18 / (rows - 1)
+            emission = Q_Vector3d(rng.uniform(0.1, 0.5), rng.uniform(0.1, 0.5), rng.uniform(0.1, 0.5))
+            scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(x - 1, y - 1, 8), rear_top_right=Q_Vector3d(x + 1, y + 1, 8), ambient=Q_Vector3d(1, 1, 1), diffuse=Q_Vector3d(1, 1, 1),
+                                                specular=Q_Vector3d(1, 1, 1), shininess=100, reflection=0, emission=emission))
+    return scene
+
+
+REFERENCE_SCENES = {
+    'demo': demo_scene,
+    'mesh': mesh_scene,
+    'lights': many_lights_scene,
+}
+
+
+def best_time(function, rays: list, repeats: int) -> float:
+    return min(time_rays(function, rays) for _ in range(repeats))
+
+
+def run_in_child(function, *args):
+    # function(*args) in a fresh process, with that process's peak RSS and its workers' in MB, so every measurement starts clean
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=_child_main, args=(sender, function, args))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def _child_main(sender, function, args: tuple) -> None:
+    try:
+        result = function(*args)
+        # ru_maxrss is in kilobytes on Linux
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        result['worker_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    except Exception as error:
+        result = error
+    sender.send(result)
+
+
+def measure_scene(name: str, width: int, height: int, max_depth: int, lighting_samples: int, cores: tuple, repeats: int = 3) -> dict:
+    """
+    Throughput of one reference scene. Every ray type is traced on its own over the rays one
+    frame produces: primary rays from the camera, shadow rays from where they hit and single
+    bounce reflection rays off the reflective hits. Stages are timed the same way, then the
+    whole frame is rendered in one process and by render_tiles on each number of cores.
+    """
+    stages = {}
+    start = time.perf_counter()
+    scene = REFERENCE_SCENES[name]()
+    scene.build_acceleration_structure()
+    stages['build'] = time.perf_counter() - start
+    scene.lighting_samples = lighting_samples
+    scene.camera.screen(width=width, height=height)
+
+    start = time.perf_counter()
+    pixels = [(x, y) for y in range(height) for x in range(width)]
+    primary = [scene.primary_ray(x=x, y=y, width=width, height=height) for x, y in pixels]
+    stages['camera'] = time.perf_counter() - start
+    stages['primary'] = best_time(scene.nearest_intersection, primary, repeats)
+
+    hits = []
+    for pixel, ray in zip(pixels, primary):
+        nearest_object, object_hit = scene.nearest_intersection(ray=ray)
+        if nearest_object is not None:
+            hits.append((pixel, ray, nearest_object, object_hit, object_hit.position + object_hit.normal_to_surface * 1e-5))
+    shadow, reflection = [], []
+    for pixel, ray, nearest_object, object_hit, shifted_point in hits:
+        scene._pixel = pixel
+        to_light = (scene.lights[0]['position'] - shifted_point).normalized() if scene.light_sampling == 'cone' else None
+        shadow += [Ray(origin=shifted_point, direction=direction) for direction, _, _ in scene.shadow_rays(origin=shifted_point, direction_from_intersection_to_light=to_light)]
+        if nearest_object.reflection > 0:
+            reflection.append(Ray(origin=shifted_point, direction=ray.direction.reflected(other_vector=object_hit.normal_to_surface)))
+    stages['shadow'] = best_time(scene.visible_emitter, shadow, repeats)
+    stages['reflection'] = best_time(scene.nearest_intersection, reflection, repeats)
+
+    start = time.perf_counter()
+    for pixel, ray, nearest_object, object_hit, shifted_point in hits:
+        scene._pixel = pixel
+        to_light = (scene.lights[0]['position'] - shifted_point).normalized() if scene.light_sampling == 'cone' else None
+        scene.calculate_lighting(this_object=nearest_object, origin=shifted_point, direction_from_intersection_to_light=to_light, object_hit=object_hit)
+    stages['shading'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = scene.render_tile(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples)
+    stages['render'] = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        write_image(path=os.path.join(directory, 'image.png'), image=image)
+        stages['write'] = time.perf_counter() - start
+
+    wall_times = []
+    for cores_to_use in cores:
+        scene.render_tiles(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, cores_to_use=cores_to_use)
+        wall_times.append(scene.render_statistics['wall_time'])
+    # Speedup over the fewest cores measured
+    scaling = {str(cores_to_use): {'seconds': wall_time, 'speedup': wall_times[0] / wall_time} for cores_to_use, wall_time in zip(cores, wall_times)}
+
+    rays = {'primary': len(primary), 'shadow': len(shadow), 'reflection': len(reflection)}
+    return {
+        'rays': rays,
+        'rays_per_second': {kind: count / stages[kind] if stages[kind] else 0.0 for kind, count in rays.items()},
+        'stage_seconds': stages,
+        'scaling': scaling,
+    }
+
+
+def run_suite(width: int = 64, height: int = 36, max_depth: int = 3, lighting_samples: int = 2, cores: tuple = None) -> dict:
+    # Every reference scene measured in its own process, as one JSON friendly dict
+    # Powers of two up to every core by default
+    cores = cores or tuple(sorted({2 ** power for power in range(cpu_count().bit_length())} | {cpu_count()}))
+    results = {
+        'created': dt.now().isoformat(timespec='seconds'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': cpu_count()},
+        'settings': {'width': width, 'height': height, 'max_depth': max_depth, 'lighting_samples': lighting_samples, 'cores': list(cores)},
+        'scenes': {},
+    }
+    for name in REFERENCE_SCENES:
+        results['scenes'][name] = run_in_child(measure_scene, name, width, height, max_depth, lighting_samples, cores)
+    return results
+
+
+def print_suite(results: dict) -> None:
+    settings = results['settings']
+    print(f'{settings["width"]}x{settings["height"]}, max depth {settings["max_depth"]}, {settings["lighting_samples"] ** 2} light samples per hit')
+    print(f'{"scene":<8} {"primary/s":>10} {"shadow/s":>10} {"reflect/s":>10} {"build (s)":>9} {"shade (s)":>9} {"render (s)":>10} {"peak RSS (MB)":>13}  scaling (cores: speedup)')
+    for name, scene in results['scenes'].items():
+        rates, stages = scene['rays_per_second'], scene['stage_seconds']
+        scaling = ', '.join(f'{cores}: {point["speedup"]:.2f}x' for cores, point in scene['scaling'].items())
+        print(f'{name:<8} {rates["primary"]:>10.0f} {rates["shadow"]:>10.0f} {rates["reflection"]:>10.0f} {stages["build"]:>9.2f} {stages["shading"]:>9.2f} {stages["render"]:>10.2f} {scene["peak_rss_mb"]:>13.1f}  {scaling}')
+
+
+def _metrics(results: dict) -> dict:
+    # Flattened 'scene.group.name' -> value for every number compare_results looks at
+    metrics = {}
+    for name, scene in results['scenes'].items():
+        for group in ('rays_per_second', 'stage_seconds'):
+            for key, value in scene[group].items():
+                metrics[f'{name}.{group}.{key}'] = value
+        for key in ('peak_rss_mb', 'worker_peak_rss_mb'):
+            metrics[f'{name}.{key}'] = scene[key]
+        for cores, point in scene['scaling'].items():
+            metrics[f'{name}.scaling.{cores}.seconds'] = point['seconds']
+    return metrics
+
+
+# Stages quicker than this in both runs are left out of comparisons, being mostly timer noise
+MIN_COMPARED_SECONDS = 0.01
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float = 0.15) -> list:
+    """
+    (metric, baseline value, current value, change, regressed) for every metric in both runs.
+    change is the relative improvement, positive when current is better (faster or smaller),
+    and a metric has regressed when it is worse than baseline by more than tolerance.
+    """
+    old, new = _metrics(baseline), _metrics(current)
+    rows = []
+    for metric in old.keys() & new.keys():
+        before, after = old[metric], new[metric]
+        if not before or not after or ('seconds' in metric and max(before, after) < MIN_COMPARED_SECONDS):
+            continue
+        higher_is_better = '.rays_per_second.' in metric
+        change = after / before - 1.0 if higher_is_better else before / after - 1.0
+        rows.append((metric, before, after, change, change < -tolerance))
+    return sorted(rows)
+
+
+def print_comparison(rows: list, tolerance: float) -> None:
+    print(f'{"metric":<38} {"baseline":>12} {"current":>12} {"change":>8}')
+    for metric, before, after, change, regressed in rows:
+        print(f'{metric:<38} {before:>12.4g} {after:>12.4g} {change:>+8.1%}{"  REGRESSION" if regressed else ""}')
+    regressions = sum(row[4] for row in rows)
+    print(f'{regressions} of {len(rows)} metrics worse than baseline by more than {tolerance:.0%}')
+
+
+def benchmark_suite(results_path: str = 'benchmark_results.json', width: int = 64, height: int = 36, max_depth: int = 3, lighting_samples: int = 2, cores: tuple = None) -> dict:
+    # Rays per second, stage times, peak memory and core scaling of the reference scenes, saved as JSON
+    results = run_suite(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, cores=cores)
+    print_suite(results)
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f'Results saved to {results_path}')
+    return results
+
+
+def benchmark_kernels(width: int = 64, height: int = 36, max_depth: int = 3, lighting_samples: int = 2) -> None:
+    # Closest hit and shadow rays per second of one core rendering each reference scene with either backend, once the kernels are compiled
+    if numba is None:
+        print('numba is not installed, nothing to compare')
+        return
+    tile = Tile(x=0, y=0, width=width, height=height)
+    print(f'{width}x{height}, max depth {max_depth}, {lighting_samples ** 2} light samples per hit')
+    print(f'{"scene":<8} {"python rays/s":>14} {"numba rays/s":>14} {"speedup":>8} {"max difference":>15}')
+    for name, make_scene in REFERENCE_SCENES.items():
+        rates, images = {}, {}
+        for backend in ('python', 'numba'):
+            scene = make_scene()
+            scene.backend = backend
+            # A first pixel compiles the kernels (or loads them from the cache) outside the timing
+            scene.render_tile(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, tile=Tile(x=0, y=0, width=1, height=1))
+            scene.rays_traced = 0
+            start = time.perf_counter()
+            images[backend] = scene.render_tile(width=width, height=height, max_depth=max_depth, lighting_samples=lighting_samples, tile=tile)
+            rates[backend] = scene.rays_traced / (time.perf_counter() - start)
+        difference = float(np.abs(images['python'] - images['numba']).max())
+        print(f'{name:<8} {rates["python"]:>14,.0f} {rates["numba"]:>14,.0f} {rates["numba"] / rates["python"]:>7.1f}x {difference:>15.2e}')
+
+
+BENCHMARKS = {
+    'bvh': benchmark_bvh,
+    'shadow': benchmark_shadow_rays,
+    'scheduler': benchmark_scheduler,
+    'framebuffer': benchmark_framebuffer,
+    'allocations': benchmark_allocations,
+    'triangles': benchmark_triangles,
+    'mesh': benchmark_mesh,
+    'boxes': benchmark_boxes,
+    'camera': benchmark_camera,
+    'sequence': benchmark_sequence,
+    'workers': benchmark_workers,
+    'scenefile': benchmark_scene_file,
+    'materials': benchmark_materials,
+    'lights': benchmark_lights,
+    'samplers': benchmark_samplers,
+    'cone': benchmark_cone,
+    'depth': benchmark_depth,
+    'output': benchmark_output,
+    'suite': benchmark_suite,
+    'instrumentation': benchmark_instrumentation,
+    'kernels': benchmark_kernels,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", help=f"Benchmarks to run ({', '.join(BENCHMARKS)}), all by default", nargs="*")
+    parser.add_argument("--results", help="suite: JSON file to write the results to", default="benchmark_results.json")
+    parser.add_argument(
+        "--compare", help="Compare the suite results against this earlier results file, exiting with status 1 on a regression; "
+                          "without benchmarks to run, compares the existing --results file"
+    )
+    parser.add_argument("--tolerance", help="--compare: relative slowdown allowed before a metric counts as a regression", type=float, default=0.15)
+    arguments = parser.parse_args()
+    unknown = [name for name in arguments.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmark(s): {", ".join(unknown)}')
+
+    results = None
+    for name in arguments.benchmarks or ([] if arguments.compare else BENCHMARKS):
+        print(f'== {name} ==')
+        if name == 'suite':
+            results = benchmark_suite(results_path=arguments.results)
+        else:
+            BENCHMARKS[name]()
+        print()
+
+    if arguments.compare:
+        if results is None:
+            with open(arguments.results) as results_file:
+                results = json.load(results_file)
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['settings'] != results['settings']:
+            print(f'Warning: the runs used different settings, {baseline["settings"]} against {results["settings"]}')
+        rows = compare_results(baseline=baseline, current=results, tolerance=arguments.tolerance)
+        print_comparison(rows=rows, tolerance=arguments.tolerance)
+        if any(row[4] for row in rows):
+            parser.exit(status=1)
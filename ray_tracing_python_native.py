@@ -4,47 +4,27 @@
 # https://www.realtimerendering.com/raytracing/Ray%20Tracing_%20the%20Rest%20of%20Your%20Life.pdf
 # https://github.com/mattgodbolt/pt-three-ways
 # https://www.youtube.com/watch?v=HbzTFCsiWcg
-# TODO - Create Material
-#           Static variables for colors
+# TODO - Static variables for colors
 
 import argparse
 import math
 
+from Camera import Camera
 from CubePrimitive import CubePrimitive
+from ImageWriter import IMAGE_FORMATS, write_image
+from Kernels import KERNEL_BACKENDS
+from MeshPrimitive import MeshPrimitive
 from PlanePrimitive import PlanePrimitive
 from QFunctions.Q_Functions import Q_Vector3d
+from Sampler import SAMPLERS, Sampler
 from Scene import Scene
+from SceneFile import read_scene, write_scene
 from SpherePrimitive import SpherePrimitive
+from TileScheduler import TILE_ORDERS
 from TrianglePrimitive import TrianglePrimitive
 
-if __name__ == "__main__":
-    # Initialize parser
-    parser = argparse.ArgumentParser()
-
-    # Adding optional argument
-    parser.add_argument("--width", help="Width", type=int)
-    parser.add_argument("--height", help="Height", type=int)
-    parser.add_argument("--depth", help="Maximum Depth", type=int)
-    parser.add_argument("--samples", help="Number of Lighting Samples", type=int)
-    parser.add_argument(
-        "--anti-aliasing-enabled", help="Use Anti Aliasing", action="store_true"
-    )
-    parser.add_argument("--cores", help="Number of Cores to Use", type=int)
-
-    # Read arguments from command line
-    arguments = parser.parse_args()
-
-    WIDTH = arguments.width
-    HEIGHT = arguments.height
-    SCALE = 1
-    ANTI_ALIASING = arguments.anti_aliasing_enabled
-    CAMERA = Q_Vector3d(0, 0.1, -1.5)
-    MAX_DEPTH = arguments.depth
-    NUMBER_OF_LIGHTING_SAMPLES = (
-        int(math.sqrt(max(arguments.samples, 1)))
-    )
-    CORES_TO_USE = arguments.cores
 
+def build_scene(camera_position: Q_Vector3d) -> Scene:
     objects = [
         # Spheres
         SpherePrimitive(
@@ -108,13 +88,152 @@ if __name__ == "__main__":
     ]
 
     lights = [{"position": Q_Vector3d(5, 25, 10)}]
-    scene = Scene(camera_position=CAMERA, objects=objects, lights=lights)
+    return Scene(camera_position=camera_position, objects=objects, lights=lights)
+
+
+if __name__ == "__main__":
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+
+    # Adding optional argument
+    parser.add_argument("--width", help="Width", type=int)
+    parser.add_argument("--height", help="Height", type=int)
+    parser.add_argument("--depth", help="Maximum Depth", type=int)
+    parser.add_argument("--samples", help="Number of Lighting Samples", type=int)
+    parser.add_argument(
+        "--anti-aliasing-enabled", help="Use Anti Aliasing", action="store_true"
+    )
+    parser.add_argument("--cores", help="Number of Cores to Use", type=int)
+    parser.add_argument(
+        "--packet", help="Trace rays as NumPy packets instead of one at a time", action="store_true"
+    )
+    parser.add_argument(
+        "--float32", help="Accumulate the image in a float32 framebuffer", action="store_true"
+    )
+    parser.add_argument("--tile-size", help="Width and height of a render tile in pixels", type=int, default=16)
+    parser.add_argument(
+        "--tile-order", help="Order tiles are handed to workers in", choices=TILE_ORDERS, default="spiral"
+    )
+    parser.add_argument(
+        "--light-sampling", help="Aim shadow rays at sampled points on every light, or in a cone around the first light position", choices=Scene.LIGHT_SAMPLING, default="lights"
+    )
+    parser.add_argument(
+        "--roulette-depth", help="Bounce from which paths may be ended by Russian roulette; every path is followed to --depth when not given", type=int, default=Scene.ROULETTE_DEPTH
+    )
+    parser.add_argument(
+        "--sampler", help="Sample pattern for light samples and anti aliasing offsets, scrambled per pixel except for grid", choices=SAMPLERS, default="sobol"
+    )
+    parser.add_argument("--scene", help="Render this scene file instead of the built in scene")
+    parser.add_argument("--save-scene", help="Write the scene, with any --mesh files, to this scene file and exit")
+    parser.add_argument("--mesh", help="OBJ or PLY file to add to the scene", action="append", default=[])
+    parser.add_argument(
+        "--look-at", help="Point the camera at X Y Z instead of through the fixed z = 0 image plane", type=float, nargs=3
+    )
+    parser.add_argument("--fov", help="Horizontal field of view in degrees, with --look-at", type=float, default=90.0)
+    parser.add_argument("--aperture", help="Lens diameter for depth of field, 0 for a pinhole", type=float, default=0.0)
+    parser.add_argument(
+        "--adaptive", help="Supersample only pixels that differ from their neighbours", action="store_true"
+    )
+    parser.add_argument("--max-samples", help="Adaptive mode: most samples spent on one pixel", type=int, default=16)
+    parser.add_argument(
+        "--adaptive-threshold", help="Adaptive mode: contrast and standard error that trigger more samples", type=float, default=0.05
+    )
+    parser.add_argument(
+        "--progressive", help="Render in passes, saving a preview and a resumable checkpoint as it goes", action="store_true"
+    )
+    parser.add_argument("--target-samples", help="Progressive mode: stop after this many samples per pixel", type=int)
+    parser.add_argument("--time-budget", help="Progressive mode: stop starting new passes after this many seconds", type=float)
+    parser.add_argument("--checkpoint", help="Progressive mode: checkpoint file", default="render_checkpoint.npz")
+    parser.add_argument(
+        "--output", help=f"Image file to write, repeat for several ({', '.join(IMAGE_FORMATS)}), image.png and image.ppm by default", action="append"
+    )
+
+    parser.add_argument(
+        "--instrument", help="Count rays and intersection tests, time each render stage and save a tile cost heatmap", action="store_true"
+    )
 
-    scene.multi_render(
-        width=WIDTH * SCALE,
-        height=HEIGHT * SCALE,
-        max_depth=MAX_DEPTH,
-        anti_aliasing=ANTI_ALIASING,
-        lighting_samples=NUMBER_OF_LIGHTING_SAMPLES,
-        cores_to_use=CORES_TO_USE,
+    parser.add_argument("--quiet", help="Print nothing while rendering, for batch jobs", action="store_true")
+    parser.add_argument(
+        "--backend", help="Intersect and shade with the Python objects, or with compiled kernels (needs numba, falls back to python without it)", choices=KERNEL_BACKENDS, default="python"
     )
+
+    # Read arguments from command line
+    arguments = parser.parse_args()
+
+    WIDTH = arguments.width
+    HEIGHT = arguments.height
+    OUTPUT = arguments.output or ["image.png", "image.ppm"]
+    SCALE = 1
+    ANTI_ALIASING = arguments.anti_aliasing_enabled
+    CAMERA = Q_Vector3d(0, 0.1, -1.5)
+    MAX_DEPTH = arguments.depth
+    NUMBER_OF_LIGHTING_SAMPLES = (
+        int(math.sqrt(max(arguments.samples, 1)))
+    )
+    CORES_TO_USE = arguments.cores
+
+    if arguments.scene:
+        scene = read_scene(path=arguments.scene)
+    else:
+        scene = build_scene(camera_position=CAMERA)
+    scene.light_sampling = arguments.light_sampling
+    scene.sampler = Sampler(kind=arguments.sampler)
+    scene.roulette_depth = arguments.roulette_depth or None
+    scene.backend = arguments.backend
+    if not arguments.scene or arguments.look_at:
+        scene.camera = Camera(
+            position=scene.camera.position,
+            look_at=Q_Vector3d(*arguments.look_at) if arguments.look_at else None,
+            fov=arguments.fov,
+            aperture=arguments.aperture,
+        )
+    for path in arguments.mesh:
+        scene.objects.append(
+            MeshPrimitive.load(
+                path=path,
+                ambient=Q_Vector3d(0.1, 0.1, 0.1),
+                diffuse=Q_Vector3d(0.6, 0.6, 0.6),
+                specular=Q_Vector3d(1, 1, 1),
+                shininess=50,
+                reflection=0.1,
+            )
+        )
+
+    if arguments.save_scene:
+        write_scene(scene=scene, path=arguments.save_scene)
+    elif arguments.progressive:
+        image = scene.progressive_render(
+            width=WIDTH * SCALE,
+            height=HEIGHT * SCALE,
+            max_depth=MAX_DEPTH,
+            lighting_samples=NUMBER_OF_LIGHTING_SAMPLES,
+            cores_to_use=CORES_TO_USE,
+            packet=arguments.packet,
+            tile_size=arguments.tile_size,
+            tile_order=arguments.tile_order,
+            target_samples=arguments.target_samples,
+            time_budget=arguments.time_budget,
+            checkpoint_path=arguments.checkpoint,
+            quiet=arguments.quiet,
+        )
+        for path in OUTPUT:
+            write_image(path=path, image=image)
+    else:
+        scene.multi_render(
+            width=WIDTH * SCALE,
+            height=HEIGHT * SCALE,
+            max_depth=MAX_DEPTH,
+            anti_aliasing=ANTI_ALIASING,
+            lighting_samples=NUMBER_OF_LIGHTING_SAMPLES,
+            cores_to_use=CORES_TO_USE,
+            packet=arguments.packet,
+            tile_size=arguments.tile_size,
+            tile_order=arguments.tile_order,
+            framebuffer_dtype="float32" if arguments.float32 else "float64",
+            adaptive=arguments.adaptive,
+            max_samples=arguments.max_samples,
+            adaptive_threshold=arguments.adaptive_threshold,
+            output=OUTPUT,
+            instrument=arguments.instrument,
+            quiet=arguments.quiet,
+        )
@@ -1,13 +1,43 @@
+import contextlib
+import gc
+import io
 import math
+import os
+import pickle
+import random
+import struct
+import tempfile
+import warnings
+import zlib
 
 import numpy as np
 
+from AccumulationBuffer import AccumulationBuffer
+import benchmarks
+from BoundingBox import BoundingBox, inverse_direction
+from Camera import Camera
+from CubePrimitive import CubePrimitive
+from FrameBuffer import SharedFrameBuffer
 from Hit import Hit
+from ImageWriter import IMAGE_FORMATS, ImageWriter
+from Instrumentation import Instrumentation
+from Kernels import KernelScene, numba, visible_emitter
+from LightRegistry import LightRegistry
+from Material import MATERIALS, Material
+from MeshPrimitive import MeshPrimitive
 from OrthoNormalBasis import OrthoNormalBasis
-from QFunctions.Q_Functions import Q_buckets, Q_Vector3d
+from PacketRenderer import PacketRenderer
+from PlanePrimitive import PlanePrimitive
+from Progress import Progress
+from QFunctions.Q_Functions import Q_buckets, Q_map, Q_Vector3d
 from Ray import Ray
+import RenderWorker
+from Sampler import SAMPLERS, Sampler, blue_noise_mask
 from Scene import Scene
+from SceneFile import read_scene, write_scene
 from SpherePrimitive import SpherePrimitive
+from TileScheduler import Tile, generate_tiles, order_tiles
+from TriangleMesh import TriangleMesh
 from TrianglePrimitive import TrianglePrimitive
 
 
@@ -402,6 +432,818 @@ def test_Scene_nearest_intersection_with_two_object():
     assert nearest_object is not None and hit is not None and hit.distance == 40
 
 
+def test_BoundingBox_intersect():
+    box = BoundingBox(minimum=(-1, -1, -1), maximum=(1, 1, 1))
+    assert box.intersect(origin=(0, 0, -5), inverse_direction=inverse_direction(Q_Vector3d(0, 0, 1))) == 4
+    assert box.intersect(origin=(0, 0, 0), inverse_direction=inverse_direction(Q_Vector3d(0, 0, 1))) == 0
+    assert box.intersect(origin=(0, 5, -5), inverse_direction=inverse_direction(Q_Vector3d(0, 0, 1))) is None
+    assert box.intersect(origin=(0, 0, -5), inverse_direction=inverse_direction(Q_Vector3d(0, 0, 1)), max_distance=3) is None
+    flat = BoundingBox(minimum=(-1, 0, -1), maximum=(1, 0, 1))
+    assert flat.minimum[1] < 0 < flat.maximum[1]
+
+
+def test_Scene_bvh_matches_linear_scan():
+    rng = random.Random(7)
+    colour = Q_Vector3d(0, 0, 0)
+    objects = []
+    for _ in range(40):
+        centre = Q_Vector3d(rng.uniform(-20, 20), rng.uniform(-20, 20), rng.uniform(10, 60))
+        objects.append(SpherePrimitive(position=centre, radius=rng.uniform(0.5, 3), ambient=colour, diffuse=colour, specular=colour, shininess=0, reflection=0))
+        objects.append(TrianglePrimitive((centre + Q_Vector3d(2, 0, 0), centre + Q_Vector3d(0, 2, 1), centre + Q_Vector3d(-2, -1, 0)), ambient=colour, diffuse=colour, specular=colour, shininess=0, reflection=0))
+    objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-50, -25, 0), rear_top_right=Q_Vector3d(50, -25, 80), ambient=colour, diffuse=colour, specular=colour, shininess=0, reflection=0))
+    linear = Scene(camera_position=Q_Vector3d(0, 0, 0), objects=objects, use_bvh=False)
+    accelerated = Scene(camera_position=Q_Vector3d(0, 0, 0), objects=objects)
+    accelerated.build_acceleration_structure()
+    assert accelerated.bvh is not None
+    for _ in range(300):
+        ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(rng.uniform(-30, 30), rng.uniform(-30, 30), 40))
+        linear_object, linear_hit = linear.nearest_intersection(ray=ray)
+        bvh_object, bvh_hit = accelerated.nearest_intersection(ray=ray)
+        assert linear_object is bvh_object
+        if linear_hit is not None:
+            assert math.fabs(linear_hit.distance - bvh_hit.distance) < 1e-9
+
+
+def make_test_scene(**kwargs) -> Scene:
+    grey = Q_Vector3d(0.5, 0.5, 0.5)
+    white = Q_Vector3d(1, 1, 1)
+    objects = [
+        SpherePrimitive(position=Q_Vector3d(2, -1, 20), radius=3, ambient=Q_Vector3d(0.1, 0, 0.1), diffuse=Q_Vector3d(0.7, 0, 0.7), specular=white, shininess=20, reflection=0.3),
+        SpherePrimitive(position=Q_Vector3d(-4, 1, 25), radius=2, ambient=Q_Vector3d(0, 0.1, 0.1), diffuse=Q_Vector3d(0, 0.7, 0.7), specular=white, shininess=40, reflection=0),
+        PlanePrimitive(front_bottom_left=Q_Vector3d(-50, -5, -10), rear_top_right=Q_Vector3d(50, -5, 100), ambient=grey, diffuse=grey, specular=white, shininess=100, reflection=0.4),
+        PlanePrimitive(front_bottom_left=Q_Vector3d(-5, 15, 15), rear_top_right=Q_Vector3d(5, 25, 15), ambient=white, diffuse=white, specular=white, shininess=100, reflection=0, emission=Q_Vector3d(0.5, 0.5, 0.5)),
+    ]
+    return Scene(camera_position=Q_Vector3d(0, 0.1, -1.5), objects=objects, lights=[{'position': Q_Vector3d(0, 20, 15)}], **kwargs)
+
+
+def test_PacketRenderer_cone_sample_matches_scalar():
+    directions = [Q_Vector3d(0, 1, 0), Q_Vector3d(1, 0, 0), Q_Vector3d.get_normalized_vector(x=-0.2, y=0.5, z=0.8)]
+    array = np.array([[d.x, d.y, d.z] for d in directions])
+    for u, v in ((0.0, 0.0), (0.5, 0.25), (0.75, 0.5)):
+        samples = PacketRenderer.cone_sample(array, math.pi / 56.0, u, v)
+        for direction, sample in zip(directions, samples):
+            expected = OrthoNormalBasis.cone_sample(direction=direction, cone_theta=math.pi / 56.0, u=u, v=v)
+            assert np.allclose(sample, expected.to_tuple(), atol=1e-9)
+
+
+def test_Scene_render_packet_matches_scalar():
+    scene = make_test_scene()
+    scalar = scene.render(width=16, height=12, max_depth=2, anti_aliasing=True, lighting_samples=2)
+    packet = scene.render_packet(width=16, height=12, max_depth=2, anti_aliasing=True, lighting_samples=2)
+    assert scalar.shape == packet.shape
+    assert np.mean(np.abs(scalar - packet) > 1e-6) < 0.01
+    assert np.abs(scalar - packet).mean() < 1e-4
+
+
+def test_Primitive_hit_distance_matches_intersect():
+    rng = random.Random(3)
+    for object in make_test_scene().objects:
+        for _ in range(100):
+            ray = Ray.from_two_vectors(Q_Vector3d(rng.uniform(-5, 5), rng.uniform(-5, 5), 0), Q_Vector3d(rng.uniform(-20, 20), rng.uniform(-10, 20), 20))
+            hit = object.intersect(ray=ray)
+            expected = hit.distance if hit else math.inf
+            assert object.hit_distance(ray=ray) == expected or math.fabs(object.hit_distance(ray=ray) - expected) < 1e-9
+
+
+def test_Scene_visible_emitter_matches_nearest_intersection():
+    rng = random.Random(5)
+    for use_bvh in (True, False):
+        scene = make_test_scene(use_bvh=use_bvh)
+        scene.build_acceleration_structure()
+        for _ in range(300):
+            origin = Q_Vector3d(rng.uniform(-10, 10), -4.9, rng.uniform(5, 40))
+            ray = Ray.from_two_vectors(origin, Q_Vector3d(rng.uniform(-6, 6), 15, rng.uniform(10, 20)))
+            nearest_object, _ = scene.nearest_intersection(ray=ray)
+            expected = nearest_object if nearest_object is not None and nearest_object.is_emissive else None
+            assert scene.visible_emitter(ray=ray) is expected
+
+
+def test_TileScheduler_tiles_cover_frame():
+    for width, height, tile_size in ((64, 48, 16), (50, 37, 16), (7, 5, 8)):
+        coverage = np.zeros((height, width), dtype=int)
+        tiles = generate_tiles(width=width, height=height, tile_size=tile_size)
+        for tile in tiles:
+            assert 0 < tile.width <= tile_size and 0 < tile.height <= tile_size
+            coverage[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] += 1
+        assert (coverage == 1).all()
+        for order in ('spiral', 'scanline'):
+            assert sorted(order_tiles(tiles=tiles, width=width, height=height, order=order)) == sorted(tiles)
+
+
+def test_TileScheduler_spiral_starts_in_centre():
+    tiles = order_tiles(tiles=generate_tiles(width=80, height=80, tile_size=16), width=80, height=80, order='spiral')
+    assert tiles[0] == Tile(x=32, y=32, width=16, height=16)
+    cost_ordered = order_tiles(tiles=tiles, width=80, height=80, order='cost', estimate_cost=lambda tile: tile.x + tile.y)
+    assert cost_ordered[0] == Tile(x=64, y=64, width=16, height=16)
+
+
+def test_Scene_render_tile_matches_render():
+    scene = make_test_scene()
+    image = scene.render(width=12, height=9, max_depth=2, lighting_samples=1)
+    tile = Tile(x=4, y=3, width=5, height=4)
+    pixels = scene.render_tile(width=12, height=9, max_depth=2, lighting_samples=1, tile=tile)
+    assert pixels.shape == (4, 5, 3)
+    assert np.allclose(pixels, image[3:7, 4:9])
+
+
+def test_SharedFrameBuffer_workers_write_tiles():
+    with SharedFrameBuffer(width=20, height=10, dtype='float32') as framebuffer:
+        attached = pickle.loads(pickle.dumps(framebuffer))
+        assert attached.name == framebuffer.name and not attached.owner
+        attached.write_tile(tile=Tile(x=4, y=2, width=3, height=2), pixels=np.ones((2, 3, 3)))
+        image = framebuffer.to_array()
+    assert image.dtype == np.float32
+    assert image.sum() == 2 * 3 * 3
+    assert (image[2:4, 4:7] == 1).all()
+
+    # A new buffer replaces the attachment to the last one instead of mapping both for good
+    with SharedFrameBuffer(width=4, height=4) as framebuffer:
+        replacement = pickle.loads(pickle.dumps(framebuffer))
+        assert attached.array is None and replacement.array is not None
+        assert pickle.loads(pickle.dumps(framebuffer)) is replacement
+
+
+def test_Scene_render_tiles_matches_render():
+    scene = make_test_scene()
+    expected = scene.render(width=12, height=9, max_depth=2, lighting_samples=1)
+    for shared in (True, False):
+        image = scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=4, shared_framebuffer=shared)
+        assert np.allclose(image, expected)
+    image = scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=5, tile_order='cost', framebuffer_dtype='float32')
+    assert image.dtype == np.float32 and np.allclose(image, expected, atol=1e-6)
+
+
+def test_Hit_position_is_lazy():
+    ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(0, 0, 2))
+    hit = Hit(distance=5, normal_to_surface=Q_Vector3d(0, 0, -1), is_inside=False, ray=ray)
+    assert hit.position == Q_Vector3d(0, 0, 5)
+    record = Hit()
+    s = SpherePrimitive(position=Q_Vector3d(0, 0, 30), radius=10, ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    assert s.intersect(ray=ray, hit=record) is record
+    assert math.fabs(record.distance - 20) < 0.00001 and (record.position - Q_Vector3d(0, 0, 20)).length < 0.00001
+
+
+def test_PlanePrimitive_miss_returns_none():
+    plane = make_test_scene().objects[2]
+    assert plane.intersect(ray=Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(0, 1, 0))) is None
+    hit = plane.intersect(ray=Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(0, -5, 5)))
+    assert hit is not None and (hit.position - Q_Vector3d(0, -5, 5)).length < 0.00001
+    assert (hit.normal_to_surface - Q_Vector3d(0, 1, 0)).length < 0.00001
+
+
+def test_TrianglePrimitive_precomputed_and_read_only():
+    t = TrianglePrimitive(
+        (Q_Vector3d(0, 0, 3), Q_Vector3d(0, 1, 3), Q_Vector3d(1, 1, 3)),
+        ambient=Q_Vector3d(0, 0, 0),
+        diffuse=Q_Vector3d(0, 0, 0),
+        specular=Q_Vector3d(0, 0, 0),
+        shininess=0,
+        reflection=0,
+    )
+    assert t.u_vector is t.u_vector and t.face_normal is t.face_normal
+    assert t.face_normal == Q_Vector3d(0, 0, -1)
+    assert t.bounding_box().minimum[0] == 0 and t.bounding_box().maximum[1] == 1
+    try:
+        t.vertices = (Q_Vector3d(0, 0, 0), Q_Vector3d(0, 0, 0), Q_Vector3d(0, 0, 0))
+        assert False, 'vertices should be read-only'
+    except AttributeError:
+        pass
+
+
+def test_TriangleMesh_matches_TrianglePrimitive():
+    rng = random.Random(11)
+    colour = Q_Vector3d(0, 0, 0)
+    triangles = []
+    for _ in range(50):
+        corner = Q_Vector3d(rng.uniform(-5, 5), rng.uniform(-5, 5), rng.uniform(5, 15))
+        triangles.append(TrianglePrimitive((corner, corner + Q_Vector3d(rng.uniform(-3, 3), rng.uniform(-3, 3), 0), corner + Q_Vector3d(rng.uniform(-3, 3), 0, rng.uniform(-3, 3))), ambient=colour, diffuse=colour, specular=colour, shininess=0, reflection=0))
+    mesh = TriangleMesh.from_triangles(triangles)
+    assert len(mesh) == 50
+    for _ in range(100):
+        ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(rng.uniform(-5, 5), rng.uniform(-5, 5), 10))
+        origin = (ray.origin.x, ray.origin.y, ray.origin.z)
+        direction = (ray.direction.x, ray.direction.y, ray.direction.z)
+        expected = [triangle.hit_distance(ray=ray) for triangle in triangles]
+        assert np.allclose(mesh.hit_distances(origin=origin, direction=direction), expected)
+        nearest = mesh.nearest(origin=origin, direction=direction)
+        if min(expected) == math.inf:
+            assert nearest is None
+        else:
+            assert math.fabs(nearest[0] - min(expected)) < 1e-9
+            hit = triangles[nearest[1]].intersect(ray=ray)
+            assert (Q_Vector3d(*mesh.normal(index=nearest[1], direction=direction)) - hit.normal_to_surface).length < 1e-9
+
+
+def make_test_mesh_corners(count: int = 200, seed: int = 8) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform((-6, -4, 12), (6, 4, 30), size=(count, 1, 3))
+    return centres + rng.uniform(-1, 1, size=(count, 3, 3))
+
+
+def test_MeshPrimitive_loads_obj_and_ply():
+    corners = make_test_mesh_corners(count=20)
+    vertices = corners.reshape(-1, 3)
+    with tempfile.TemporaryDirectory() as directory:
+        obj_path = os.path.join(directory, 'mesh.obj')
+        with open(obj_path, 'w') as obj:
+            obj.writelines(f'v {x} {y} {z}\n' for x, y, z in vertices)
+            obj.writelines(f'f {3 * i + 1} {3 * i + 2}/1 {3 * i + 3}/1/1\n' for i in range(len(corners) - 1))
+            obj.write('f -3 -2 -1\n')
+        ply_path = os.path.join(directory, 'mesh.ply')
+        with open(ply_path, 'wb') as ply:
+            ply.write(f'ply\nformat binary_little_endian 1.0\nelement vertex {len(vertices)}\nproperty float x\nproperty float y\nproperty float z\nelement face {len(corners)}\nproperty list uchar int vertex_indices\nend_header\n'.encode('ascii'))
+            ply.write(vertices.astype('<f4').tobytes())
+            faces = np.zeros(len(corners), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+            faces['count'] = 3
+            faces['indices'] = np.arange(len(vertices)).reshape(-1, 3)
+            ply.write(faces.tobytes())
+        material = dict(ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+        from_obj = MeshPrimitive.load(path=obj_path, **material)
+        from_ply = MeshPrimitive.load(path=ply_path, **material)
+        assert len(from_obj) == len(from_ply) == len(corners)
+        assert np.allclose(np.sort(from_obj.mesh.vertices, axis=0), np.sort(corners, axis=0))
+        assert np.allclose(np.sort(from_ply.mesh.vertices, axis=0), np.sort(corners.astype(np.float32), axis=0))
+
+
+def test_MeshPrimitive_matches_triangles():
+    rng = random.Random(8)
+    corners = make_test_mesh_corners()
+    material = dict(ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    mesh = MeshPrimitive(vertices=corners.reshape(-1, 3), faces=np.arange(3 * len(corners)).reshape(-1, 3), **material)
+    triangles = [TrianglePrimitive(vertices=tuple(Q_Vector3d(*vertex) for vertex in triangle), **material) for triangle in corners.tolist()]
+    for _ in range(200):
+        ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(rng.uniform(-8, 8), rng.uniform(-6, 6), 20))
+        expected = min(triangle.hit_distance(ray=ray) for triangle in triangles)
+        hit = mesh.intersect(ray=ray)
+        if expected == math.inf:
+            assert hit is None and mesh.hit_distance(ray=ray) == math.inf
+        else:
+            assert math.fabs(hit.distance - expected) < 1e-9
+            assert hit.normal_to_surface.dot_product(ray.direction) <= 0
+        assert mesh.occludes(ray=ray, max_distance=15) == (expected < 15)
+
+
+def test_CubePrimitive_slab_matches_faces():
+    rng = random.Random(9)
+    material = dict(ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    cube = CubePrimitive(front_bottom_left=Q_Vector3d(-1, -2, 3), rear_top_right=Q_Vector3d(1, 2, 5), **material)
+    for _ in range(500):
+        origin = Q_Vector3d(rng.uniform(-3, 3), rng.uniform(-3, 3), rng.uniform(-1, 6))
+        ray = Ray.from_two_vectors(origin, Q_Vector3d(rng.uniform(-3, 3), rng.uniform(-3, 3), rng.uniform(0, 8)))
+        hits = [face.intersect(ray=ray) for face in cube.faces]
+        hits = [hit for hit in hits if hit is not None]
+        hit = cube.intersect(ray=ray)
+        if not hits:
+            assert hit is None
+            continue
+        expected = min(hits, key=lambda face_hit: face_hit.distance)
+        assert math.fabs(hit.distance - expected.distance) < 1e-9
+        assert (hit.normal_to_surface - expected.normal_to_surface).length < 1e-9
+        assert hit.is_inside == (-1 < origin.x < 1 and -2 < origin.y < 2 and 3 < origin.z < 5)
+        assert (hit.position - ray.position_at_distance(hit.distance)).length < 1e-9
+
+
+def test_CubePrimitive_rotated_uses_faces():
+    material = dict(ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    cube = CubePrimitive(front_bottom_left=Q_Vector3d(-1, -1, 3), rear_top_right=Q_Vector3d(1, 1, 5), rotation=(0, math.pi / 4, 0), **material)
+    hit = cube.intersect(ray=Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(0, 0, 1)))
+    assert math.fabs(hit.distance - (4 - math.sqrt(2))) < 1e-9 and not hit.is_inside
+    assert cube.intersect(ray=Ray.from_two_vectors(Q_Vector3d(0, 0, 4), Q_Vector3d(0, 0, 5))).is_inside
+    assert cube.bounding_box().maximum[0] > 1.4
+
+
+def test_PlanePrimitive_analytic_in_every_axis():
+    material = dict(ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    planes = (
+        (Q_Vector3d(2, -1, -1), Q_Vector3d(2, 3, 3), Q_Vector3d(-1, 0, 0)),
+        (Q_Vector3d(-1, 2, -1), Q_Vector3d(3, 2, 3), Q_Vector3d(0, -1, 0)),
+        (Q_Vector3d(-1, -1, 2), Q_Vector3d(3, 3, 2), Q_Vector3d(0, 0, -1)),
+    )
+    for front_bottom_left, rear_top_right, normal in planes:
+        plane = PlanePrimitive(front_bottom_left=front_bottom_left, rear_top_right=rear_top_right, **material)
+        ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(1, 1, 1))
+        hit = plane.intersect(ray=ray)
+        assert plane.axis is not None
+        assert math.fabs(hit.distance - 2 * math.sqrt(3)) < 1e-9
+        assert hit.normal_to_surface == normal
+        assert math.fabs(min(face.hit_distance(ray=ray) for face in plane.faces) - hit.distance) < 1e-9
+
+
+def test_Scene_progressive_render_resumes_from_checkpoint():
+    scene = make_test_scene()
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint_path = os.path.join(directory, 'checkpoint.npz')
+        preview_path = os.path.join(directory, 'preview.png')
+        settings = dict(width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=4, checkpoint_path=checkpoint_path, preview_path=preview_path)
+        scene.progressive_render(target_samples=4, **settings)
+        assert AccumulationBuffer.load(path=checkpoint_path).passes == 4 and os.path.exists(preview_path)
+        # Passes share one pool and one BVH, nothing is rebuilt per pass
+        bvh = scene.bvh
+        image = scene.progressive_render(target_samples=9, **settings)
+        assert scene.bvh is bvh
+        checkpoint = AccumulationBuffer.load(path=checkpoint_path)
+        assert checkpoint.passes == 9 and (checkpoint.samples == 9).all()
+        expected = scene.render(width=12, height=9, max_depth=2, anti_aliasing=True, lighting_samples=1)
+        # The full render clamps after averaging, the progressive one clamps each pass
+        assert np.abs(image - expected).mean() < 0.01
+        # A checkpoint from another sampler, light sampling mode or roulette depth is not resumed
+        for name, value in (('sampler', Sampler(kind='grid' if scene.sampler.kind != 'grid' else 'halton')), ('light_sampling', 'cone' if scene.light_sampling != 'cone' else 'lights'), ('roulette_depth', 1)):
+            changed = make_test_scene()
+            setattr(changed, name, value)
+            try:
+                changed.progressive_render(target_samples=10, **settings)
+                assert False, 'expected a ValueError'
+            except ValueError:
+                pass
+
+
+def test_Scene_adaptive_anti_aliasing_refines_edges_only():
+    scene = make_test_scene()
+    plain = scene.render(width=16, height=12, max_depth=2, anti_aliasing=False, lighting_samples=1)
+    pixels, samples = scene.render_tile_adaptive(width=16, height=12, max_depth=2, lighting_samples=1, max_samples=9, threshold=math.inf)
+    assert np.allclose(pixels, plain) and (samples == 1).all()
+    image = scene.render_tiles(width=16, height=12, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=5, adaptive=(9, 0.05))
+    assert image.shape == plain.shape
+    assert scene.sample_counts.max() == 9 and 1 < scene.render_statistics['samples_per_pixel'] < 9
+    # Flat pixels keep their single centred sample
+    assert np.allclose(image[scene.sample_counts == 1], plain[scene.sample_counts == 1])
+
+
+def test_Camera_legacy_matches_original_mapping():
+    camera = Camera(position=Q_Vector3d(0, 0.1, -1.5))
+    width, height = 16, 12
+    screen_ratio = float(width) / float(height)
+    for x, y, offset in ((0, 0, (0, 0)), (15, 11, (0, 0)), (7, 5, (0.01, -0.02))):
+        yy = Q_map(value=-y, lower_limit=-(height - 1), upper_limit=0, scaled_lower_limit=-1 / screen_ratio, scaled_upper_limit=1 / screen_ratio)
+        xx = Q_map(value=x, lower_limit=0, upper_limit=width - 1, scaled_lower_limit=-1.0, scaled_upper_limit=1.0)
+        expected = (Q_Vector3d(xx + offset[0], yy + offset[1], 0) - camera.position).normalized()
+        ray = camera.primary_ray(x=x, y=y, width=width, height=height, offset=offset)
+        assert (ray.direction - expected).length < 1e-12
+        origins, directions = camera.rays(width=width, height=height, xs=[x], ys=[y], offsets=np.array([offset]))
+        assert np.allclose(directions[0], expected.to_tuple()) and np.allclose(origins[0], camera.position.to_tuple())
+
+
+def test_Camera_look_at_and_fov():
+    camera = Camera(position=Q_Vector3d(1, 2, 3), look_at=Q_Vector3d(1, 2, 13), fov=90)
+    _, directions = camera.grid(width=21, height=11)
+    assert np.allclose(directions[5, 10], (0, 0, 1))
+    # The edge columns sit half the field of view either side of the view direction
+    assert np.allclose(directions[5, 0], (-math.sqrt(0.5), 0, math.sqrt(0.5)))
+    assert np.allclose(directions[5, 20], (math.sqrt(0.5), 0, math.sqrt(0.5)))
+    assert directions[0, 10, 1] > 0
+    assert (camera.primary_ray(x=0, y=5, width=21, height=11).direction - Q_Vector3d(*directions[5, 0])).length < 1e-12
+    camera.set(look_at=Q_Vector3d(11, 2, 3))
+    assert np.allclose(camera.grid(width=21, height=11)[1][5, 10], (1, 0, 0))
+
+
+def test_BVH_refit_after_translate_matches_linear_scan():
+    rng = random.Random(13)
+    scene = make_test_scene()
+    scene.build_acceleration_structure()
+    scene.apply_frame(frame={'offsets': {0: Q_Vector3d(-6, 2, 5), 2: Q_Vector3d(0, 1, 0)}})
+    linear = make_test_scene(use_bvh=False)
+    linear.objects[0].translate(offset=Q_Vector3d(-6, 2, 5))
+    linear.objects[2].translate(offset=Q_Vector3d(0, 1, 0))
+    assert scene.bvh.node_bounds[0, 1] <= -4
+    for _ in range(300):
+        ray = Ray.from_two_vectors(Q_Vector3d(0, 0.1, -1.5), Q_Vector3d(rng.uniform(-10, 10), rng.uniform(-6, 6), 10))
+        expected, expected_hit = linear.nearest_intersection(ray=ray)
+        nearest, hit = scene.nearest_intersection(ray=ray)
+        assert (nearest is None) == (expected is None)
+        if nearest is not None:
+            assert math.fabs(hit.distance - expected_hit.distance) < 1e-9
+
+
+def test_BVH_python_lists_are_lazy_and_not_pickled():
+    mesh = MeshPrimitive.from_packed(corners=make_test_mesh_corners(), ambient=Q_Vector3d(0, 0, 0), diffuse=Q_Vector3d(0, 0, 0), specular=Q_Vector3d(0, 0, 0), shininess=0, reflection=0)
+    assert mesh.bvh._cached_lists is None
+    ray = Ray.from_two_vectors(Q_Vector3d(0, 0, 0), Q_Vector3d(0.5, 0.5, 20))
+    distance = mesh.hit_distance(ray=ray)
+    assert mesh.bvh._cached_lists is not None
+    copy = pickle.loads(pickle.dumps(mesh))
+    assert copy.bvh._cached_lists is None and copy.hit_distance(ray=ray) == distance
+    mesh.translate(offset=Q_Vector3d(0, 0, 1))
+    assert mesh.bvh._cached_lists is None
+
+
+def test_Scene_render_sequence_matches_single_frames():
+    frames = [
+        {},
+        {'offsets': {0: Q_Vector3d(-2, 1, 0)}},
+        {'offsets': {0: Q_Vector3d(-4, 2, 0)}, 'camera': {'position': Q_Vector3d(0.5, 0.5, -2)}},
+    ]
+    images = make_test_scene().render_sequence(frames=frames, width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=4, output=None)
+    assert len(images) == 3
+    for frame, image in zip(frames, images):
+        scene = make_test_scene()
+        scene.apply_frame(frame=frame)
+        assert np.allclose(image, scene.render(width=12, height=9, max_depth=2, lighting_samples=1))
+    assert not np.allclose(images[0], images[2])
+
+    # One tile per frame on more workers than that, so workers miss frames and must still see their changes
+    frames = [{}, {'camera': {'position': Q_Vector3d(3, 2, -4)}, 'offsets': {0: Q_Vector3d(-2, 1, 0)}}, {}, {'offsets': {1: Q_Vector3d(1, 0, 0)}}]
+    images = make_test_scene().render_sequence(frames=frames, width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=4, tile_size=64, output=None)
+    scene = make_test_scene()
+    for frame, image in zip(frames, images):
+        scene.apply_frame(frame=frame)
+        assert np.allclose(image, scene.render(width=12, height=9, max_depth=2, lighting_samples=1))
+
+
+def test_Scene_worker_pool_tasks_carry_tiles_only():
+    scene = make_test_scene()
+    tile = Tile(0, 0, 4, 4)
+    task = (12, 9, 2, False, 1, tile, False, None, None, None, 0)
+    assert len(pickle.dumps(task)) < len(pickle.dumps(scene)) / 10
+    with scene.worker_pool(cores_to_use=2) as pool:
+        _, pixels, _, _, _, _ = pool.apply(RenderWorker.render_tile, (task,))
+        image = scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=1, cores_to_use=2, tile_size=4, pool=pool)
+    expected = scene.render(width=12, height=9, max_depth=2, lighting_samples=1)
+    assert np.allclose(pixels, expected[:4, :4]) and np.allclose(image, expected)
+
+
+def test_SceneFile_round_trip_renders_the_same():
+    scene = make_test_scene()
+    white = Q_Vector3d(1, 1, 1)
+    material = dict(ambient=Q_Vector3d(0.1, 0.1, 0), diffuse=Q_Vector3d(0.6, 0.6, 0), specular=white, shininess=30, reflection=0.2)
+    scene.objects.append(CubePrimitive(front_bottom_left=Q_Vector3d(3, -5, 16), rear_top_right=Q_Vector3d(6, -2, 19), rotation=(0.3, 0.5, 0), **material))
+    scene.objects.append(CubePrimitive(front_bottom_left=Q_Vector3d(-8, -5, 18), rear_top_right=Q_Vector3d(-6, -3, 20), **material))
+    scene.objects.append(TrianglePrimitive((Q_Vector3d(-2, 2, 15), Q_Vector3d(0, 4, 15), Q_Vector3d(1, 2, 16)), **material))
+    scene.objects.append(MeshPrimitive.from_packed(corners=make_test_mesh_corners() * 0.2 + (0, 3, 22), **material))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'scene.bin')
+        write_scene(scene=scene, path=path)
+        loaded = read_scene(path=path)
+        assert [type(primitive) for primitive in loaded.objects] == [type(primitive) for primitive in scene.objects[:-2]] + [MeshPrimitive, MeshPrimitive]
+        assert np.array_equal(loaded.objects[-1].bvh.node_bounds, scene.objects[-1].bvh.node_bounds)
+        # Every primitive with the same material shares one set of colour vectors
+        assert loaded.objects[-1].diffuse is loaded.objects[-2].diffuse
+        expected = scene.render(width=16, height=12, max_depth=2, lighting_samples=1)
+        assert np.allclose(loaded.render(width=16, height=12, max_depth=2, lighting_samples=1), expected)
+        write_scene(scene=scene, path=path, bvh=False)
+        assert np.allclose(read_scene(path=path, mmap=False).render(width=16, height=12, max_depth=2, lighting_samples=1), expected)
+
+
+def test_Material_registry_shares_ids():
+    grey = Q_Vector3d(0.5, 0.5, 0.5)
+    cube = CubePrimitive(front_bottom_left=Q_Vector3d(0, 0, 0), rear_top_right=Q_Vector3d(1, 1, 1), ambient=grey, diffuse=Q_Vector3d(0.25, 0.5, 0.75), specular=grey, shininess=10, reflection=0.5)
+    sphere = SpherePrimitive(position=Q_Vector3d(0, 0, 5), radius=1, material=Material(ambient=Q_Vector3d(0.5, 0.5, 0.5), diffuse=Q_Vector3d(0.25, 0.5, 0.75), specular=grey, shininess=10, reflection=0.5))
+    assert sphere.material_id == cube.material_id and all(face.material_id == cube.material_id for face in cube.faces)
+    assert sphere.diffuse is cube.diffuse and sphere.reflection == 0.5
+    arrays = MATERIALS.arrays()
+    assert np.allclose(arrays['diffuse'][cube.material_id], (0.25, 0.5, 0.75)) and not arrays['is_emissive'][cube.material_id]
+    # A pickled scene resolves to this process's registry and materials
+    scene = pickle.loads(pickle.dumps(Scene(camera_position=Q_Vector3d(0, 0, 0), objects=[cube, sphere])))
+    assert scene.materials is MATERIALS and scene.objects[1].material is sphere.material
+
+
+def test_Material_registry_releases_and_remaps_ids():
+    grey = Q_Vector3d(0.5, 0.5, 0.5)
+    sphere = SpherePrimitive(position=Q_Vector3d(0, 0, 5), radius=1, ambient=grey, diffuse=Q_Vector3d(0.125, 0.375, 0.625), specular=grey, shininess=11, reflection=0.25)
+    expected = Scene(camera_position=Q_Vector3d(0, 0, 0), objects=[sphere]).render(width=8, height=6, max_depth=2, lighting_samples=1)
+    data = pickle.dumps(Scene(camera_position=Q_Vector3d(0, 0, 0), objects=[sphere]))
+    gc.collect()
+    material_id, in_use = sphere.material_id, len(MATERIALS)
+    # Once nothing uses a material its id goes to the next new one, as it would be taken in another process
+    del sphere
+    gc.collect()
+    assert len(MATERIALS) == in_use - 1
+    try:
+        MATERIALS[material_id]
+        assert False, 'expected a KeyError'
+    except KeyError:
+        pass
+    other = SpherePrimitive(position=Q_Vector3d(0, 0, 5), radius=1, ambient=grey, diffuse=Q_Vector3d(0.875, 0.125, 0.125), specular=grey, shininess=12, reflection=0)
+    assert other.material_id == material_id
+    # The unpickled sphere registers its own material again instead of taking the stale id
+    scene = pickle.loads(data)
+    assert scene.objects[0].material_id != material_id and scene.objects[0].diffuse == Q_Vector3d(0.125, 0.375, 0.625)
+    assert np.allclose(MATERIALS.arrays()['diffuse'][scene.objects[0].material_id], (0.125, 0.375, 0.625))
+    assert np.allclose(scene.render(width=8, height=6, max_depth=2, lighting_samples=1), expected)
+
+
+def test_LightRegistry_alias_table_matches_weights():
+    white = Q_Vector3d(1, 1, 1)
+    lights = [PlanePrimitive(front_bottom_left=Q_Vector3d(-1, 10, 0), rear_top_right=Q_Vector3d(1, 10, 2), ambient=white, diffuse=white, specular=white, shininess=10, reflection=0, emission=Q_Vector3d(0.5, 0.5, 0.5)),
+              SpherePrimitive(position=Q_Vector3d(5, 10, 0), radius=0.5, ambient=white, diffuse=white, specular=white, shininess=10, reflection=0, emission=Q_Vector3d(2, 2, 2)),
+              TrianglePrimitive((Q_Vector3d(0, 0, 0), Q_Vector3d(3, 0, 0), Q_Vector3d(0, 3, 0)), ambient=white, diffuse=white, specular=white, shininess=10, reflection=0, emission=Q_Vector3d(1, 0, 0))]
+    registry = LightRegistry(emitters=lights)
+    assert math.fabs(registry.areas[1] - math.pi) < 1e-12 and math.fabs(registry.areas[2] - 4.5) < 1e-12
+    counts = [0, 0, 0]
+    for i in range(30000):
+        counts[registry.select((i + 0.5) / 30000)[0]] += 1
+    assert all(math.fabs(count / 30000 - probability) < 1e-3 for count, probability in zip(counts, registry.probabilities))
+    index, point, pdf = registry.sample(u=0.1, v=0.7)
+    assert math.fabs(pdf - registry.probabilities[index] / registry.areas[index]) < 1e-12
+    assert lights[index].bounding_box().minimum[1] - 1e-9 <= point.y <= lights[index].bounding_box().maximum[1] + 1e-9
+
+
+def test_Scene_light_sampling_reaches_every_light():
+    scene = make_test_scene()
+    # A second light that only the light registry knows about, off to the side of lights[0]
+    white = Q_Vector3d(1, 1, 1)
+    scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-30, 5, 5), rear_top_right=Q_Vector3d(-30, 15, 15), ambient=white, diffuse=white, specular=white, shininess=100, reflection=0, emission=Q_Vector3d(0.5, 0.5, 0.5)))
+    lit = scene.render(width=16, height=12, max_depth=1, lighting_samples=2)
+    assert np.abs(lit - scene.render_packet(width=16, height=12, max_depth=1, lighting_samples=2)).mean() < 1e-4
+    scene.light_sampling = 'cone'
+    cone = scene.render(width=16, height=12, max_depth=1, lighting_samples=2)
+    assert len(scene.light_registry) == 2 and lit.sum() > cone.sum()
+
+
+def test_Sampler_tables_are_stratified_and_vary_per_pixel():
+    table = Sampler(kind='sobol').table(16)
+    assert table.shape == (Sampler.PATTERNS, 16, 2)
+    # Scrambling keeps the (0, 2) net: every pattern puts one point in each 1/16 slice of either axis
+    assert (np.sort(np.floor(table * 16), axis=1) == np.arange(16)[np.newaxis, :, np.newaxis]).all()
+    assert np.array_equal(np.sort(blue_noise_mask().ravel()), np.arange(Sampler.MASK_SIZE ** 2))
+    xs, ys = np.arange(32) % 8, np.arange(32) // 8
+    for kind in SAMPLERS:
+        sampler = Sampler(kind=kind)
+        patterns = sampler.pixel_patterns(xs=xs, ys=ys, dimension=1)
+        assert sampler.table(4).shape == (sampler.patterns, 4, 2) and patterns.max() < sampler.patterns
+        assert sampler.pattern(x=3, y=2, dimension=1) == patterns[19]
+        if kind != 'grid':
+            assert len(set(patterns.tolist())) > 8 and not np.array_equal(patterns, sampler.pixel_patterns(xs=xs, ys=ys, dimension=2))
+
+
+def test_Sampler_progressive_passes_average_out_lighting_noise():
+    # A floor lit by an area light through the penumbra of a sphere, so nearly all the error is from the shadow rays
+    grey = Q_Vector3d(0.5, 0.5, 0.5)
+    white = Q_Vector3d(1, 1, 1)
+    black = Q_Vector3d(0, 0, 0)
+    objects = [
+        PlanePrimitive(front_bottom_left=Q_Vector3d(-50, 0, -50), rear_top_right=Q_Vector3d(50, 0, 50), ambient=black, diffuse=grey, specular=black, shininess=1, reflection=0),
+        SpherePrimitive(position=Q_Vector3d(0, 4, 0), radius=1, ambient=grey, diffuse=grey, specular=grey, shininess=1, reflection=0),
+        PlanePrimitive(front_bottom_left=Q_Vector3d(-3, 8, -3), rear_top_right=Q_Vector3d(3, 8, 3), ambient=white, diffuse=white, specular=white, shininess=1, reflection=0, emission=white),
+    ]
+    scene = Scene(objects=objects, camera=Camera(position=Q_Vector3d(0, 3, -0.01), look_at=Q_Vector3d(0, 0, 0), fov=60))
+    settings = dict(width=12, height=9, max_depth=1, cores_to_use=1, packet=True, checkpoint_path=None, preview_path=None, quiet=True)
+    reference = scene.progressive_render(target_samples=36, lighting_samples=8, **settings)
+    errors = [np.sqrt(((scene.progressive_render(target_samples=passes, lighting_samples=1, **settings) - reference) ** 2).mean()) for passes in (1, 9, 36)]
+    # Every pass fires its own shadow rays, so the error keeps falling instead of settling on one pass's noise
+    assert errors[1] < 0.6 * errors[0] and errors[2] < 0.8 * errors[1]
+
+
+def test_OrthoNormalBasis_cone_samples_match_cone_sample():
+    points = Sampler(kind='sobol').table(9)[5]
+    table = OrthoNormalBasis.cone_table(cone_theta=math.pi / 56.0, points=points)
+    directions = [Q_Vector3d(0, 1, 0), Q_Vector3d(1, 0, 0), Q_Vector3d.get_normalized_vector(x=-0.2, y=0.5, z=0.8)]
+    packet = PacketRenderer.cone_directions(np.array([d.to_tuple() for d in directions]), np.broadcast_to(table, (len(directions),) + table.shape))
+    for direction, batch in zip(directions, packet):
+        samples = OrthoNormalBasis.cone_samples(direction=direction, cone_table=table.tolist())
+        for (u, v), sample, row in zip(points.tolist(), samples, batch):
+            expected = OrthoNormalBasis.cone_sample(direction=direction, cone_theta=math.pi / 56.0, u=u, v=v)
+            assert np.allclose(sample.to_tuple(), expected.to_tuple(), atol=1e-12) and np.allclose(row, expected.to_tuple(), atol=1e-12)
+
+
+def test_Scene_russian_roulette_matches_packet_and_keeps_brightness():
+    scene = make_test_scene()
+    grey = Q_Vector3d(0.3, 0.3, 0.3)
+    for z in (-5, 60):
+        scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-50, -5, z), rear_top_right=Q_Vector3d(50, 40, z), ambient=grey, diffuse=grey, specular=grey, shininess=50, reflection=0.9))
+    # Off unless asked for
+    assert scene.roulette_depth is None
+    every_bounce = scene.render_packet(width=16, height=12, max_depth=8, lighting_samples=1)
+    scene.roulette_depth = 3
+    scalar = scene.render(width=16, height=12, max_depth=8, lighting_samples=1)
+    assert np.abs(scalar - scene.render_packet(width=16, height=12, max_depth=8, lighting_samples=1)).max() < 1e-9
+    assert not np.allclose(scalar, every_bounce)
+    assert math.fabs(scalar.mean() - every_bounce.mean()) < 0.02
+    # Every sample of a pixel, and every pass of a progressive render, draws its own decisions
+    centre = {'center': (0, 0)}
+    first_pass = scene.render_tile(width=16, height=12, max_depth=8, lighting_samples=1, offsets=centre)
+    second_pass = scene.render_tile(width=16, height=12, max_depth=8, lighting_samples=1, offsets=centre, first_sample=1)
+    assert not np.allclose(first_pass, second_pass)
+    assert np.abs(second_pass - scene.render_packet_tile(width=16, height=12, max_depth=8, lighting_samples=1, offsets=centre, first_sample=1)).max() < 1e-9
+    grid = scene.render_tile(width=16, height=12, max_depth=8, lighting_samples=1, offsets={'a': (0, 0), 'b': (0, 0)})
+    assert not np.allclose(grid, first_pass)
+    assert np.abs(grid - scene.render_packet_tile(width=16, height=12, max_depth=8, lighting_samples=1, offsets={'a': (0, 0), 'b': (0, 0)})).max() < 1e-9
+
+
+def read_test_image(path: str, width: int, height: int) -> np.ndarray:
+    # Just enough of each format to read back what ImageWriter wrote
+    data = open(path, 'rb').read()
+    if path.endswith('.ppm'):
+        return np.frombuffer(data[-width * height * 3:], dtype=np.uint8).reshape(height, width, 3) / 255
+    if path.endswith('.pfm'):
+        return np.frombuffer(data[-width * height * 12:], dtype='<f4').reshape(height, width, 3)[::-1]
+    if path.endswith('.exr'):
+        # The offset table sits right before the scanlines: y, byte count, then B, G and R
+        line_size = 8 + width * 12
+        offsets = np.frombuffer(data, dtype='<u8', count=height, offset=len(data) - height * (line_size + 8))
+        return np.stack([np.frombuffer(data, dtype='<f4', count=width * 3, offset=int(offset) + 8).reshape(3, width)[::-1].T for offset in offsets])
+    chunks, position = b'', 8
+    while position < len(data):
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        if kind == b'IDAT':
+            chunks += data[position + 8:position + 8 + length]
+        position += 12 + length
+    scanlines = np.frombuffer(zlib.decompress(chunks), dtype=np.uint8).reshape(height, 1 + width * 6)
+    assert not scanlines[:, 0].any()
+    return scanlines[:, 1:].copy().view('>u2').reshape(height, width, 3) / 65535
+
+
+def test_ImageWriter_streams_tiles_in_any_order():
+    rng = np.random.default_rng(0)
+    image = rng.random((37, 53, 3))
+    image[0, 0] = (1.5, -0.25, 0.5)
+    tiles = generate_tiles(width=53, height=37, tile_size=16)
+    with tempfile.TemporaryDirectory() as directory:
+        for image_format in IMAGE_FORMATS:
+            for source in (None, image):
+                path = os.path.join(directory, f'image.{image_format}')
+                filled = np.zeros(37, dtype=np.int64)
+                with ImageWriter(path=path, width=53, height=37, source=source) as writer:
+                    for tile in reversed(tiles):
+                        writer.write_tile(tile=tile, pixels=image[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width])
+                        filled[tile.y:tile.y + tile.height] += tile.width
+                        complete = filled == 53
+                        # pfm and exr rows are written as soon as every tile across them is in, ppm and png rows once every row above them is too
+                        expected_rows = complete.sum() if image_format in ImageWriter.RANDOM_ACCESS_FORMATS else (37 if complete.all() else np.argmin(complete))
+                        assert writer.rows_written == expected_rows
+                        # With a source nothing is copied, without one only the rows not written yet are kept
+                        assert len(writer._pending) == (0 if source is not None else np.count_nonzero(filled) - writer.rows_written)
+                expected = image.astype(np.float32) if image_format in ('pfm', 'exr') else np.clip(image, 0, 1)
+                assert np.abs(read_test_image(path=path, width=53, height=37) - expected).max() <= (0.5 / 255 if image_format == 'ppm' else 0.5 / 65535 if image_format == 'png' else 0)
+        try:
+            ImageWriter(path=os.path.join(directory, 'image.jpg'), width=4, height=4)
+            assert False, 'expected a ValueError for an unknown extension'
+        except ValueError:
+            pass
+
+
+def test_Scene_render_tiles_streams_output_without_copying_rows():
+    scene = make_test_scene()
+    write_tile = ImageWriter.write_tile
+    pending = []
+
+    def recording_write_tile(writer, tile, pixels):
+        write_tile(writer, tile=tile, pixels=pixels)
+        pending.append(len(writer._pending))
+
+    with tempfile.TemporaryDirectory() as directory:
+        output = tuple(os.path.join(directory, f'image.{image_format}') for image_format in IMAGE_FORMATS)
+        ImageWriter.write_tile = recording_write_tile
+        try:
+            # The default spiral order finishes the top rows last, yet no writer holds rows of its own
+            image = scene.render_tiles(width=24, height=18, max_depth=1, lighting_samples=1, cores_to_use=2, tile_size=4, output=output)
+        finally:
+            ImageWriter.write_tile = write_tile
+        assert pending and max(pending) == 0
+        for path in output:
+            expected = image.astype(np.float32) if path.endswith(('pfm', 'exr')) else image
+            assert np.abs(read_test_image(path=path, width=24, height=18) - expected).max() <= 0.5 / 255
+
+
+def test_benchmarks_compare_results_flags_regressions():
+    def results(primary_rate: float, render_seconds: float, peak_rss: float) -> dict:
+        return {'settings': {}, 'scenes': {'demo': {'rays_per_second': {'primary': primary_rate}, 'stage_seconds': {'render': render_seconds, 'write': 0.001},
+                                                    'peak_rss_mb': peak_rss, 'worker_peak_rss_mb': peak_rss, 'scaling': {'1': {'seconds': render_seconds, 'speedup': 1.0}}}}}
+
+    rows = {row[0]: row for row in benchmarks.compare_results(baseline=results(1000.0, 2.0, 50.0), current=results(800.0, 1.0, 52.0), tolerance=0.1)}
+    # Fewer rays per second is worse, less time is better, and small memory growth is within tolerance
+    assert rows['demo.rays_per_second.primary'][4] and abs(rows['demo.rays_per_second.primary'][3] + 0.2) < 1e-12
+    assert not rows['demo.stage_seconds.render'][4] and abs(rows['demo.stage_seconds.render'][3] - 1.0) < 1e-12
+    assert not rows['demo.peak_rss_mb'][4]
+    # Stages too quick to time reliably are not compared
+    assert 'demo.stage_seconds.write' not in rows
+
+
+def test_benchmarks_reference_scenes():
+    mesh = benchmarks.mesh_scene()
+    assert sum(len(primitive) for primitive in mesh.objects if isinstance(primitive, MeshPrimitive)) == 10_000
+    lights = benchmarks.many_lights_scene()
+    lights.build_acceleration_structure()
+    assert len(lights.light_registry) == 16
+
+
+def test_benchmarks_all_run_at_a_tiny_size():
+    # Every benchmark once, so a change to what they call (such as the worker task tuple) cannot break one unnoticed
+    with tempfile.TemporaryDirectory() as directory:
+        tiny = {
+            'bvh': dict(sizes=(10, 100), number_of_rays=5),
+            'shadow': dict(width=8, height=6, lighting_samples=1),
+            'scheduler': dict(width=16, height=10, max_depth=1, lighting_samples=1, tile_size=8),
+            'framebuffer': dict(width=32, height=16, tile_size=8, render_width=16, render_height=8),
+            'allocations': dict(number_of_rays=20),
+            'triangles': dict(sizes=(2, 12), number_of_rays=5),
+            'mesh': dict(sizes=(100,), number_of_rays=5),
+            'boxes': dict(number_of_rays=5),
+            'camera': dict(width=8, height=6),
+            'sequence': dict(number_of_frames=2, width=8, height=6, cores_to_use=2),
+            'workers': dict(number_of_triangles=100, width=16, height=8, tile_size=8, cores_to_use=2),
+            'scenefile': dict(number_of_triangles=100, mesh_size=100),
+            'materials': dict(number_of_triangles=100),
+            'lights': dict(width=8, height=6, reference_samples=2, sample_counts=(1,)),
+            'samplers': dict(width=8, height=8, reference_samples=2, sample_counts=(1,)),
+            'cone': dict(number_of_points=20, sample_counts=(1, 2)),
+            'depth': dict(width=8, height=6, depths=(1, 4)),
+            'output': dict(width=32, height=16, tile_size=8),
+            'suite': dict(results_path=os.path.join(directory, 'results.json'), width=8, height=6, max_depth=1, lighting_samples=1, cores=(1,)),
+            'instrumentation': dict(width=8, height=6, max_depth=1, lighting_samples=1, repeats=1),
+            'kernels': dict(width=4, height=3, max_depth=1, lighting_samples=1),
+        }
+        assert tiny.keys() == benchmarks.BENCHMARKS.keys()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, benchmark in benchmarks.BENCHMARKS.items():
+                benchmark(**tiny[name])
+
+
+def test_Instrumentation_counts_without_changing_the_render():
+    scene = make_test_scene()
+    expected = scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=2, cores_to_use=2, tile_size=4)
+    assert scene.render_statistics['instrumentation'] is None
+    image = scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=2, cores_to_use=2, tile_size=4, instrument=True)
+    assert np.allclose(image, expected)
+    statistics = scene.render_statistics['instrumentation']['total']
+    assert statistics['rays.primary'] == 12 * 9
+    assert statistics['hits'] + statistics['misses'] == statistics['rays.primary'] + statistics['rays.reflection']
+    assert statistics['rays.shadow'] == 4 * statistics['hits'] and sum(value for key, value in statistics.items() if key.startswith('tests.')) > 0
+    assert abs(sum(entry['seconds.tile'] for entry in scene.render_statistics['instrumentation']['workers'].values()) - statistics['seconds.tile']) < 1e-9
+    # Every tile's cost is spread over its pixels
+    assert scene.tile_costs.shape == (9, 12) and np.all(scene.tile_costs > 0)
+
+    # Wrapped methods are put back once the block ends
+    with Instrumentation(scene=scene) as instrumentation:
+        scene.nearest_intersection(ray=scene.primary_ray(x=6, y=4, width=12, height=9))
+    assert 'nearest_intersection' not in vars(scene) and 'primary_ray' not in vars(scene.camera)
+    assert SpherePrimitive.intersect.__name__ == 'intersect' and instrumentation.result()['hits'] + instrumentation.result()['misses'] == 1
+
+
+def test_Progress_aggregates_tiles_from_workers():
+    scene = make_test_scene()
+    stream = io.StringIO()
+    progress = Progress(total=12 * 9, stream=stream)
+    scene.render_tiles(width=12, height=9, max_depth=2, lighting_samples=2, cores_to_use=2, tile_size=4, progress=progress)
+    progress.close()
+    assert progress.done == 12 * 9 and progress.rays >= 12 * 9
+    # Not a terminal, so whole lines, the last one complete
+    assert stream.getvalue().splitlines()[-1].startswith('Rendering: 100.0% 108/108 px')
+
+    written = stream.getvalue()
+    quiet = Progress(total=4, quiet=True, stream=stream)
+    quiet.update(done=4, rays=10)
+    quiet.close()
+    assert quiet.done == 4 and stream.getvalue() == written
+    assert 'ETA' not in Progress(stream=stream).line()
+
+
+def test_Kernels_match_the_python_backend():
+    scene = make_test_scene()
+    white = Q_Vector3d(1, 1, 1)
+    material = dict(ambient=Q_Vector3d(0.1, 0.1, 0), diffuse=Q_Vector3d(0.6, 0.6, 0), specular=white, shininess=30, reflection=0.2)
+    scene.objects.append(CubePrimitive(front_bottom_left=Q_Vector3d(3, -5, 16), rear_top_right=Q_Vector3d(6, -2, 19), rotation=(0.3, 0.5, 0), **material))
+    scene.objects.append(CubePrimitive(front_bottom_left=Q_Vector3d(-8, -5, 18), rear_top_right=Q_Vector3d(-6, -3, 20), **material))
+    scene.objects.append(PlanePrimitive(front_bottom_left=Q_Vector3d(-4, 3, 20), rear_top_right=Q_Vector3d(-1, 5, 23), **material))
+    scene.objects.append(TrianglePrimitive((Q_Vector3d(-2, 2, 15), Q_Vector3d(0, 4, 15), Q_Vector3d(1, 2, 16)), **material))
+    scene.objects.append(MeshPrimitive.from_packed(corners=make_test_mesh_corners() * 0.2 + (0, 3, 22), **material))
+    scene.build_acceleration_structure()
+    kernels = KernelScene(scene=scene)
+    rng = random.Random(4)
+    for _ in range(200):
+        origin = Q_Vector3d(rng.uniform(-2, 2), rng.uniform(-2, 2), rng.uniform(-2, 19))
+        ray = Ray(origin=origin, direction=Q_Vector3d(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)).normalized())
+        expected_object, expected = scene.nearest_intersection(ray=ray)
+        kernel_object, hit = kernels.nearest_intersection(ray=ray)
+        assert kernel_object is expected_object
+        if expected is not None:
+            assert math.fabs(hit.distance - expected.distance) < 1e-9 and hit.is_inside == expected.is_inside
+            assert (hit.normal_to_surface - expected.normal_to_surface).length < 1e-9
+
+    # Traversal stacks are sized from the trees, and shadow rays stop at the first blocker with the same answer as Scene.visible_emitter
+    assert kernels.arrays[8].tolist() == [scene.bvh.depth() + 1, scene.objects[-1].bvh.depth() + 1]
+    for _ in range(200):
+        origin = Q_Vector3d(rng.uniform(-2, 2), rng.uniform(-2, 2), rng.uniform(-2, 19))
+        ray = Ray.from_two_vectors(origin, scene.emitters[0].position + Q_Vector3d(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)))
+        expected = scene.visible_emitter(ray=ray)
+        light = visible_emitter(kernels.arrays, kernels.shading[5], kernels._lights, (origin.x, origin.y, origin.z), (ray.direction.x, ray.direction.y, ray.direction.z))
+        assert (scene.objects[light] if light >= 0 else None) is expected
+
+    # Without numba the kernels still run, as plain Python, so the shading is compared either way
+    for light_sampling in Scene.LIGHT_SAMPLING:
+        scene.light_sampling = light_sampling
+        scene.backend = 'python'
+        expected = scene.render(width=12, height=9, max_depth=2, lighting_samples=2)
+        scene._backend = 'numba'
+        assert np.allclose(scene.render(width=12, height=9, max_depth=2, lighting_samples=2), expected, atol=1e-9)
+
+
+def test_Scene_backend_falls_back_without_numba():
+    scene = make_test_scene()
+    try:
+        scene.backend = 'cuda'
+        assert False, 'expected a ValueError'
+    except ValueError:
+        pass
+    if numba is None:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            scene.backend = 'numba'
+        assert scene.backend == 'python' and len(caught) == 1
+    else:
+        scene.backend = 'numba'
+        assert scene.backend == 'numba'
+
+
 if __name__ == "__main__":
     list_of_tests = [x for x in dir() if "test_" in x]
     total_tests = 0